@@ -14,20 +14,25 @@
 # ЧАСТЬ 2 (callback-router, /name, мини-план сна, расширенные хэндлеры и entrypoint)
 # пришлю по твоей команде.
 
-import os, re, json, uuid, logging, random
+import os, sys, re, json, math, uuid, logging, random, time, asyncio, heapq, itertools, threading
+from collections import deque
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone, time as dtime, date
 from typing import List, Tuple, Dict, Optional, Any
 from difflib import SequenceMatcher
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
 from dotenv import load_dotenv
-from langdetect import detect, DetectorFactory
 
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Bot as TGBot
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 )
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters
+    CallbackQueryHandler, ContextTypes, filters, BaseUpdateProcessor
 )
 
 # --- SAFE import of optional PRO-intake plugin ---
@@ -46,6 +51,14 @@ except Exception:
 
 from openai import OpenAI
 
+# --- optional: NumPy для локального индекса правил (без него — без grounding'а) ---
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except Exception:
+    np = None
+    HAVE_NUMPY = False
+
 # ---------- Google Sheets (robust + memory fallback) ----------
 import gspread
 from gspread.exceptions import SpreadsheetNotFound
@@ -55,11 +68,31 @@ from oauth2client.service_account import ServiceAccountCredentials
 # ---------------- Boot & Config ----------------
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
-DetectorFactory.seed = 0
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+# Запасная (дешевле/быстрее) модель, на которую роутер уходит при открытом брейкере.
+OPENAI_FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4o-mini")
+LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "12"))
+LLM_FALLBACK_TIMEOUT_SEC = float(os.getenv("LLM_FALLBACK_TIMEOUT_SEC", "8"))
+
+# Режим запуска: polling (по умолчанию) или webhook (python main.py webhook / RUN_MODE=webhook)
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # публичный https-адрес, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "tg")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+# Сколько апдейтов обрабатываем одновременно (разные пользователи); один пользователь — строго по очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# HTTP-пул к api.telegram.org (один на весь процесс, через app.bot)
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "64"))
+TG_KEEPALIVE_SEC = float(os.getenv("TG_KEEPALIVE_SEC", "60"))
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "10"))
+TG_WRITE_TIMEOUT = float(os.getenv("TG_WRITE_TIMEOUT", "10"))
+TG_POOL_TIMEOUT = float(os.getenv("TG_POOL_TIMEOUT", "3"))
 
 SHEET_NAME = os.getenv("SHEET_NAME", "TendAI Sheets")
 SHEET_ID = os.getenv("SHEET_ID", "")
@@ -294,24 +327,77 @@ T["uk"] = {**T["ru"], **{
 }}
 T["es"] = T["en"]
 
-# --- [PATCH] Инъекция плейсхолдера имени в ключевые тексты
-def _inject_name_placeholders():
-    for lang in list(T.keys()):
-        for key in ["welcome", "daily_gm", "daily_pm", "thanks", "plan_header"]:
-            try:
-                s = T[lang].get(key, "")
-                if s and "{name}" not in s:
-                    if key == "welcome":
-                        T[lang][key] = (("Привет, {name}! " if lang in ("ru","uk") else
-                                         "¡Hola, {name}! " if lang=="es" else
-                                         "Hi, {name}! ") + s)
-                    elif key in ("daily_gm", "daily_pm", "plan_header"):
-                        T[lang][key] = s + " {name}"
-                    elif key == "thanks":
-                        T[lang][key] = s.replace("🙌", "{name} 🙌")
-            except Exception:
-                pass
-_inject_name_placeholders()
+# ===== Скомпилированный каталог сообщений =====
+# T остаётся исходником и не мутируется. Бандл языка компилируется при первом обращении:
+# каждая строка разбивается на статические куски и плейсхолдеры ({name} и т.п.),
+# плейсхолдер имени вшивается в ключевые тексты здесь же. tr() для строки без
+# плейсхолдеров просто возвращает готовый текст — без replace и без чтения users.
+_PH_RE = re.compile(r"\{(\w+)\}")
+
+def _with_name_placeholder(lang: str, key: str, s: str) -> str:
+    if not s or "{name}" in s:
+        return s
+    if key == "welcome":
+        return ("Привет, {name}! " if lang in ("ru","uk") else
+                "¡Hola, {name}! " if lang=="es" else
+                "Hi, {name}! ") + s
+    if key in ("daily_gm", "daily_pm", "plan_header"):
+        return s + " {name}"
+    if key == "thanks":
+        return s.replace("🙌", "{name} 🙌")
+    return s
+
+class Template:
+    __slots__ = ("text", "parts", "fields")
+
+    def __init__(self, text: str):
+        self.text = text
+        # чётные индексы — статический текст, нечётные — имена плейсхолдеров
+        self.parts = tuple(_PH_RE.split(text))
+        self.fields = frozenset(self.parts[1::2])
+
+    def render(self, values: Dict[str, str]) -> str:
+        if not self.fields:
+            return self.text
+        out = []
+        for i, p in enumerate(self.parts):
+            if i % 2 == 0:
+                out.append(p)
+            else:
+                v = values.get(p)
+                out.append("{" + p + "}" if v is None else v)
+        return "".join(out)
+
+class MessageCatalog:
+    def __init__(self, source: Dict[str, dict]):
+        self._source = source
+        self._bundles: Dict[str, Dict[str, Any]] = {}
+
+    def bundle(self, lang: str) -> Dict[str, Any]:
+        b = self._bundles.get(lang)
+        if b is None:
+            b = self._bundles[lang] = self._compile(lang)
+        return b
+
+    def _compile(self, lang: str) -> Dict[str, Any]:
+        src = self._source[norm_lang(lang)]
+        # язык-алиас (T["es"] = T["en"]) делит бандл с исходным языком
+        base = next(l for l, d in self._source.items() if d is src)
+        if base != lang:
+            return self.bundle(base)
+        return {key: Template(_with_name_placeholder(lang, key, val)) if isinstance(val, str) else val
+                for key, val in src.items()}
+
+CATALOG = MessageCatalog(T)
+
+def tr(lang: str, key: str, uid: Optional[int] = None, **values) -> str:
+    """Текст по ключу; {name} берётся из values или (лениво) из display_name(uid)."""
+    tpl = CATALOG.bundle(lang)[key]
+    if not tpl.fields:
+        return tpl.text
+    if "name" in tpl.fields and "name" not in values:
+        values["name"] = (display_name(uid) if uid is not None else "") or ""
+    return tpl.render(values)
 
 # ---------------- Helpers ----------------
 def utcnow():
@@ -320,17 +406,201 @@ def utcnow():
 def iso(dt: Optional[datetime]) -> str:
     return "" if not dt else dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S%z")
 
+# ---------------- Metrics (in-process) ----------------
+# Простейший реестр метрик: счётчики/гейджи в одном dict, имена в стиле Prometheus
+# (метки зашиты в имя). Периодически пишется в лог (job_metrics_log); если задан
+# METRICS_PORT, отдаётся по GET /metrics (metrics_serve) — как /metrics в webhook.py.
+METRICS_LOG_SEC = int(os.getenv("METRICS_LOG_SEC", "300"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS: Dict[str, float] = {}
+
+def metric_name(base: str, **labels) -> str:
+    if not labels:
+        return base
+    inner = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{base}{{{inner}}}"
+
+def metric_inc(name: str, n: float = 1.0, **labels):
+    key = metric_name(name, **labels)
+    METRICS[key] = METRICS.get(key, 0.0) + n
+
+def metric_set(name: str, value: float, **labels):
+    METRICS[metric_name(name, **labels)] = float(value)
+
+def metric_observe(name: str, value: float, **labels):
+    """Упрощённая гистограмма: _count/_sum/_max."""
+    metric_inc(f"{name}_count", **labels)
+    metric_inc(f"{name}_sum", value, **labels)
+    key = metric_name(f"{name}_max", **labels)
+    if value > METRICS.get(key, 0.0):
+        METRICS[key] = float(value)
+
+def metrics_snapshot() -> Dict[str, float]:
+    return dict(sorted(dict(METRICS).items()))   # копия: читается и из потока metrics_serve
+
+def metrics_text() -> str:
+    """Экспорт в текстовом формате Prometheus."""
+    return "".join(f"{k} {v:g}\n" for k, v in metrics_snapshot().items())
+
+def metrics_serve(port: int) -> ThreadingHTTPServer:
+    """GET /metrics → metrics_text() на отдельном порту, в фоновом потоке."""
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"metrics on :{port}/metrics")
+    return srv
+
+async def job_metrics_log(context: ContextTypes.DEFAULT_TYPE):
+    logging.info("METRICS " + json.dumps(metrics_snapshot(), ensure_ascii=False))
+
+# ===== Определение языка =====
+# Только SUPPORTED-языки. Кириллица — по алфавиту (і/ї/є/ґ → uk, иначе ru). Латиница —
+# en против es: диакритика/¿¡ и логарифм отношения правдоподобий символьных триграмм,
+# обученных на компактных образцах ниже. Для каждого пользователя копим историю
+# уверенных определений: после LANG_STABLE_N совпадений с текущим языком больше не определяем.
+LANG_MIN_CONF = float(os.getenv("LANG_MIN_CONF", "0.9"))
+LANG_MIN_NGRAMS = 6
+LANG_STABLE_N = 3
+LANG_MAX_CHARS = 160
+
+_LANG_SEED_EN = (
+    "hi how are you today i have a headache since the morning and it is getting worse "
+    "my back hurts when i sit for a long time what should i do about it "
+    "i slept only five hours last night and i feel tired all day "
+    "can you help me with my diet i want to lose weight and have more energy "
+    "what is the best time to drink water should i take vitamin d or magnesium "
+    "thank you this was helpful please remind me in the evening "
+    "i feel stressed at work and cannot focus the pain is sharp and it comes and goes "
+    "my stomach burns after meals especially at night which foods should i avoid "
+    "how many steps do you recommend per day is coffee bad for my sleep "
+    "the doctor said my blood pressure is a little high what does that mean for me "
+    "yes no maybe later good morning good night tomorrow week month with without "
+    "the and that this there their have has what when where which would could should "
+    "about after again because before being both but each from into just like more "
+    "most much never only other over same some such than then them these they through "
+    "very well were while will your yours how long does it usually take to get better"
+)
+_LANG_SEED_ES = (
+    "hola como estas hoy tengo dolor de cabeza desde la mañana y cada vez es peor "
+    "me duele la espalda cuando estoy sentado mucho tiempo que debo hacer "
+    "anoche dormí solo cinco horas y me siento cansado todo el día "
+    "puedes ayudarme con mi dieta quiero bajar de peso y tener más energía "
+    "cuál es el mejor momento para beber agua debo tomar vitamina d o magnesio "
+    "gracias esto fue útil por favor recuérdame en la tarde o por la noche "
+    "me siento estresado en el trabajo y no puedo concentrarme el dolor es agudo y va y viene "
+    "me arde el estómago después de comer sobre todo en la noche qué alimentos debo evitar "
+    "cuántos pasos recomiendas por día el café es malo para mi sueño "
+    "el médico dijo que mi presión arterial está un poco alta qué significa eso para mí "
+    "sí no quizás luego buenos días buenas noches mañana semana mes con sin "
+    "el la los las que de del para por una uno unos pero porque cuando donde como "
+    "también muy bien estoy tengo quiero puedo hace hacer desde hasta entre sobre "
+    "todo todos nada algo siempre nunca ahora después antes mucho poco mejor peor "
+    "cuánto tiempo tarda normalmente en mejorar necesito ayuda con mi salud"
+)
+
+_LD_CYR_RE = re.compile(r"[а-яёіїєґ]")
+_LD_UK_RE = re.compile(r"[іїєґ]")
+_LD_ES_MARKS_RE = re.compile(r"[ñ¿¡áéíóú]")
+_LD_WORD_RE = re.compile(r"[a-zñáéíóúü]+")
+
+def _trigrams(text: str) -> List[str]:
+    out = []
+    for w in _LD_WORD_RE.findall(text):
+        w = f" {w} "
+        out.extend(w[i:i + 3] for i in range(len(w) - 2))
+    return out
+
+def _script_lang(low: str) -> Optional[str]:
+    """ru/uk по кириллице (бесплатная проверка), None — латиница или нет букв."""
+    if _LD_CYR_RE.search(low):
+        return "uk" if _LD_UK_RE.search(low) else "ru"
+    return None
+
+class LangDetector:
+    def __init__(self):
+        self._delta: Optional[Dict[str, float]] = None   # триграмма → log P(en) − log P(es)
+        self._unk = 0.0
+        self._history: Dict[int, deque] = {}
+        self._stable: set = set()
+
+    def warm(self):
+        if self._delta is not None:
+            return
+        t0 = time.perf_counter()
+        en, es = {}, {}
+        for g in _trigrams(_LANG_SEED_EN):
+            en[g] = en.get(g, 0) + 1
+        for g in _trigrams(_LANG_SEED_ES):
+            es[g] = es.get(g, 0) + 1
+        v = len(set(en) | set(es))
+        n_en, n_es = sum(en.values()) + v, sum(es.values()) + v
+        self._delta = {g: math.log((en.get(g, 0) + 1) / n_en) - math.log((es.get(g, 0) + 1) / n_es)
+                       for g in set(en) | set(es)}
+        self._unk = math.log(1 / n_en) - math.log(1 / n_es)
+        self.detect("warm up the detector")
+        logging.info(f"Lang detector ready: {len(self._delta)} trigrams in {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    def detect(self, text: str) -> Tuple[Optional[str], float]:
+        """(язык, уверенность 0..1); (None, 0.0), если текста слишком мало."""
+        if self._delta is None:
+            self.warm()
+        low = (text or "")[:LANG_MAX_CHARS].lower()
+        cyr = _script_lang(low)
+        if cyr:
+            return cyr, 1.0
+        grams = _trigrams(low)
+        if len(grams) < LANG_MIN_NGRAMS:
+            return None, 0.0
+        delta, unk = self._delta, self._unk
+        score = sum(delta.get(g, unk) for g in grams)
+        if _LD_ES_MARKS_RE.search(low):
+            score -= 6.0
+        score = max(-30.0, min(30.0, score))
+        p_en = 1.0 / (1.0 + math.exp(-score))
+        return ("en", p_en) if p_en >= 0.5 else ("es", 1.0 - p_en)
+
+    def detect_for_user(self, uid: int, text: str, current: str) -> str:
+        """Язык для пользователя: current, пока нет уверенного другого. После стабилизации
+        пропускается только триграммная модель en/es; проверка алфавита идёт всегда."""
+        if uid in self._stable:
+            cyr = _script_lang((text or "")[:LANG_MAX_CHARS].lower())
+            if cyr == current or (cyr is None and current not in ("ru", "uk")):
+                return current
+            self._stable.discard(uid)   # сменился алфавит — определяем заново
+        lang, conf = self.detect(text)
+        if lang is None or conf < LANG_MIN_CONF:
+            return current
+        hist = self._history.setdefault(uid, deque(maxlen=LANG_STABLE_N))
+        hist.append(lang)
+        if lang == current and len(hist) == LANG_STABLE_N and all(l == current for l in hist):
+            self._stable.add(uid)
+            self._history.pop(uid, None)
+            metric_inc("lang_detect_stable_total")
+        return lang
+
+    def forget(self, uid: int):
+        self._stable.discard(uid)
+        self._history.pop(uid, None)
+
+LANG_DETECTOR = LangDetector()
+
 def detect_lang_from_text(text: str, fallback: str) -> str:
-    s = (text or "").strip()
-    if not s:
-        return fallback
-    low = s.lower()
-    if re.search(r"[а-яёіїєґ]", low):
-        return "uk" if re.search(r"[іїєґ]", low) else "ru"
-    try:
-        return norm_lang(detect(s))
-    except Exception:
-        return fallback
+    lang, conf = LANG_DETECTOR.detect(text)
+    return lang if lang is not None and conf >= LANG_MIN_CONF else fallback
 
 def profile_is_incomplete(profile_row: dict) -> bool:
     keys = ["sex","age","goal"]
@@ -390,24 +660,132 @@ async def _ipro_save_to_sheets_and_open_menu(update: Update, context: ContextTyp
         await context.application.bot.send_message(update.effective_chat.id, "/start")
 
 # ---------- Anti-duplicate questions ----------
+# SequenceMatcher квадратичен по длине, поэтому он остаётся только судьёй для реальных
+# кандидатов. Перед ним два дешёвых необходимых условия ratio >= thresh:
+#  • длина: ratio <= 2·min(la, lb) / (la + lb);
+#  • биграммы: при U несовпавших символах совпавшие блоки (их не больше U + 1) дают минимум
+#    M − U − 1 общих биграмм, где M = (la + lb − U) / 2. Если общих меньше — дубля нет.
+# Обе проверки точные (не отсекают ни одной пары, которую засчитал бы SequenceMatcher).
+class PromptSig:
+    __slots__ = ("low", "n", "bigrams")
+
+    def __init__(self, text: str):
+        self.low = (text or "").lower()
+        self.n = len(self.low)
+        bg: Dict[str, int] = {}
+        low = self.low
+        for i in range(self.n - 1):
+            k = low[i:i + 2]
+            bg[k] = bg.get(k, 0) + 1
+        self.bigrams = bg
+
+    def shared(self, other: "PromptSig") -> int:
+        a, b = (self.bigrams, other.bigrams) if len(self.bigrams) <= len(other.bigrams) else (other.bigrams, self.bigrams)
+        return sum(min(v, b.get(k, 0)) for k, v in a.items())
+
+    def similar(self, other: "PromptSig", thresh: float) -> bool:
+        total = self.n + other.n
+        if total == 0 or self.low == other.low:
+            return True
+        m_min = _min_matches(total, thresh)
+        if min(self.n, other.n) < m_min:
+            return False
+        max_unmatched = total - 2 * m_min
+        if 2 * self.shared(other) < total - 3 * max_unmatched - 2:
+            return False
+        return _ratio(self.low, other.low) >= thresh
+
+def _min_matches(total: int, thresh: float) -> int:
+    """Наименьшее M, при котором SequenceMatcher засчитает ratio: то же выражение
+    2.0 * M / total >= thresh во float, что и в difflib, — без ошибок округления на границе."""
+    m = max(0, math.ceil(thresh * total / 2))
+    while m > 0 and 2.0 * (m - 1) / total >= thresh:
+        m -= 1
+    while 2.0 * m / total < thresh:
+        m += 1
+    return m
+
 def _ratio(a: str, b: str) -> float:
     return SequenceMatcher(None, (a or "").lower(), (b or "").lower()).ratio()
 
 def is_duplicate_question(uid: int, text: str, thresh: float = 0.93) -> bool:
     s = sessions.setdefault(uid, {})
     asked = s.setdefault("asked_prompts", [])
-    for prev in asked[-4:]:
-        if _ratio(prev, text) >= thresh:
+    sigs = s.setdefault("asked_sigs", [])
+    sig = PromptSig(text)
+    for prev in sigs[-4:]:
+        if sig.similar(prev, thresh):
             return True
     asked.append(text)
+    sigs.append(sig)
     if len(asked) > 16:
         s["asked_prompts"] = asked[-16:]
+        s["asked_sigs"] = sigs[-16:]
     return False
 
 async def send_unique(msg_obj, uid: int, text: str, reply_markup=None, force: bool = False):
     if force or not is_duplicate_question(uid, text):
         await msg_obj.reply_text(text, reply_markup=reply_markup)
 
+# ===== Reply composer =====
+# Собирает всё, что on_text хочет сказать за один ход, и отправляет минимумом сообщений:
+# текст без клавиатуры «прилипает» к следующей части с клавиатурой (баннер + зеркало фактов
+# + ответ роутера → одно сообщение), part(join=True) дописывается к последнему собранному
+# сообщению (followups — к ответу), tail() уходит последним отдельным сообщением (опрос).
+TG_TEXT_LIMIT = 4096
+
+class ReplyComposer:
+    def __init__(self, bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self._msgs: List[list] = []          # [text, kb, priority]
+        self._pending: List[str] = []
+        self._tail: List[list] = []
+
+    def part(self, text: str, kb=None, *, join: bool = False):
+        text = (text or "").strip()
+        if not text:
+            return
+        if join and kb is None and self._msgs and self._fits(self._msgs[-1][0], text):
+            self._msgs[-1][0] += "\n\n" + text
+            return
+        if kb is None:
+            self._pending.append(text)
+            return
+        self._close(kb, text)
+
+    def tail(self, text: str, kb=None, *, priority: Optional[int] = None):
+        self._tail.append([text, kb, PRIO_REPLY if priority is None else priority])
+
+    @staticmethod
+    def _fits(a: str, b: str) -> bool:
+        return len(a) + len(b) + 2 <= TG_TEXT_LIMIT
+
+    def _close(self, kb, text: str):
+        body = ""
+        for t in self._pending + [text]:
+            if body and not self._fits(body, t):
+                self._msgs.append([body, None, PRIO_REPLY])
+                body = ""
+            body = body + "\n\n" + t if body else t
+        self._pending = []
+        self._msgs.append([body, kb, PRIO_REPLY])
+
+    async def flush(self) -> int:
+        if self._pending:
+            last = self._pending.pop()
+            self._close(None, last)
+        out, self._msgs, tail, self._tail = self._msgs, [], self._tail, []
+        sent = 0
+        for text, kb, prio in out + tail:
+            try:
+                await OUTBOX.send(self.bot, self.chat_id, text, reply_markup=kb, priority=prio)
+                sent += 1
+            except Exception as e:
+                logging.error(f"composer send fail: {e}")
+        metric_observe("messages_per_turn", sent)
+        return sent
+
 # -------- Sheets (with memory fallback) --------
 SHEETS_ENABLED = True
 ss = None
@@ -516,6 +894,45 @@ MEM_HABITS: List[dict] = []
 # --------- Sessions ----------
 sessions: Dict[int, dict] = {}
 
+# ===== Состояние диалога =====
+# Одно поле sessions[uid]["state"] вместо набора флагов awaiting_*. on_text по нему сразу
+# прыгает в нужную ветку (TEXT_STATES ниже). Переходы пишутся в кольцевой буфер
+# STATE_TRACE[uid] (и в лог при STATE_TRACE_LOG=1) и в метрику state_transitions_total.
+ST_IDLE          = "idle"
+ST_NAME          = "await_name"
+ST_DAILY_COMMENT = "await_daily_comment"
+ST_FREE_FEEDBACK = "await_free_feedback"
+ST_CITY          = "await_city"
+ST_WEIGHT        = "await_weight"
+ST_H60           = "await_h60"
+ST_PROFILE_VALUE = "await_profile_value"   # ключ поля — в sessions[uid]["p_wait_key"]
+ST_PAIN          = "pain_triage"           # шаг — в sessions[uid]["step"]
+
+STATE_TRACE_LOG = os.getenv("STATE_TRACE_LOG", "0") == "1"
+STATE_TRACE_LEN = 20
+STATE_TRACE: Dict[int, deque] = {}
+
+def get_state(uid: int) -> str:
+    s = sessions.get(uid)
+    return s.get("state", ST_IDLE) if s else ST_IDLE
+
+def set_state(uid: int, state: str, reason: str, **data):
+    s = sessions.setdefault(uid, {})
+    old = s.get("state", ST_IDLE)
+    s["state"] = state
+    s.update(data)
+    if old == state:
+        return
+    STATE_TRACE.setdefault(uid, deque(maxlen=STATE_TRACE_LEN)).append((time.time(), old, state, reason))
+    metric_inc("state_transitions_total", **{"from": old, "to": state})
+    if STATE_TRACE_LOG:
+        logging.info(f"[STATE] uid={uid} {old} -> {state} ({reason})")
+
+def leave_state(uid: int, state: str, reason: str):
+    """Выйти в idle, только если пользователь всё ещё в state."""
+    if get_state(uid) == state:
+        set_state(uid, ST_IDLE, reason)
+
 # --- [PATCH] Имя пользователя: sanitize/display/set + одноразовый запрос/сохранение
 def sanitize_name(raw: str) -> str:
     s = (raw or "").strip()
@@ -524,7 +941,9 @@ def sanitize_name(raw: str) -> str:
     return s[:30]
 
 def display_name(uid: int) -> str:
-    u = users_get(uid)
+    return _display_name_from(users_get(uid))
+
+def _display_name_from(u: dict) -> str:
     name = (u.get("name") or "").strip()
     if name:
         return name
@@ -545,7 +964,7 @@ async def ensure_ask_name(uid: int, lang: str, context: ContextTypes.DEFAULT_TYP
         [InlineKeyboardButton("✍️ " + ("Написать имя" if lang!="en" else "Type your name"), callback_data="name|ask")],
         [InlineKeyboardButton(T[lang]["skip"], callback_data="name|skip")]
     ])
-    sessions.setdefault(uid, {})["awaiting_name"] = True
+    set_state(uid, ST_NAME, "ask_name")
     prompt = "How should I address you?" if lang == "en" else "Как к вам обращаться?"
     await maybe_send(context, uid, prompt)
     await maybe_send(
@@ -556,16 +975,15 @@ async def ensure_ask_name(uid: int, lang: str, context: ContextTypes.DEFAULT_TYP
     )
     return True
 
-async def try_handle_name_reply(uid: int, text: str, lang: str) -> bool:
+async def try_handle_name_reply(bot, uid: int, text: str, lang: str) -> bool:
     """Если ожидали имя — сохранить и подтвердить. True, если сообщение обработано."""
-    if not sessions.get(uid, {}).get("awaiting_name"):
+    if get_state(uid) != ST_NAME:
         return False
-    sessions[uid]["awaiting_name"] = False
-    bot = TGBot(TELEGRAM_TOKEN)
+    set_state(uid, ST_IDLE, "name_reply")
     name = sanitize_name(text)
     if not name:
         try:
-            await bot.send_message(uid,
+            await OUTBOX.send(bot, uid,
                 "Не понял. Пришлите имя буквами (например: «Мария»)." if lang!="en" else
                 "Didn’t catch that — please send a name (e.g., “Maria”).")
         except Exception as e:
@@ -573,7 +991,7 @@ async def try_handle_name_reply(uid: int, text: str, lang: str) -> bool:
         return True
     set_name(uid, name)
     try:
-        await bot.send_message(uid, (f"Принял, {name}! 👍" if lang!="en" else f"Got it, {name}! 👍"))
+        await OUTBOX.send(bot, uid, (f"Принял, {name}! 👍" if lang!="en" else f"Got it, {name}! 👍"))
     except Exception as e:
         logging.warning(f"name ack send fail: {e}")
     return True
@@ -591,10 +1009,409 @@ def is_question(text: str) -> bool:
         return False
     if "?" in s:
         return True
-    q_kws = ["как","когда","что","почему","зачем","ли","можно","нужно",
-             "how","when","what","which","why","where","can","could","should",
-             "як","коли","що","чому","навіщо"]
-    return any(re.search(rf"\b{kw}\b", s) for kw in q_kws)
+    return "question" in keyword_categories(s)
+
+# -------- Snapshot replica --------
+# Users/Profiles/Episodes/Reminders/Rules читаются не по требованию, а фоновым
+# job_replica_refresh: один values_batch_get на все листы раз в REPLICA_REFRESH_SEC.
+# Строки сравниваются с прошлым снимком по содержимому — неизменённые переиспользуют
+# прежние записи, — и новый неизменяемый снимок подменяет старый одним присваиванием.
+# *_get-хелперы читают только снимок (0 запросов к API). Собственные записи бота видны
+# сразу через локальный слой: он живёт, пока следующий снимок не прочитан после записи.
+# Ручные правки в таблице появляются не позже чем через REPLICA_REFRESH_SEC (+ время чтения).
+REPLICA_REFRESH_SEC = int(os.getenv("REPLICA_REFRESH_SEC", "20"))
+REPLICA_MAX_STALE_SEC = int(os.getenv("REPLICA_MAX_STALE_SEC", str(REPLICA_REFRESH_SEC * 6)))
+
+REPLICA_TABLES = {
+    # имя: (лист, заголовки, ключ)
+    "users":     (lambda: ws_users,     USERS_HEADERS,     "user_id"),
+    "profiles":  (lambda: ws_profiles,  PROFILES_HEADERS,  "user_id"),
+    "episodes":  (lambda: ws_episodes,  EPISODES_HEADERS,  "episode_id"),
+    "reminders": (lambda: ws_reminders, REMINDERS_HEADERS, "id"),
+    "rules":     (lambda: ws_rules,     RULES_HEADERS,     "rule_id"),
+}
+
+class ReplicaTable:
+    __slots__ = ("rows", "by_key", "by_raw")
+
+    def __init__(self, rows: tuple, by_key: Dict[str, dict], by_raw: Dict[tuple, dict]):
+        self.rows = rows            # записи по порядку строк (строка листа = индекс + 2)
+        self.by_key = by_key        # ключ → первая запись с этим ключом
+        self.by_raw = by_raw        # сырые значения строки → запись (для диффа)
+
+    @classmethod
+    def build(cls, values: List[list], headers: List[str], key: str, prev: Optional["ReplicaTable"]):
+        head = values[0] if values else headers
+        cols = [(h, head.index(h)) for h in headers if h in head]
+        width = len(head)
+        reuse = prev.by_raw if prev is not None else {}
+        rows, by_key, by_raw, changed = [], {}, {}, 0
+        for raw in values[1:]:
+            raw = tuple(raw) + ("",) * (width - len(raw))
+            rec = reuse.get(raw)
+            if rec is None:
+                rec = {h: "" for h in headers}
+                rec.update((h, raw[i]) for h, i in cols)
+                changed += 1
+            rows.append(rec)
+            by_raw.setdefault(raw, rec)
+            by_key.setdefault(str(rec.get(key, "")), rec)
+        return cls(tuple(rows), by_key, by_raw), changed
+
+class SheetReplica:
+    def __init__(self):
+        self._tables: Dict[str, ReplicaTable] = {}
+        self._taken_at = 0.0
+        self._local: Dict[Tuple[str, str], Tuple[float, dict]] = {}
+        # refresh идёт в рабочем потоке, put/patch — из обработчиков и буферов дописывания
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        names = list(REPLICA_TABLES)
+        started = time.time()
+        t0 = time.monotonic()
+        resp = ss.values_batch_get([f"'{REPLICA_TABLES[n][0]().title}'" for n in names])
+        tables = {}
+        for name, vr in zip(names, resp.get("valueRanges", [])):
+            _, headers, key = REPLICA_TABLES[name]
+            tables[name], changed = ReplicaTable.build(vr.get("values") or [], headers, key, self._tables.get(name))
+            metric_inc("replica_rows_changed_total", changed, table=name)
+            metric_set("replica_rows", len(tables[name].rows), table=name)
+        with self._lock:
+            self._tables, self._taken_at = tables, started
+            # снимаем только записи, которые снимок уже видел; put() после чтения листа
+            # заменил кортеж — такую запись оставляем
+            for k, loc in list(self._local.items()):
+                if loc[0] < started and self._local.get(k) is loc:
+                    del self._local[k]
+        metric_observe("replica_refresh_seconds", time.monotonic() - t0)
+
+    def invalidate(self):
+        self._taken_at = 0.0
+
+    def _table(self, name: str) -> ReplicaTable:
+        if not self._tables or time.time() - self._taken_at > REPLICA_MAX_STALE_SEC:
+            self.refresh()   # первый запуск или остановленный job — читаем синхронно
+        return self._tables[name]
+
+    def get(self, name: str, key) -> Optional[dict]:
+        self._table(name)
+        with self._lock:   # снимок и локальные записи — из одного и того же состояния
+            table = self._tables[name]
+            loc = self._local.get((name, str(key)))
+        if loc is not None:
+            return dict(loc[1])
+        rec = table.by_key.get(str(key))
+        return dict(rec) if rec is not None else None
+
+    def rows(self, name: str) -> List[dict]:
+        self._table(name)
+        key = REPLICA_TABLES[name][2]
+        with self._lock:
+            table = self._tables[name]
+            local = {k: rec for (n, k), (_, rec) in self._local.items() if n == name}
+        if not local:
+            return list(table.rows)
+        out = [local.pop(str(r.get(key, "")), r) for r in table.rows]
+        return out + list(local.values())
+
+    def put(self, name: str, key, rec: dict, *, pending: bool = False):
+        """Локальная запись сразу после записи в лист. pending — строка ещё в буфере
+        дописывания: такую запись снимок не вытесняет, пока не вызван confirm()."""
+        with self._lock:
+            self._local[(name, str(key))] = (math.inf if pending else time.time(), dict(rec))
+
+    def confirm(self, name: str, key):
+        with self._lock:
+            loc = self._local.get((name, str(key)))
+            if loc is not None:
+                self._local[(name, str(key))] = (time.time(), loc[1])
+
+    def patch(self, name: str, key, fields: Dict[str, str]):
+        self._table(name)
+        with self._lock:
+            rec = self.get(name, key)
+            if rec is not None:
+                rec.update(fields)
+                self.put(name, key, rec)
+
+REPLICA = SheetReplica()
+
+# Номер строки, найденный по колонке A, годен только пока строки не удаляют: поиск и запись
+# по номеру делаются под SHEET_ROWS_LOCK, под ним же /delete_data удаляет строки.
+SHEET_ROWS_LOCK = threading.Lock()
+
+def _find_row(ws, key) -> Optional[int]:
+    """Номер строки по значению в колонке A: одно чтение колонки, а не всего листа."""
+    for i, v in enumerate(ws.col_values(1), start=1):
+        if i > 1 and v == str(key):
+            return i
+    return None
+
+async def job_replica_refresh(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(REPLICA.refresh)
+    except Exception as e:
+        logging.warning(f"replica refresh failed: {e}")
+
+# -------- Tail readers --------
+# HabitsLog только дописывается (и пишется сразу, без AppendBuffer), поэтому читать его
+# с первой строки незачем. TailReader помнит, сколько строк уже видел, и при refresh() одним batch_get
+# берёт строку 2 и хвост начиная с последней известной строки: если обе совпали с буфером,
+# новые строки дописываются в колоночный буфер, иначе (строки удаляли/двигали) — полная
+# перезагрузка. Стоимость обновления пропорциональна числу новых строк.
+class TailReader:
+    def __init__(self, name: str, ws_get, headers: List[str]):
+        self.name = name
+        self._ws = ws_get
+        self.headers = headers
+        self._last_col = gsu.rowcol_to_a1(1, len(headers)).rstrip("1")
+        self.reset()
+
+    def reset(self):
+        self.cols: Dict[str, List[str]] = {h: [] for h in self.headers}
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _row(self, i: int) -> List[str]:
+        return [self.cols[h][i] for h in self.headers]
+
+    def _extend(self, rows: List[list]):
+        width = len(self.headers)
+        for raw in rows:
+            raw = (list(raw) + [""] * width)[:width]
+            for h, v in zip(self.headers, raw):
+                self.cols[h].append(v)
+        self.n += len(rows)
+
+    def refresh(self):
+        ws = self._ws()
+        t0 = time.monotonic()
+        if self.n == 0:
+            self._extend(ws.get_values(f"A2:{self._last_col}"))
+            metric_inc("tail_full_reloads_total", table=self.name)
+        else:
+            # строка листа = индекс в буфере + 2; хвост начинаем с последней известной строки
+            first, tail = ws.batch_get([f"A2:{self._last_col}2", f"A{self.n + 1}:{self._last_col}"])
+            width = len(self.headers)
+            norm = lambda r: (list(r) + [""] * width)[:width]
+            if not first or not tail or norm(first[0]) != self._row(0) or norm(tail[0]) != self._row(self.n - 1):
+                logging.info(f"tail reader {self.name}: rows changed, full reload")
+                self.reset()
+                return self.refresh()
+            self._extend(tail[1:])
+            metric_inc("tail_rows_read_total", len(tail) - 1, table=self.name)
+        metric_observe("tail_refresh_seconds", time.monotonic() - t0, table=self.name)
+
+    def set(self, row_no: int, field: str, value: str):
+        i = row_no - 2
+        if 0 <= i < self.n:
+            self.cols[field][i] = value
+
+    def where(self, **eq) -> List[dict]:
+        """Строки, у которых все указанные колонки равны значениям (с номерами строк в _row)."""
+        idx = range(self.n)
+        for field, value in eq.items():
+            col = self.cols[field]
+            idx = [i for i in idx if col[i] == value]
+        return [{**dict(zip(self.headers, self._row(i))), "_row": i + 2} for i in idx]
+
+TAIL_READERS = {
+    "habits": TailReader("HabitsLog", lambda: ws_habits, HABITS_HEADERS),
+}
+
+# -------- Append buffers --------
+# Дописывание строк (чек-ины, отзывы, эпизоды, напоминания) копится в буфере листа и уходит
+# одним append_rows: job_append_flush раз в APPEND_FLUSH_SEC или сразу, как набралось
+# APPEND_FLUSH_MAX строк; post_shutdown дожимает остатки. on_row получает номер строки после
+# записи. Кому строка нужна в листе немедленно (episode_set, статусы напоминаний), зовёт
+# flush() — синхронно, как и остальные обращения к Sheets.
+APPEND_FLUSH_SEC = float(os.getenv("APPEND_FLUSH_SEC", "2"))
+APPEND_FLUSH_MAX = int(os.getenv("APPEND_FLUSH_MAX", "200"))
+
+class AppendBuffer:
+    def __init__(self, name: str, ws_get):
+        self.name = name
+        self._ws = ws_get
+        self._rows: List[Tuple[list, Any]] = []
+        self._lock = threading.Lock()         # защищает _rows
+        self._flush_lock = threading.Lock()   # сериализует append_rows — порядок строк сохраняется
+        self._kicked = False                  # сброс по размеру уже запланирован
+        self._kick_after = 0.0                # после неудачи — не раньше (monotonic)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, row: list, on_row=None):
+        with self._lock:
+            self._rows.append((row, on_row))
+            n = len(self._rows)
+            # один сброс по размеру за раз; после сбоя ждём APPEND_FLUSH_SEC (или job_append_flush)
+            kick = n >= APPEND_FLUSH_MAX and not self._kicked and time.monotonic() >= self._kick_after
+            if kick:
+                self._kicked = True
+        metric_set("append_pending", n, sheet=self.name)
+        if kick:
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self._flush_quiet)
+            except RuntimeError:
+                self._flush_quiet()
+
+    def _flush_quiet(self):
+        try:
+            self.flush()
+        except Exception:
+            # строки остались в буфере, ошибка уже в логе; повторит job_append_flush
+            self._kick_after = time.monotonic() + APPEND_FLUSH_SEC
+        finally:
+            self._kicked = False
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._rows = self._rows, []
+            if not batch:
+                return 0
+            t0 = time.monotonic()
+            try:
+                resp = self._ws().append_rows([row for row, _ in batch])
+            except Exception as e:
+                with self._lock:
+                    self._rows = batch + self._rows
+                metric_inc("append_flush_failed_total", sheet=self.name)
+                logging.error(f"append flush {self.name} failed ({len(batch)} rows): {e}")
+                raise
+            metric_observe("append_flush_rows", len(batch), sheet=self.name)
+            metric_observe("append_flush_seconds", time.monotonic() - t0, sheet=self.name)
+            metric_set("append_pending", len(self._rows), sheet=self.name)
+            start = _row_from_append(resp)
+            for i, (_, on_row) in enumerate(batch):
+                if on_row is not None:
+                    try:
+                        on_row(start + i if start else None)
+                    except Exception as e:
+                        logging.warning(f"append {self.name} row callback failed: {e}")
+            return len(batch)
+
+APPENDS = {
+    "daily":     AppendBuffer("DailyCheckins", lambda: ws_daily),
+    "feedback":  AppendBuffer("Feedback",      lambda: ws_feedback),
+    "episodes":  AppendBuffer("Episodes",      lambda: ws_episodes),
+    "reminders": AppendBuffer("Reminders",     lambda: ws_reminders),
+}
+
+def appends_flush_all(attempts: int = 1):
+    for buf in APPENDS.values():
+        for attempt in range(attempts):
+            try:
+                buf.flush()
+                break
+            except Exception:
+                if attempt + 1 < attempts:
+                    time.sleep(0.5 * 2 ** attempt)
+        if len(buf):
+            logging.error(f"append buffer {buf.name}: {len(buf)} rows not written")
+
+async def job_append_flush(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(appends_flush_all)
+
+# -------- Hot state --------
+# Часто меняющиеся служебные поля Users (флаг «ждём ответа», счётчик авто-сообщений,
+# даты показа опроса/баннера) живут в памяти: users_get накладывает их поверх строки,
+# users_set меняет только память и помечает поле грязным. job_hot_checkpoint раз в
+# HOT_CHECKPOINT_SEC пишет все грязные поля одним batch_update; post_shutdown — последний раз.
+HOT_FIELDS = frozenset({"pending_q", "sent_today", "last_sent_utc", "last_fb_asked", "profile_banner_shown"})
+HOT_CHECKPOINT_SEC = int(os.getenv("HOT_CHECKPOINT_SEC", "30"))
+
+class HotState:
+    def __init__(self):
+        self._vals: Dict[int, Dict[str, str]] = {}
+        self._dirty: Dict[int, Dict[str, str]] = {}
+        self._dropped: set = set()   # /delete_data: не возвращать их поля из неудачного чекпоинта
+
+    def get(self, uid: int, field: str) -> Optional[str]:
+        return self._vals.get(uid, {}).get(field)
+
+    def overlay(self, uid: int, row: dict) -> dict:
+        if not row:
+            return row
+        vals = self._vals.setdefault(uid, {})
+        for f in HOT_FIELDS:
+            if f not in vals:
+                vals[f] = str(row.get(f, "") or "")
+        return {**row, **vals}
+
+    def set(self, uid: int, field: str, value: str):
+        vals = self._vals.setdefault(uid, {})
+        if vals.get(field) == value:
+            return
+        vals[field] = value
+        self._dirty.setdefault(uid, {})[field] = value
+        self._dropped.discard(uid)
+        metric_inc("hot_writes_total")
+
+    def drop_user(self, uid: int):
+        self._vals.pop(uid, None)
+        self._dirty.pop(uid, None)
+        self._dropped.add(uid)
+
+    def take_dirty(self) -> Dict[int, Dict[str, str]]:
+        batch, self._dirty = self._dirty, {}
+        return batch
+
+    def restore(self, batch: Dict[int, Dict[str, str]]):
+        for uid, fields in batch.items():
+            if uid in self._dropped:
+                continue
+            mine = self._dirty.setdefault(uid, {})
+            for f, v in fields.items():
+                mine.setdefault(f, v)
+
+HOT = HotState()
+
+def hot_get(uid: int, field: str) -> str:
+    v = HOT.get(uid, field)
+    if v is None:
+        v = users_get(uid).get(field) or ""
+    return v
+
+def users_set_many(updates: Dict[int, Dict[str, str]]):
+    """Пакетная запись полей Users: 1 чтение колонки user_id + 1 batch_update."""
+    if not updates:
+        return
+    if not SHEETS_ENABLED:
+        for uid, fields in updates.items():
+            if uid in MEM_USERS:
+                MEM_USERS[uid].update(fields)
+        return
+    with SHEET_ROWS_LOCK:
+        rows = {v: i for i, v in enumerate(ws_users.col_values(1), start=1)}
+        data = []
+        for uid, fields in updates.items():
+            row = rows.get(str(uid))
+            if not row:
+                continue
+            for f, v in fields.items():
+                col = gsu.rowcol_to_a1(1, USERS_HEADERS.index(f) + 1).rstrip("1")
+                data.append({"range": f"{col}{row}", "values": [[v]]})
+        if data:
+            ws_users.batch_update(data)
+
+async def hot_checkpoint():
+    batch = HOT.take_dirty()
+    if not batch:
+        return
+    try:
+        await asyncio.to_thread(users_set_many, batch)
+        metric_observe("hot_checkpoint_users", len(batch))
+    except Exception as e:
+        logging.error(f"hot state checkpoint failed: {e}")
+        HOT.restore(batch)
+
+async def job_hot_checkpoint(context: ContextTypes.DEFAULT_TYPE):
+    await hot_checkpoint()
 
 # -------- Sheets wrappers --------
 def _headers(ws):
@@ -602,13 +1419,12 @@ def _headers(ws):
 
 def users_get(uid: int) -> dict:
     if SHEETS_ENABLED:
-        for r in ws_records(ws_users, USERS_HEADERS):
-            if str(r.get("user_id")) == str(uid):
-                return r
-        return {}
-    return MEM_USERS.get(uid, {})
+        r = REPLICA.get("users", uid)
+        return HOT.overlay(uid, r) if r else {}
+    return HOT.overlay(uid, MEM_USERS.get(uid, {}))
 
 def users_upsert(uid: int, username: str, lang: str):
+    USER_RECS.pop(uid, None)
     base = {
         "user_id": str(uid),
         "username": username or "",
@@ -631,65 +1447,74 @@ def users_upsert(uid: int, username: str, lang: str):
         "pending_q": "no",
     }
     if SHEETS_ENABLED:
-        vals = ws_records(ws_users, USERS_HEADERS)
-        for i, r in enumerate(vals, start=2):
-            if str(r.get("user_id")) == str(uid):
+        with SHEET_ROWS_LOCK:
+            i = _find_row(ws_users, uid)
+            if i:
+                # строка переписывается целиком — база только свежая, не из реплики
+                r = dict(zip(USERS_HEADERS, ws_users.row_values(i)))
                 merged = {h: r.get(h, "") for h in USERS_HEADERS}
+                merged = HOT.overlay(uid, merged)
                 merged["user_id"] = str(uid)
                 if username: merged["username"] = username
                 if lang:     merged["lang"] = lang
                 end_col = gsu.rowcol_to_a1(1, len(USERS_HEADERS)).rstrip("1")
                 ws_users.update(range_name=f"A{i}:{end_col}{i}",
                                 values=[[merged.get(h, "") for h in USERS_HEADERS]])
+                REPLICA.put("users", uid, merged)
                 return
-        ws_users.append_row([base.get(h,"") for h in USERS_HEADERS])
+            ws_users.append_row([base.get(h,"") for h in USERS_HEADERS])
+            REPLICA.put("users", uid, base)
     else:
-        prev = MEM_USERS.get(uid, {})
+        prev = HOT.overlay(uid, MEM_USERS.get(uid, {}))
         merged = {**base, **prev}
         if username: merged["username"] = username
         if lang:     merged["lang"] = lang
         MEM_USERS[uid] = merged
 
 def users_set(uid: int, field: str, value: str):
+    if field in HOT_FIELDS:
+        HOT.set(uid, field, value)
+        _user_rec_apply(uid, field, value)
+        return
     if SHEETS_ENABLED:
-        vals = ws_records(ws_users, USERS_HEADERS)
-        for i, r in enumerate(vals, start=2):
-            if str(r.get("user_id")) == str(uid):
-                hdr = USERS_HEADERS
-                if field in hdr:
-                    ws_users.update_cell(i, hdr.index(field)+1, value)
-                return
+        if field not in USERS_HEADERS:
+            return
+        with SHEET_ROWS_LOCK:
+            i = _find_row(ws_users, uid)
+            if i:
+                ws_users.update_cell(i, USERS_HEADERS.index(field)+1, value)
+                REPLICA.patch("users", uid, {field: value})
+                _user_rec_apply(uid, field, value)
+            return
     else:
         u = MEM_USERS.setdefault(uid, {})
         u[field] = value
+        _user_rec_apply(uid, field, value)
 
 def profiles_get(uid: int) -> dict:
     if SHEETS_ENABLED:
-        for r in ws_records(ws_profiles, PROFILES_HEADERS):
-            if str(r.get("user_id")) == str(uid):
-                return r
-        return {}
+        return REPLICA.get("profiles", uid) or {}
     return MEM_PROFILES.get(uid, {})
 
 def profiles_upsert(uid: int, data: dict):
     if SHEETS_ENABLED:
         hdr = PROFILES_HEADERS
-        current, idx = None, None
-        for i, r in enumerate(ws_records(ws_profiles, PROFILES_HEADERS), start=2):
-            if str(r.get("user_id")) == str(uid):
-                current, idx = r, i
-                break
-        if not current:
-            current = {"user_id": str(uid)}
-        for k,v in data.items():
-            current[k] = "" if v is None else (", ".join(v) if isinstance(v,list) else str(v))
-        current["updated_at"] = iso(utcnow())
-        values = [current.get(h,"") for h in hdr]
-        end_col = gsu.rowcol_to_a1(1, len(hdr)).rstrip("1")
-        if idx:
-            ws_profiles.update(range_name=f"A{idx}:{end_col}{idx}", values=[values])
-        else:
-            ws_profiles.append_row(values)
+        with SHEET_ROWS_LOCK:
+            idx = _find_row(ws_profiles, uid)
+            # строка переписывается целиком — база только свежая, не из реплики
+            current = dict(zip(hdr, ws_profiles.row_values(idx))) if idx else None
+            if not current:
+                current = {"user_id": str(uid)}
+            for k,v in data.items():
+                current[k] = "" if v is None else (", ".join(v) if isinstance(v,list) else str(v))
+            current["updated_at"] = iso(utcnow())
+            values = [current.get(h,"") for h in hdr]
+            end_col = gsu.rowcol_to_a1(1, len(hdr)).rstrip("1")
+            if idx:
+                ws_profiles.update(range_name=f"A{idx}:{end_col}{idx}", values=[values])
+            else:
+                ws_profiles.append_row(values)
+        REPLICA.put("profiles", uid, current)
     else:
         row = MEM_PROFILES.setdefault(uid, {"user_id": str(uid)})
         for k,v in data.items():
@@ -704,16 +1529,18 @@ def episode_create(uid: int, topic: str, severity: int, red: str) -> str:
            "target":"<=3/10","reminder_at":"","next_checkin_at":"","status":"open",
            "last_update":now,"notes":""}
     if SHEETS_ENABLED:
-        ws_episodes.append_row([rec.get(h,"") for h in EPISODES_HEADERS])
+        REPLICA.put("episodes", eid, rec, pending=True)
+        APPENDS["episodes"].add([rec.get(h,"") for h in EPISODES_HEADERS],
+                                lambda row: REPLICA.confirm("episodes", eid))
     else:
         MEM_EPISODES.append(rec)
     return eid
 
 def episode_find_open(uid: int) -> Optional[dict]:
     if SHEETS_ENABLED:
-        for r in ws_records(ws_episodes, EPISODES_HEADERS):
-            if r.get("user_id")==str(uid) and r.get("status")=="open":
-                return r
+        for r in REPLICA.rows("episodes"):
+            if str(r.get("user_id"))==str(uid) and r.get("status")=="open":
+                return dict(r)
         return None
     for r in MEM_EPISODES:
         if r["user_id"]==str(uid) and r["status"]=="open":
@@ -722,15 +1549,16 @@ def episode_find_open(uid: int) -> Optional[dict]:
 
 def episode_set(eid: str, field: str, value: str):
     if SHEETS_ENABLED:
-        vals = ws_episodes.get_all_values(); hdr = vals[0]
-        if field not in hdr:
+        if field not in EPISODES_HEADERS:
             return
-        col = hdr.index(field)+1
-        for i in range(2, len(vals)+1):
-            if ws_episodes.cell(i,1).value == eid:
-                ws_episodes.update_cell(i,col,value)
-                ws_episodes.update_cell(i,hdr.index("last_update")+1, iso(utcnow()))
-                return
+        APPENDS["episodes"].flush()   # эпизод мог ещё не дойти до листа
+        with SHEET_ROWS_LOCK:
+            i = _find_row(ws_episodes, eid)
+            if i:
+                now = iso(utcnow())
+                ws_episodes.update_cell(i, EPISODES_HEADERS.index(field)+1, value)
+                ws_episodes.update_cell(i, EPISODES_HEADERS.index("last_update")+1, now)
+                REPLICA.patch("episodes", eid, {field: value, "last_update": now})
     else:
         for r in MEM_EPISODES:
             if r["episode_id"]==eid:
@@ -738,39 +1566,117 @@ def episode_set(eid: str, field: str, value: str):
 
 def feedback_add(ts, uid, name, username, rating, comment):
     if SHEETS_ENABLED:
-        ws_feedback.append_row([ts,str(uid),name,username or "",rating,comment])
+        APPENDS["feedback"].add([ts,str(uid),name,username or "",rating,comment])
     else:
         MEM_FEEDBACK.append({"timestamp":ts,"user_id":str(uid),"name":name,"username":username or "","rating":rating,"comment":comment})
 
+# rid -> номер строки в Reminders (подсказка, чтобы обновлять статус без чтения листа).
+# Пишется и из on_row буфера дописывания (рабочий поток) — только под REMINDER_ROWS_LOCK.
+REMINDER_ROWS: Dict[str, int] = {}
+REMINDER_ROWS_LOCK = threading.Lock()
+_REMINDER_STATUS_COL = gsu.rowcol_to_a1(1, REMINDERS_HEADERS.index("status") + 1).rstrip("1")
+
+def _row_from_append(resp) -> Optional[int]:
+    """Номер (первой) строки из ответа append_row/append_rows: updates.updatedRange 'Sheet!A12:F12'."""
+    try:
+        rng = resp["updates"]["updatedRange"].split("!")[-1].split(":")[0]
+        return int(re.sub(r"[A-Z]+", "", rng))
+    except Exception:
+        return None
+
 def reminder_add(uid: int, text: str, when_utc: datetime):
     rid = f"{uid}-{uuid.uuid4().hex[:6]}"
     created = iso(utcnow())
     rec = {"id":rid,"user_id":str(uid),"text":text,"when_utc":iso(when_utc),"created_at":created,"status":"scheduled"}
     if SHEETS_ENABLED:
-        ws_reminders.append_row([rec["id"], rec["user_id"], rec["text"], rec["when_utc"], rec["created_at"], rec["status"]])
+        def _on_row(row):
+            if row:
+                with REMINDER_ROWS_LOCK:
+                    REMINDER_ROWS[rid] = row
+            REPLICA.confirm("reminders", rid)
+        REPLICA.put("reminders", rid, rec, pending=True)
+        APPENDS["reminders"].add([rec["id"], rec["user_id"], rec["text"], rec["when_utc"], rec["created_at"], rec["status"]], _on_row)
     else:
         MEM_REMINDERS.append(rec)
     return rid
 
 def reminders_all_records():
     if SHEETS_ENABLED:
-        return ws_records(ws_reminders, REMINDERS_HEADERS)
+        return REPLICA.rows("reminders")
     return MEM_REMINDERS.copy()
 
-def reminders_mark_sent(rid: str):
-    if SHEETS_ENABLED:
-        vals = ws_reminders.get_all_values()
-        for i in range(2, len(vals)+1):
-            if ws_reminders.cell(i,1).value == rid:
-                ws_reminders.update_cell(i,6,"sent"); return
-    else:
+def reminders_set_status_many(updates: Dict[str, str]):
+    """Пакетное обновление статусов: 1 ranged-чтение для проверки подсказок + 1 batch_update."""
+    if not updates:
+        return
+    if not SHEETS_ENABLED:
+        for r in MEM_REMINDERS:
+            if r["id"] in updates:
+                r["status"] = updates[r["id"]]
+        return
+    APPENDS["reminders"].flush()   # статус пишем только в уже дописанные строки
+    with SHEET_ROWS_LOCK:
+        rows = _reminder_rows(updates)
+        data = [{"range": f"{_REMINDER_STATUS_COL}{row}", "values": [[updates[rid]]]} for rid, row in rows.items()]
+        if data:
+            ws_reminders.batch_update(data)
+            for rid in rows:
+                REPLICA.patch("reminders", rid, {"status": updates[rid]})
+
+def _reminder_rows(rids) -> Dict[str, int]:
+    """rid -> номер строки: подсказки REMINDER_ROWS проверяются одним batch_get,
+    остальное — по колонке id. Вызывать под SHEET_ROWS_LOCK."""
+    rows: Dict[str, int] = {}
+    with REMINDER_ROWS_LOCK:
+        hinted = [(rid, REMINDER_ROWS[rid]) for rid in rids if rid in REMINDER_ROWS]
+    if hinted:
+        got = ws_reminders.batch_get([f"A{row}" for _, row in hinted])
+        for (rid, row), vr in zip(hinted, got):
+            if vr and vr[0] and vr[0][0] == rid:
+                rows[rid] = row
+    if any(rid not in rows for rid in rids):
+        for i, v in enumerate(ws_reminders.col_values(1), start=1):
+            if v in rids and v not in rows:
+                rows[v] = i
+        with REMINDER_ROWS_LOCK:
+            REMINDER_ROWS.update(rows)
+    return rows
+
+def reminders_claim(rids: List[str], token: str) -> set:
+    """Токен доставки: статус «scheduled» → token, затем статусы читаются обратно, и
+    своими считаются только строки, где стоит наш token. Чужой «sending:…», «sent» и
+    удалённые строки не берём. Два процесса, записавшие токен почти одновременно, могут
+    оба прочитать свой — окно узкое, но это не атомарный compare-and-set."""
+    if not rids:
+        return set()
+    if not SHEETS_ENABLED:
+        owned = set()
         for r in MEM_REMINDERS:
-            if r["id"]==rid:
-                r["status"]="sent"; return
+            if r["id"] in rids and r.get("status") in ("scheduled", token):
+                r["status"] = token
+                owned.add(r["id"])
+        return owned
+    APPENDS["reminders"].flush()
+    with SHEET_ROWS_LOCK:
+        rows = _reminder_rows(set(rids))
+        if not rows:
+            return set()
+        order = list(rows.items())
+        got = ws_reminders.batch_get([f"{_REMINDER_STATUS_COL}{row}" for _, row in order])
+        free = [(rid, row) for (rid, row), vr in zip(order, got)
+                if (vr[0][0] if vr and vr[0] else "") in ("scheduled", token)]
+        if not free:
+            return set()
+        ws_reminders.batch_update([{"range": f"{_REMINDER_STATUS_COL}{row}", "values": [[token]]} for _, row in free])
+        back = ws_reminders.batch_get([f"{_REMINDER_STATUS_COL}{row}" for _, row in free])
+        owned = {rid for (rid, _), vr in zip(free, back) if vr and vr[0] and vr[0][0] == token}
+        for rid in owned:
+            REPLICA.patch("reminders", rid, {"status": token})
+        return owned
 
 def daily_add(ts, uid, mood, comment):
     if SHEETS_ENABLED:
-        ws_daily.append_row([ts,str(uid),mood,comment or ""])
+        APPENDS["daily"].add([ts,str(uid),mood,comment or ""])
     else:
         MEM_DAILY.append({"timestamp":ts,"user_id":str(uid),"mood":mood,"comment":comment or ""})
 
@@ -779,9 +1685,10 @@ def habits_add(uid: int, typ: str, value: Optional[str], unit: Optional[str]) ->
     ts = iso(utcnow())
     rec = {"timestamp":ts,"user_id":str(uid),"type":typ,"value":value or "1","unit":unit or "", "streak":"0"}
     if SHEETS_ENABLED:
-        ws_habits.append_row([rec.get(h,"") for h in HABITS_HEADERS])
-        rows = ws_records(ws_habits, HABITS_HEADERS)
-        rows = [r for r in rows if r.get("user_id")==str(uid) and r.get("type")==typ]
+        resp = ws_habits.append_row([rec.get(h,"") for h in HABITS_HEADERS])
+        new_row = _row_from_append(resp)
+        TAIL_READERS["habits"].refresh()
+        rows = TAIL_READERS["habits"].where(user_id=str(uid), type=typ)
     else:
         MEM_HABITS.append(rec)
         rows = [r for r in MEM_HABITS if r.get("user_id")==str(uid) and r.get("type")==typ]
@@ -807,9 +1714,10 @@ def habits_add(uid: int, typ: str, value: Optional[str], unit: Optional[str]) ->
     # [PATCH] обновляем streak в только что добавленной строке (Sheets)
     if SHEETS_ENABLED:
         try:
-            last_row_idx = len(ws_habits.get_all_values())
+            last_row_idx = new_row or TAIL_READERS["habits"].n + 1
             col_idx = HABITS_HEADERS.index("streak") + 1
             ws_habits.update_cell(last_row_idx, col_idx, str(streak))
+            TAIL_READERS["habits"].set(last_row_idx, "streak", str(streak))
         except Exception as e:
             logging.warning(f"habits_add: streak update failed: {e}")
     return streak
@@ -825,12 +1733,47 @@ def _has_jq_ctx(context: ContextTypes.DEFAULT_TYPE) -> bool:
         return False
 
 # --------- Scheduling (restore) ---------
+# Политика догонялок после рестарта: просроченные дольше RESTORE_CATCHUP_MAX_AGE_SEC
+# отправляем все (send), только последнее на пользователя (coalesce) или никакие (drop).
+# Остальные просроченные размазываем по окну RESTORE_SPREAD_SEC, а не шлём все разом.
+RESTORE_CATCHUP_POLICY = os.getenv("RESTORE_CATCHUP_POLICY", "coalesce")
+RESTORE_CATCHUP_MAX_AGE_SEC = int(os.getenv("RESTORE_CATCHUP_MAX_AGE_SEC", str(6 * 3600)))
+RESTORE_SPREAD_SEC = int(os.getenv("RESTORE_SPREAD_SEC", "600"))
+RESTORE_MIN_DELAY_SEC = 60
+
+def _catchup_plan(items: List[dict], now: datetime) -> Tuple[List[Tuple[dict, datetime]], List[Tuple[dict, str]]]:
+    """items: [{"uid","due",...}] → ([(item, when_utc)], [(item, "coalesced"|"dropped")])."""
+    start = now + timedelta(seconds=RESTORE_MIN_DELAY_SEC)
+    future, overdue, skipped = [], [], []
+    stale_latest: Dict[int, dict] = {}
+    for it in sorted(items, key=lambda x: x["due"]):
+        if it["due"] > start:
+            future.append((it, it["due"]))
+            continue
+        age = (now - it["due"]).total_seconds()
+        if age <= RESTORE_CATCHUP_MAX_AGE_SEC or RESTORE_CATCHUP_POLICY == "send":
+            overdue.append(it)
+        elif RESTORE_CATCHUP_POLICY == "coalesce":
+            prev = stale_latest.get(it["uid"])
+            if prev is not None:
+                skipped.append((prev, "coalesced"))
+            stale_latest[it["uid"]] = it
+        else:
+            skipped.append((it, "dropped"))
+    overdue.extend(sorted(stale_latest.values(), key=lambda x: x["due"]))
+    step = RESTORE_SPREAD_SEC / max(1, len(overdue))
+    planned = [(it, start + timedelta(seconds=i * step)) for i, it in enumerate(overdue)]
+    metric_inc("restore_overdue_total", len(overdue))
+    metric_inc("restore_skipped_total", len(skipped))
+    return future + planned, skipped
+
 def schedule_from_sheet_on_start(app):
     if not _has_jq_app(app):
         logging.warning("JobQueue not available – skip scheduling on start.")
         return
     now = utcnow()
-    src = ws_records(ws_episodes, EPISODES_HEADERS) if SHEETS_ENABLED else MEM_EPISODES
+    src = REPLICA.rows("episodes") if SHEETS_ENABLED else MEM_EPISODES
+    ep_items = []
     for r in src:
         if r.get("status")!="open": continue
         eid = r.get("episode_id"); uid = int(r.get("user_id"))
@@ -840,18 +1783,44 @@ def schedule_from_sheet_on_start(app):
             dt_ = datetime.strptime(nca, "%Y-%m-%d %H:%M:%S%z")
         except:
             continue
-        delay = max(60, (dt_-now).total_seconds())
-        app.job_queue.run_once(job_checkin_episode, when=delay, data={"user_id":uid,"episode_id":eid})
-    for r in reminders_all_records():
-        if (r.get("status") or "")!="scheduled": continue
+        ep_items.append({"uid": uid, "due": dt_, "eid": eid})
+    planned, skipped = _catchup_plan(ep_items, now)
+    for it, when in planned:
+        app.job_queue.run_once(job_checkin_episode, when=when, data={"user_id":it["uid"],"episode_id":it["eid"]})
+    for it, _ in skipped:
+        episode_set(it["eid"], "next_checkin_at", "")
+
+    src_u = REPLICA.rows("users") if SHEETS_ENABLED else list(MEM_USERS.values())
+    langs = {str(u.get("user_id")): norm_lang(u.get("lang") or "en") for u in src_u}
+    rem_items, statuses = [], {}
+    for i, r in enumerate(reminders_all_records(), start=2):
+        st = (r.get("status") or "")
+        if st != "scheduled" and not st.startswith("sending:"): continue
         uid = int(r.get("user_id")); rid=r.get("id")
         try:
             dt_ = datetime.strptime(r.get("when_utc"), "%Y-%m-%d %H:%M:%S%z")
         except:
             continue
-        delay = max(60,(dt_-now).total_seconds())
-        app.job_queue.run_once(job_oneoff_reminder, when=delay, data={"user_id":uid,"reminder_id":rid})
-    src_u = ws_records(ws_users, USERS_HEADERS) if SHEETS_ENABLED else list(MEM_USERS.values())
+        if SHEETS_ENABLED:
+            with REMINDER_ROWS_LOCK:
+                REMINDER_ROWS[rid] = i
+        if st.startswith("sending:") and dt_ <= now:
+            # доставку начал прошлый процесс и не подтвердил — at-most-once: не шлём повторно
+            statuses[rid] = "unconfirmed"
+            continue
+        if st.startswith("sending:"):
+            statuses[rid] = "scheduled"   # токен взят до срока прошлым процессом — снова свободно
+        rem_items.append({"uid": uid, "due": dt_, "rid": rid, "text": r.get("text") or ""})
+    planned, skipped = _catchup_plan(rem_items, now)
+    for it, when in planned:
+        REMINDERS.push(it["rid"], it["uid"], it["text"], langs.get(str(it["uid"]), "en"), when)
+    statuses.update({it["rid"]: st for it, st in skipped})
+    if statuses:
+        try:
+            reminders_set_status_many(statuses)
+        except Exception as e:
+            logging.error(f"restore: reminder status update failed: {e}")
+    logging.info(f"Restore: {len(ep_items)} episode check-ins, {len(rem_items)} reminders, {len(statuses)} skipped.")
     for u in src_u:
         if (u.get("paused") or "").lower()=="yes": continue
         uid = int(u.get("user_id"))
@@ -890,107 +1859,549 @@ def hhmm_tuple(hhmm:str)->Tuple[int,int]:
 def local_to_utc_hour_min(tz_offset_hours:int, hhmm:str)->Tuple[int,int]:
     h,m = hhmm_tuple(hhmm); return ((h - tz_offset_hours) % 24, m)
 
+# ===== Слот-планировщик чек-инов =====
+# Вместо двух run_daily-джобов на пользователя: индекс «UTC-минута суток → {uid: lang}»
+# и один повторяющийся джоб раз в минуту, который обрабатывает весь слот батчем.
+# Перенос пользователя в другой слот — O(1).
+SLOT_CATCHUP_MAX_MIN = int(os.getenv("SLOT_CATCHUP_MAX_MIN", "10"))
+
+class SlotScheduler:
+    def __init__(self, name: str):
+        self.name = name
+        self.slots: Dict[int, Dict[int, str]] = {}   # minute_of_day -> {uid: lang}
+        self.user_slot: Dict[int, int] = {}          # uid -> minute_of_day
+
+    def set(self, uid: int, h_utc: int, m_utc: int, lang: str):
+        self.remove(uid)
+        minute = h_utc * 60 + m_utc
+        self.slots.setdefault(minute, {})[uid] = lang
+        self.user_slot[uid] = minute
+
+    def remove(self, uid: int):
+        minute = self.user_slot.pop(uid, None)
+        if minute is None:
+            return
+        bucket = self.slots.get(minute)
+        if bucket is not None:
+            bucket.pop(uid, None)
+            if not bucket:
+                del self.slots[minute]
+
+    def due(self, minute: int) -> List[Tuple[int, str]]:
+        return list(self.slots.get(minute, {}).items())
+
+    def upcoming(self, now: datetime, minutes: int) -> List[Tuple[int, str, datetime]]:
+        """(uid, lang, due_utc) для слотов в ближайшие `minutes` минут."""
+        base = now.replace(second=0, microsecond=0)
+        out = []
+        for i in range(1, minutes + 1):
+            due = base + timedelta(minutes=i)
+            for uid, lang in self.due(due.hour * 60 + due.minute):
+                out.append((uid, lang, due))
+        return out
+
+    def __len__(self) -> int:
+        return len(self.user_slot)
+
+MORNING_SLOTS = SlotScheduler("morning")
+EVENING_SLOTS = SlotScheduler("evening")
+_slot_last_minute: Optional[datetime] = None
+
+async def job_slot_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Раз в минуту: все due-пользователи текущего слота (плюс пропущенные минуты) батчем."""
+    global _slot_last_minute
+    now_min = utcnow().replace(second=0, microsecond=0)
+    start = now_min
+    if _slot_last_minute is not None:
+        start = max(_slot_last_minute + timedelta(minutes=1), now_min - timedelta(minutes=SLOT_CATCHUP_MAX_MIN))
+    _slot_last_minute = now_min
+    m = start
+    n = 0
+    while m <= now_min:
+        minute = m.hour * 60 + m.minute
+        for uid, lang in MORNING_SLOTS.due(minute):
+            context.application.create_task(send_daily_checkin(context, uid, lang))
+            n += 1
+        for uid, lang in EVENING_SLOTS.due(minute):
+            context.application.create_task(send_evening_checkin(context, uid, lang))
+            n += 1
+        m += timedelta(minutes=1)
+    metric_inc("slot_checkins_total", n)
+    metric_set("slot_users", len(MORNING_SLOTS), kind="morning")
+    metric_set("slot_users", len(EVENING_SLOTS), kind="evening")
+
+def start_slot_scheduler(app):
+    if not _has_jq_app(app):
+        logging.warning("JobQueue not available – slot scheduler not started.")
+        return
+    first = 60 - utcnow().second
+    app.job_queue.run_repeating(job_slot_tick, interval=60, first=first, name="slot_tick")
+
 def schedule_daily_checkin(app, uid:int, tz_off:int, hhmm_local:str, lang:str):
     if not _has_jq_app(app):
         logging.warning(f"JobQueue not available – skip daily scheduling for uid={uid}.")
         return
-    for j in app.job_queue.get_jobs_by_name(f"daily_{uid}"):
-        j.schedule_removal()
     h_utc, m_utc = local_to_utc_hour_min(tz_off, hhmm_local)
-    t = dtime(hour=h_utc, minute=m_utc, tzinfo=timezone.utc)
-    app.job_queue.run_daily(job_daily_checkin, time=t, name=f"daily_{uid}", data={"user_id":uid,"lang":lang})
+    MORNING_SLOTS.set(uid, h_utc, m_utc, lang)
 
-# === Вечер: отдельный джоб (Users.evening_hour) ===
+# === Вечер: отдельный слот (Users.evening_hour) ===
 def schedule_morning_evening(app, uid:int, tz_off:int, lang:str):
     if not _has_jq_app(app): return
-    for j in app.job_queue.get_jobs_by_name(f"daily_e_{uid}"):
-        j.schedule_removal()
     hhmm = users_get(uid).get("evening_hour") or DEFAULT_EVENING_LOCAL
     h_e, m_e = hhmm_tuple(hhmm); h_e = (h_e - tz_off) % 24
-    app.job_queue.run_daily(
-        job_evening_checkin,
-        dtime(hour=h_e, minute=m_e, tzinfo=timezone.utc),
-        name=f"daily_e_{uid}",
-        data={"user_id":uid,"lang":lang}
-    )
+    EVENING_SLOTS.set(uid, h_e, m_e, lang)
+
+def unschedule_checkins(uid: int):
+    MORNING_SLOTS.remove(uid)
+    EVENING_SLOTS.remove(uid)
+
+# ------------- Outbound-очередь (лимиты Telegram) -------------
+# Все авто-отправки идут через OUTBOX: глобальный token bucket (~30 msg/s), пауза между
+# сообщениями в один чат, приоритеты (ответы пользователю раньше рассылок) и повтор после
+# RetryAfter. Пока диспетчер не запущен (нет event loop / тесты) — отправляем напрямую.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "28"))
+TG_GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", "28"))
+TG_CHAT_INTERVAL_SEC = float(os.getenv("TG_CHAT_INTERVAL_SEC", "1.0"))
+TG_SEND_MAX_RETRIES = int(os.getenv("TG_SEND_MAX_RETRIES", "3"))
+OUTBOX_DRAIN_SEC = float(os.getenv("OUTBOX_DRAIN_SEC", "10"))
+PRIO_REPLY, PRIO_NORMAL, PRIO_BROADCAST = 0, 1, 2
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def delay(self) -> float:
+        """0 — токен есть (и списан); иначе сколько ждать до следующего."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+class OutboundDispatcher:
+    def __init__(self):
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._seq = itertools.count()
+        self._items: Dict[int, list] = {}        # chat_id -> heap[(prio, seq, item)]
+        self._ready: list = []                   # heap[(prio, seq, chat_id)]
+        self._waiting: list = []                 # heap[(ready_at, seq, chat_id)]
+        self._state: Dict[int, str] = {}         # chat_id -> ready|waiting
+        self._next_at: Dict[int, float] = {}     # chat_id -> не раньше (pacing/RetryAfter)
+        self._bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        self._wake: Optional[asyncio.Event] = None
+        self._inflight: set = set()
+        self.depth = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logging.info("Outbound dispatcher started.")
+
+    async def stop(self):
+        if not self.running:
+            return
+        deadline = time.monotonic() + OUTBOX_DRAIN_SEC
+        while (self.depth or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self._task.cancel()
+        if self.depth:
+            logging.warning(f"Outbound dispatcher stopped with {self.depth} unsent messages.")
+
+    async def send(self, bot, chat_id: int, text: str, *, priority: int = PRIO_NORMAL, **kwargs):
+        """Поставить в очередь и дождаться фактической отправки (результат/исключение send_message)."""
+        if not self.running:
+            return await bot.send_message(chat_id, text, **kwargs)
+        fut = asyncio.get_running_loop().create_future()
+        item = {"text": text, "kwargs": kwargs, "fut": fut, "enq": time.monotonic(), "tries": 0}
+        seq = next(self._seq)
+        heapq.heappush(self._items.setdefault(chat_id, []), (priority, seq, item))
+        self.depth += 1
+        metric_set("outbox_depth", self.depth)
+        if chat_id not in self._state:
+            self._schedule_chat(chat_id, time.monotonic())
+        elif self._state[chat_id] == "ready":
+            # приоритет «головы» мог вырасти — ленивый дубликат в ready-куче
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._wake.set()
+        return await fut
+
+    def _schedule_chat(self, chat_id: int, now: float):
+        at = self._next_at.get(chat_id, 0.0)
+        if at > now:
+            self._state[chat_id] = "waiting"
+            heapq.heappush(self._waiting, (at, next(self._seq), chat_id))
+        else:
+            self._state[chat_id] = "ready"
+            heapq.heappush(self._ready, (self._items[chat_id][0][0], next(self._seq), chat_id))
+
+    def _promote(self, now: float):
+        while self._waiting and self._waiting[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._waiting)
+            if self._state.get(chat_id) != "waiting":
+                continue
+            if self._items.get(chat_id):
+                self._schedule_chat(chat_id, now)
+            else:
+                self._state.pop(chat_id, None)
+                self._items.pop(chat_id, None)
+                if self._next_at.get(chat_id, 0.0) <= now:
+                    self._next_at.pop(chat_id, None)
+
+    def _clean_ready_top(self):
+        while self._ready:
+            _, _, chat_id = self._ready[0]
+            if self._state.get(chat_id) == "ready" and self._items.get(chat_id):
+                return
+            heapq.heappop(self._ready)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._promote(now)
+            self._clean_ready_top()
+            if not self._ready:
+                timeout = (self._waiting[0][0] - now) if self._waiting else None
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = self._bucket.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            _, _, item = heapq.heappop(self._items[chat_id])
+            self.depth -= 1
+            metric_set("outbox_depth", self.depth)
+            self._next_at[chat_id] = now + TG_CHAT_INTERVAL_SEC
+            self._state[chat_id] = "waiting"
+            heapq.heappush(self._waiting, (now + TG_CHAT_INTERVAL_SEC, next(self._seq), chat_id))
+            t = asyncio.get_running_loop().create_task(self._deliver(chat_id, item))
+            self._inflight.add(t)
+            t.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, chat_id: int, item: dict):
+        fut = item["fut"]
+        metric_observe("outbox_lag_seconds", time.monotonic() - item["enq"])
+        try:
+            msg = await self.bot.send_message(chat_id, item["text"], **item["kwargs"])
+        except RetryAfter as e:
+            metric_inc("outbox_retry_after_total")
+            item["tries"] += 1
+            if item["tries"] > TG_SEND_MAX_RETRIES:
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            # возвращаем в голову очереди чата и блокируем чат на retry_after
+            self._next_at[chat_id] = time.monotonic() + float(e.retry_after)
+            heapq.heappush(self._items.setdefault(chat_id, []), (-1, next(self._seq), item))
+            self.depth += 1
+            metric_set("outbox_depth", self.depth)
+            if chat_id not in self._state:
+                self._schedule_chat(chat_id, time.monotonic())
+            self._wake.set()
+            return
+        except Exception as e:
+            metric_inc("outbox_failed_total")
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        metric_inc("outbox_sent_total")
+        if not fut.done():
+            fut.set_result(msg)
+
+OUTBOX = OutboundDispatcher()
 
 # ------------- Лимитер авто-сообщений + тихие часы -------------
-def _in_quiet(uid: int, now_utc: datetime) -> bool:
-    u = users_get(uid)
-    q = (u.get("quiet_hours") or "").strip()
-    if not q: return False
-    m = re.match(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})', q)
-    if not m: return False
-    tz_off = int(str(u.get("tz_offset") or "0"))
-    local = now_utc + timedelta(hours=tz_off)
-    start = local.replace(hour=int(m.group(1)), minute=int(m.group(2)), second=0, microsecond=0)
-    end   = local.replace(hour=int(m.group(3)), minute=int(m.group(4)), second=0, microsecond=0)
-    if end <= start:
-        return local >= start or local <= end
-    return start <= local <= end
-
-# === ПРАВКА 1: корректный сброс sent_today при смене локального дня ===
-def can_send(uid: int) -> bool:
-    u = users_get(uid)
-    if (u.get("paused") or "").lower() == "yes":
-        return False
-    if _in_quiet(uid, utcnow()):
-        return False
+# UserRec — разобранная строка Users для лимитера: tz в секундах, тихие часы — диапазон
+# секунд суток, last_sent_utc — epoch, sent_today — int. Записи живут в USER_RECS, а
+# users_set/users_upsert обновляют их на месте, так что can_send/_in_quiet — чистая
+# арифметика без обращения к хранилищу. TTL подтягивает ручные правки таблицы.
+USER_REC_TTL_SEC = int(os.getenv("USER_REC_TTL_SEC", "300"))
+AUTO_MSGS_PER_DAY = 2
 
-    # корректный сброс лимита по новому локальному дню
-    tz_off = int(str(u.get("tz_offset") or "0"))
-    today_local = (utcnow() + timedelta(hours=tz_off)).date()
+_QUIET_RE = re.compile(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})')
 
-    last = (u.get("last_sent_utc") or "").strip()
-    last_local = None
-    if last:
-        try:
-            last_local = (datetime.strptime(last, "%Y-%m-%d %H:%M:%S%z")
-                          .astimezone(timezone.utc) + timedelta(hours=tz_off)).date()
-        except Exception:
-            last_local = None
+def _parse_quiet(q: str) -> Optional[Tuple[int, int]]:
+    m = _QUIET_RE.match((q or "").strip())
+    if not m:
+        return None
+    h1, m1, h2, m2 = (int(x) for x in m.groups())
+    if h1 > 23 or h2 > 23 or m1 > 59 or m2 > 59:
+        return None
+    return (h1 * 60 + m1) * 60, (h2 * 60 + m2) * 60
 
-    sent_today = int(str(u.get("sent_today") or "0"))
-    if (not last_local) or (last_local != today_local):
-        sent_today = 0
-        users_set(uid, "sent_today", "0")
+def _parse_utc_ts(s: str) -> Optional[float]:
+    s = (s or "").strip()
+    if not s:
+        return None
+    try:
+        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S%z").timestamp()
+    except Exception:
+        return None
 
-    return sent_today < 2
+def _parse_int(s, default: int = 0) -> int:
+    try:
+        return int(str(s or default))
+    except Exception:
+        return default
+
+class UserRec:
+    FIELDS = ("paused", "tz_offset", "quiet_hours", "last_sent_utc", "sent_today")
+    __slots__ = ("uid", "paused", "tz_sec", "quiet", "last_sent_ts", "sent_today", "loaded_at")
+
+    def __init__(self, uid: int, row: dict):
+        self.uid = uid
+        self.loaded_at = time.monotonic()
+        for field in self.FIELDS:
+            self.apply(field, row.get(field))
+
+    def apply(self, field: str, value):
+        if field == "paused":
+            self.paused = str(value or "").lower() == "yes"
+        elif field == "tz_offset":
+            self.tz_sec = _parse_int(value) * 3600
+        elif field == "quiet_hours":
+            self.quiet = _parse_quiet(value)
+        elif field == "last_sent_utc":
+            self.last_sent_ts = _parse_utc_ts(value)
+        elif field == "sent_today":
+            self.sent_today = _parse_int(value)
+
+    def local_day(self, ts: float) -> int:
+        return int((ts + self.tz_sec) // 86400)
+
+    def in_quiet(self, ts: float) -> bool:
+        if not self.quiet:
+            return False
+        start, end = self.quiet
+        sod = (ts + self.tz_sec) % 86400
+        if end <= start:
+            return sod >= start or sod <= end
+        return start <= sod <= end
+
+    def sent_on(self, ts: float) -> int:
+        """Сколько авто-сообщений уже ушло в локальный день ts (0, если последнее — вчера)."""
+        if self.last_sent_ts is None or self.local_day(self.last_sent_ts) != self.local_day(ts):
+            return 0
+        return self.sent_today
+
+USER_RECS: Dict[int, UserRec] = {}
+
+def user_rec(uid: int) -> UserRec:
+    rec = USER_RECS.get(uid)
+    if rec is None or time.monotonic() - rec.loaded_at > USER_REC_TTL_SEC:
+        rec = USER_RECS[uid] = UserRec(uid, users_get(uid))
+    return rec
+
+def _user_rec_apply(uid: int, field: str, value):
+    rec = USER_RECS.get(uid)
+    if rec is not None and field in UserRec.FIELDS:
+        rec.apply(field, value)
+
+def _in_quiet(uid: int, now_utc: datetime) -> bool:
+    return user_rec(uid).in_quiet(now_utc.timestamp())
+
+def send_block_reason(uid: int, now: Optional[float] = None) -> Optional[str]:
+    """None — авто-сообщение можно отправить; иначе "paused" / "quiet" / "cap"."""
+    rec = user_rec(uid)
+    if rec.paused:
+        return "paused"
+    now = time.time() if now is None else now
+    if rec.in_quiet(now):
+        return "quiet"
+    # счётчик прошлого локального дня просто не учитывается — сбросит его mark_sent
+    if rec.sent_on(now) >= AUTO_MSGS_PER_DAY:
+        return "cap"
+    return None
+
+def can_send(uid: int) -> bool:
+    return send_block_reason(uid) is None
 
 def mark_sent(uid: int):
-    u = users_get(uid)
-    tz_off = int(str(u.get("tz_offset") or "0"))
-    last = u.get("last_sent_utc") or ""
-    today_local = (utcnow() + timedelta(hours=tz_off)).date()
-    last_local  = None
-    if last:
+    rec = user_rec(uid)
+    now = utcnow()
+    sent = rec.sent_on(now.timestamp()) + 1
+    users_set(uid, "sent_today", str(sent))
+    users_set(uid, "last_sent_utc", iso(now))
+
+# ===== Отложенная доставка =====
+# Сообщение, упёршееся в тихие часы или дневной лимит, не теряется: оно ложится в личный
+# ящик пользователя (с истечением DEFER_TTL_SEC) и уходит пачкой, когда окно открывается —
+# конец тихих часов или новый локальный день. Время открытия считает UserRec, к нему
+# добавляется случайный сдвиг до DEFER_JITTER_SEC, чтобы все ящики не открывались в 08:00:00.
+# Повторная постановка с тем же ключом (по умолчанию — текст) заменяет старую.
+DEFER_TTL_SEC = float(os.getenv("DEFER_TTL_SEC", str(12 * 3600)))
+DEFER_JITTER_SEC = float(os.getenv("DEFER_JITTER_SEC", "600"))
+DEFER_MAX_PER_USER = int(os.getenv("DEFER_MAX_PER_USER", "3"))
+DEFER_RETRY_SEC = float(os.getenv("DEFER_RETRY_SEC", "60"))
+
+def _next_open_ts(rec: UserRec, now: float) -> float:
+    ts = now
+    for _ in range(3):
+        if rec.in_quiet(ts):
+            sod = (ts + rec.tz_sec) % 86400
+            ts += (rec.quiet[1] - sod) % 86400 + 1
+        elif rec.sent_on(ts) >= AUTO_MSGS_PER_DAY:
+            ts = (rec.local_day(ts) + 1) * 86400 - rec.tz_sec
+        else:
+            break
+    return ts
+
+class DeferredOutbox:
+    def __init__(self):
+        self.bot = None
+        self._boxes: Dict[int, List[list]] = {}     # uid -> [[key, text, kb, priority, count, expires_ts]]
+        self._heap: list = []                      # (due_ts, seq, uid)
+        self._due: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._inflight: set = set()
+
+    def __len__(self) -> int:
+        return sum(len(b) for b in self._boxes.values())
+
+    def push(self, uid: int, text: str, kb=None, *, priority: int = PRIO_NORMAL, count: bool = True,
+             key: Optional[str] = None, ttl: Optional[float] = None):
+        now = time.time()
+        key = key or text
+        box = [e for e in self._boxes.get(uid, []) if e[0] != key]
+        box.append([key, text, kb, priority, count, now + (DEFER_TTL_SEC if ttl is None else ttl)])
+        self._boxes[uid] = box[-DEFER_MAX_PER_USER:]
+        metric_inc("deferred_total")
+        self._schedule(uid, now)
+
+    def drop_user(self, uid: int):
+        self._boxes.pop(uid, None)
+        self._due.pop(uid, None)
+        metric_set("deferred_pending", len(self))
+
+    def _schedule(self, uid: int, now: float, due: Optional[float] = None):
+        if due is None:
+            due = _next_open_ts(user_rec(uid), now) + random.uniform(0, DEFER_JITTER_SEC)
+        if due > max(e[5] for e in self._boxes[uid]):
+            due = min(e[5] for e in self._boxes[uid])   # откроется позже, чем всё истечёт — только чистка
+        self._due[uid] = due
+        heapq.heappush(self._heap, (due, next(self._seq), uid))
+        metric_set("deferred_pending", len(self))
+        if self._wake is not None:
+            self._wake.set()
+
+    def _requeue(self, uid: int, box: List[list], due: Optional[float] = None):
+        """Вернуть недоставленное в ящик; пока шла доставка, туда могли положить новое."""
+        newer = self._boxes.get(uid, [])
+        keys = {e[0] for e in newer}
+        self._boxes[uid] = ([e for e in box if e[0] not in keys] + newer)[-DEFER_MAX_PER_USER:]
+        self._schedule(uid, time.time(), due)
+
+    def start(self, bot):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._inflight:
+            await asyncio.wait(list(self._inflight), timeout=OUTBOX_DRAIN_SEC)
+        if self._boxes:
+            logging.info(f"deferred outbox: {len(self)} undelivered messages dropped on shutdown")
+
+    async def _flush_user(self, uid: int):
+        now = time.time()
+        self._due.pop(uid, None)
+        stored = self._boxes.pop(uid, [])
+        box = [e for e in stored if e[5] > now]
+        if len(box) < len(stored):
+            metric_inc("deferred_expired_total", len(stored) - len(box))
+        if not box:
+            return
         try:
-            last_local = (datetime.strptime(last, "%Y-%m-%d %H:%M:%S%z").astimezone(timezone.utc) + timedelta(hours=tz_off)).date()
-        except:
-            last_local = None
-    sent = 0 if (not last_local or last_local != today_local) else int(str(u.get("sent_today") or "0"))
-    users_set(uid, "sent_today", str(sent + 1))
-    users_set(uid, "last_sent_utc", iso(utcnow()))
+            reason = send_block_reason(uid, now)
+            if reason == "paused":
+                return
+            if reason is not None:
+                self._requeue(uid, box)
+                return
+            budget = AUTO_MSGS_PER_DAY - user_rec(uid).sent_on(now)
+            while box and budget > 0:
+                _, text, kb, priority, count, _ = box.pop(0)
+                try:
+                    await OUTBOX.send(self.bot, uid, text, reply_markup=kb, priority=priority)
+                    metric_inc("deferred_sent_total")
+                except Exception as e:
+                    logging.error(f"deferred send fail: {e}")
+                    continue
+                if count:
+                    mark_sent(uid)
+                    budget -= 1
+        except Exception as e:
+            # Sheets/реплика недоступны — не теряем ящик, пробуем позже
+            logging.error(f"deferred flush failed (uid={uid}): {e}")
+            metric_inc("deferred_flush_errors_total")
+            self._requeue(uid, box, time.time() + DEFER_RETRY_SEC)
+            return
+        if box:
+            self._requeue(uid, box)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, uid = heapq.heappop(self._heap)
+                if self._due.get(uid) != due:
+                    continue   # перепланирован или ящик уже убран
+                # ящики разных пользователей доставляются параллельно — темп задаёт OUTBOX
+                t = asyncio.get_running_loop().create_task(self._flush_user(uid))
+                self._inflight.add(t)
+                t.add_done_callback(self._inflight.discard)
+            metric_set("deferred_pending", len(self))
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+DEFERRED = DeferredOutbox()
 
 # === ПРАВКА 2: maybe_send исходная версия ===
-async def _maybe_send_raw(context, uid, text, kb=None, *, force=False, count=True):
-    if force or can_send(uid):
+async def _maybe_send_raw(context, uid, text, kb=None, *, force=False, count=True, priority=PRIO_REPLY,
+                          defer: bool = True):
+    reason = None if force else send_block_reason(uid)
+    if reason is None:
         try:
-            await context.bot.send_message(uid, text, reply_markup=kb)
+            await OUTBOX.send(context.bot, uid, text, reply_markup=kb, priority=priority)
             if count:
                 mark_sent(uid)
         except Exception as e:
             logging.error(f"send fail: {e}")
+    elif defer and reason != "paused":
+        DEFERRED.push(uid, text, kb, priority=priority, count=count)
 
 # --- [PATCH] maybe_send-обёртка: подстановка {name} + anti-spam «один вопрос»
-async def maybe_send(context, uid, text, kb=None, *, force=False, count=True):
-    txt = (text or "").replace("{name}", display_name(uid) or "")
+async def maybe_send(context, uid, text, kb=None, *, force=False, count=True, priority=PRIO_REPLY):
+    txt = text or ""
+    if "{name}" in txt:
+        txt = txt.replace("{name}", display_name(uid) or "")
     if not force and is_question(txt):
-        u = users_get(uid)
-        if (u.get("pending_q") or "").lower() == "yes":
+        if hot_get(uid, "pending_q").lower() == "yes":
             return
         users_set(uid, "pending_q", "yes")
-    await _maybe_send_raw(context, uid, txt, kb, force=force, count=count)
+    await _maybe_send_raw(context, uid, txt, kb, force=force, count=count, priority=priority)
 
 # ------------- Jobs -------------
 async def job_checkin_episode(context: ContextTypes.DEFAULT_TYPE):
@@ -1002,23 +2413,150 @@ async def job_checkin_episode(context: ContextTypes.DEFAULT_TYPE):
     lang = norm_lang(u.get("lang") or "en")
     kb = inline_numbers_0_10()
     try:
-        await context.bot.send_message(uid, T[lang]["checkin_ping"], reply_markup=kb)
+        # at-most-once: снимаем next_checkin_at ДО отправки, чтобы рестарт не повторил пинг
         episode_set(eid, "next_checkin_at", "")
+        await OUTBOX.send(context.bot, uid, T[lang]["checkin_ping"], reply_markup=kb, priority=PRIO_BROADCAST)
     except Exception as e:
         logging.error(f"job_checkin_episode send error: {e}")
 
-async def job_oneoff_reminder(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data or {}
-    uid, rid = d.get("user_id"), d.get("reminder_id")
-    text = T[norm_lang(users_get(uid).get("lang") or "en")]["thanks"]
-    for r in reminders_all_records():
-        if r.get("id")==rid:
-            text = r.get("text") or text; break
-    try:
-        await context.bot.send_message(uid, text.replace("{name}", display_name(uid) or ""))
-    except Exception as e:
-        logging.error(f"reminder send error: {e}")
-    reminders_mark_sent(rid)
+# ===== Reminder engine =====
+# Мин-куча по when_utc и один таймер (asyncio-задача), который спит до ближайшего
+# напоминания. Текст и язык лежат прямо в записи кучи → срабатывание без чтений листа.
+# Статусы «sent» копятся и пишутся пачкой (reminders_set_status_many).
+# Токен доставки: за REMINDER_CLAIM_AHEAD_SEC до срока reminders_claim пачкой ставит
+# «sending:<BOOT_ID>» и читает статусы обратно; шлются только напоминания с нашим токеном.
+# Если процесс упал, рестарт не шлёт просроченные «sending:…» повторно.
+REMINDER_FLUSH_SEC = float(os.getenv("REMINDER_FLUSH_SEC", "5"))
+REMINDER_FLUSH_MAX = int(os.getenv("REMINDER_FLUSH_MAX", "100"))
+REMINDER_CLAIM_AHEAD_SEC = float(os.getenv("REMINDER_CLAIM_AHEAD_SEC", "30"))
+BOOT_ID = uuid.uuid4().hex[:8]
+
+class ReminderEngine:
+    def __init__(self):
+        self.bot = None
+        self._heap: list = []                    # (when_ts, seq, rid, uid, text, lang)
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._status: Dict[str, str] = {}        # rid -> статус к записи
+        self._last_flush = time.monotonic()
+        self._dropped_users: set = set()
+        self._inflight: set = set()
+        self._claimed: set = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, rid: str, uid: int, text: str, lang: str, when_utc: datetime):
+        heapq.heappush(self._heap, (when_utc.timestamp(), next(self._seq), rid, uid, text, lang))
+        self._dropped_users.discard(uid)
+        metric_set("reminders_pending", len(self._heap))
+        if self._wake is not None:
+            self._wake.set()
+
+    def drop_user(self, uid: int):
+        self._heap = [e for e in self._heap if e[3] != uid]
+        heapq.heapify(self._heap)
+        self._dropped_users.add(uid)
+        metric_set("reminders_pending", len(self._heap))
+
+    def start(self, bot):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._inflight:
+            await asyncio.wait(list(self._inflight), timeout=OUTBOX_DRAIN_SEC)
+        await self._flush(force=True)
+
+    def _mark(self, rid: str, status: str):
+        self._status[rid] = status
+
+    async def _flush(self, force: bool = False):
+        if not self._status:
+            return
+        if not force and len(self._status) < REMINDER_FLUSH_MAX and time.monotonic() - self._last_flush < REMINDER_FLUSH_SEC:
+            return
+        batch, self._status = self._status, {}
+        self._last_flush = time.monotonic()
+        try:
+            await asyncio.to_thread(reminders_set_status_many, batch)
+            metric_observe("reminders_flush_size", len(batch))
+        except Exception as e:
+            logging.error(f"reminders status flush failed: {e}")
+            for rid, st in batch.items():
+                self._status.setdefault(rid, st)
+
+    async def _claim(self, rids: List[str]):
+        try:
+            owned = await asyncio.to_thread(reminders_claim, rids, f"sending:{BOOT_ID}")
+            metric_observe("reminders_claim_size", len(rids))
+        except Exception as e:
+            # не блокируем доставку из-за сбоя Sheets: эти напоминания идут без токена
+            logging.error(f"reminders claim failed: {e}")
+            owned = set(rids)
+        lost = set(rids) - owned
+        if lost:
+            # токен у другого процесса, уже отправлено или строку удалили — не шлём
+            metric_inc("reminders_claim_lost_total", len(lost))
+            self._heap = [e for e in self._heap if e[2] not in lost]
+            heapq.heapify(self._heap)
+        self._claimed.update(owned)
+
+    async def _claim_upcoming(self):
+        if not self._heap or self._heap[0][0] > time.time() + REMINDER_CLAIM_AHEAD_SEC:
+            return
+        horizon = time.time() + REMINDER_CLAIM_AHEAD_SEC
+        rids = [e[2] for e in heapq.nsmallest(REMINDER_FLUSH_MAX, self._heap)
+                if e[0] <= horizon and e[2] not in self._claimed]
+        if rids:
+            await self._claim(rids)
+
+    async def _fire(self, rid: str, uid: int, text: str, lang: str):
+        if "{name}" in text:
+            text = text.replace("{name}", display_name(uid) or "")
+        try:
+            await OUTBOX.send(self.bot, uid, text or tr(lang, "thanks", name=""), priority=PRIO_NORMAL)
+            metric_inc("reminders_sent_total")
+        except Exception as e:
+            logging.error(f"reminder send error: {e}")
+        if uid not in self._dropped_users:
+            self._mark(rid, "sent")
+
+    async def _run(self):
+        while True:
+            await self._claim_upcoming()
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+            unclaimed = [e[2] for e in due if e[2] not in self._claimed]
+            if unclaimed:
+                await self._claim(unclaimed)
+            for _, _, rid, uid, text, lang in due:
+                if rid not in self._claimed:
+                    continue
+                self._claimed.discard(rid)
+                t = asyncio.get_running_loop().create_task(self._fire(rid, uid, text, lang))
+                self._inflight.add(t)
+                t.add_done_callback(self._inflight.discard)
+            metric_set("reminders_pending", len(self._heap))
+            await self._flush()
+            timeout = REMINDER_FLUSH_SEC
+            if self._heap:
+                top = self._heap[0]
+                wake_at = top[0] if top[2] in self._claimed else top[0] - REMINDER_CLAIM_AHEAD_SEC
+                timeout = min(timeout, max(0.0, wake_at - time.time()))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+REMINDERS = ReminderEngine()
 
 # ===== LLM Router =====
 SYS_ROUTER = (
@@ -1031,27 +2569,153 @@ SYS_ROUTER = (
     "\"assistant_reply\": \"string\", \"followups\": [\"string\"], \"needs_more\": true, "
     "\"red_flags\": false, \"confidence\": 0.0}"
 )
-
-def llm_router_answer(text: str, lang: str, profile: dict) -> dict:
+SYS_ROUTER_RULES = (
+    "\nRelevantRules (vetted; prefer them over general knowledge, cite as [n] when used):\n"
+)
+ROUTER_MAX_TOKENS = int(os.getenv("ROUTER_MAX_TOKENS", "420"))
+ROUTER_MAX_TOKENS_GROUNDED = int(os.getenv("ROUTER_MAX_TOKENS_GROUNDED", "300"))
+RULES_TOP_K = int(os.getenv("RULES_TOP_K", "3"))
+
+# ===== Circuit breaker для LLM =====
+# Окно последних вызовов: ошибка или ответ дольше LLM_BREAKER_SLOW_SEC считается «плохим».
+# При доле плохих >= порога брейкер открывается, и роутер сразу идёт на следующий уровень
+# (fallback-модель → локальный ответ). Восстановление проверяет фоновый job_llm_probe.
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+LLM_BREAKER_ERR_RATE = float(os.getenv("LLM_BREAKER_ERR_RATE", "0.5"))
+LLM_BREAKER_SLOW_SEC = float(os.getenv("LLM_BREAKER_SLOW_SEC", "8"))
+LLM_BREAKER_COOLDOWN_SEC = float(os.getenv("LLM_BREAKER_COOLDOWN_SEC", "30"))
+LLM_PROBE_EVERY_SEC = int(os.getenv("LLM_PROBE_EVERY_SEC", "15"))
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_CODE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.window: deque = deque(maxlen=LLM_BREAKER_WINDOW)
+        metric_set("llm_breaker_state", 0, model=name)
+
+    def allow(self) -> bool:
+        """Пользовательский трафик идёт только через закрытый брейкер; half-open — только проба."""
+        return self.state == self.CLOSED
+
+    def probe_due(self) -> bool:
+        return self.state == self.OPEN and (time.monotonic() - self.opened_at) >= LLM_BREAKER_COOLDOWN_SEC
+
+    def record(self, ok: bool, latency: float):
+        metric_observe("llm_latency_seconds", latency, model=self.name)
+        if not ok:
+            metric_inc("llm_errors_total", model=self.name)
+        bad = (not ok) or latency >= LLM_BREAKER_SLOW_SEC
+        if self.state == self.HALF_OPEN:
+            self._transition(self.OPEN if bad else self.CLOSED)
+            return
+        self.window.append(bad)
+        if self.state == self.CLOSED and len(self.window) >= LLM_BREAKER_MIN_CALLS:
+            if sum(self.window) / len(self.window) >= LLM_BREAKER_ERR_RATE:
+                self._transition(self.OPEN)
+
+    def _transition(self, to: str):
+        if to == self.state:
+            if to == self.OPEN:
+                self.opened_at = time.monotonic()
+            return
+        logging.warning(f"LLM breaker [{self.name}]: {self.state} -> {to}")
+        self.state = to
+        if to == self.OPEN:
+            self.opened_at = time.monotonic()
+        if to == self.CLOSED:
+            self.window.clear()
+        metric_set("llm_breaker_state", self._STATE_CODE[to], model=self.name)
+        metric_inc("llm_breaker_transitions_total", model=self.name, to=to)
+
+LLM_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+def _router_tiers() -> List[Tuple[str, float, CircuitBreaker]]:
+    """Уровни роутера по порядку: основная модель, затем запасная (если задана)."""
+    tiers = [(OPENAI_MODEL, LLM_TIMEOUT_SEC)]
+    if OPENAI_FALLBACK_MODEL and OPENAI_FALLBACK_MODEL != OPENAI_MODEL:
+        tiers.append((OPENAI_FALLBACK_MODEL, LLM_FALLBACK_TIMEOUT_SEC))
+    out = []
+    for m, t in tiers:
+        if m not in LLM_BREAKERS:
+            LLM_BREAKERS[m] = CircuitBreaker(m)
+        out.append((m, t, LLM_BREAKERS[m]))
+    return out
+
+def _router_canned(lang: str) -> dict:
+    return {"intent":"other","assistant_reply":T[lang]["unknown"],"followups":[],"needs_more":True,"red_flags":False,"confidence":0.3}
+
+async def llm_router_answer(text: str, lang: str, profile: dict) -> dict:
     if not oai:
-        return {"intent":"other","assistant_reply":T[lang]["unknown"],"followups":[],"needs_more":True,"red_flags":False,"confidence":0.3}
+        return _router_canned(lang)
     sys = SYS_ROUTER.replace("{lang}", lang) + f"\nUserProfile: {json.dumps(profile, ensure_ascii=False)}"
-    try:
-        resp = oai.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.25,
-            max_tokens=420,
-            response_format={"type":"json_object"},
-            messages=[{"role":"system","content":sys},{"role":"user","content":text}]
+    grounding = rules_retrieve(text, lang, profile, k=RULES_TOP_K)
+    max_tokens = ROUTER_MAX_TOKENS
+    if grounding:
+        sys += SYS_ROUTER_RULES + "\n".join(
+            f"[{i}] {r['text']}" + (f" (src: {r['citations']})" if r.get("citations") else "")
+            for i, r in enumerate(grounding, start=1)
         )
-        out = resp.choices[0].message.content.strip()
-        data = json.loads(out)
-        if "followups" not in data or data["followups"] is None:
-            data["followups"] = []
+        max_tokens = ROUTER_MAX_TOKENS_GROUNDED
+    for tier, (model, timeout, breaker) in enumerate(_router_tiers()):
+        if not breaker.allow():
+            continue
+        t0 = time.monotonic()
+        try:
+            # синхронный клиент — в поток, чтобы цикл обслуживал других пользователей
+            resp = await asyncio.to_thread(
+                oai.with_options(timeout=timeout, max_retries=0).chat.completions.create,
+                model=model,
+                temperature=0.25,
+                max_tokens=max_tokens,
+                response_format={"type":"json_object"},
+                messages=[{"role":"system","content":sys},{"role":"user","content":text}]
+            )
+        except Exception as e:
+            breaker.record(False, time.monotonic() - t0)
+            logging.error(f"router LLM error ({model}): {e}")
+            continue
+        try:
+            out = resp.choices[0].message.content.strip()
+            data = json.loads(out)
+            if "followups" not in data or data["followups"] is None:
+                data["followups"] = []
+        except Exception as e:
+            # невалидный JSON — такой же отказ уровня, как ошибка вызова
+            breaker.record(False, time.monotonic() - t0)
+            metric_inc("llm_router_parse_errors_total", tier=str(tier))
+            logging.error(f"router LLM parse error ({model}): {e}")
+            continue
+        breaker.record(True, time.monotonic() - t0)
+        metric_inc("llm_router_answers_total", tier=str(tier))
         return data
-    except Exception as e:
-        logging.error(f"router LLM error: {e}")
-        return {"intent":"other","assistant_reply":T[lang]["unknown"],"followups":[],"needs_more":True,"red_flags":False,"confidence":0.3}
+    metric_inc("llm_router_answers_total", tier="canned")
+    return _router_canned(lang)
+
+def _llm_probe_call(model: str):
+    oai.with_options(timeout=LLM_FALLBACK_TIMEOUT_SEC, max_retries=0).chat.completions.create(
+        model=model, max_tokens=1, messages=[{"role":"user","content":"ping"}]
+    )
+
+async def job_llm_probe(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая проба открытых брейкеров: один короткий запрос → closed или снова open."""
+    if not oai:
+        return
+    for model, _, breaker in _router_tiers():
+        if not breaker.probe_due():
+            continue
+        breaker._transition(CircuitBreaker.HALF_OPEN)
+        t0 = time.monotonic()
+        try:
+            await asyncio.to_thread(_llm_probe_call, model)
+            breaker.record(True, time.monotonic() - t0)
+        except Exception as e:
+            logging.info(f"LLM probe failed ({model}): {e}")
+            breaker.record(False, time.monotonic() - t0)
 
 # ===== Rules-based подсказки =====
 def rules_match(seg: str, prof: dict) -> bool:
@@ -1081,12 +2745,12 @@ def rules_match(seg: str, prof: dict) -> bool:
 
 def _read_rules():
     if SHEETS_ENABLED:
-        return ws_records(ws_rules, RULES_HEADERS)
+        return REPLICA.rows("rules")
     return MEM_RULES
 
-def pick_nutrition_tips(lang: str, prof: dict, limit: int = 2) -> List[str]:
+def pick_nutrition_tips(lang: str, prof: dict, limit: int = 2, rules: Optional[List[dict]] = None) -> List[str]:
     tips = []
-    for r in _read_rules():
+    for r in (_read_rules() if rules is None else rules):
         if (r.get("domain") or "").lower() != "nutrition":
             continue
         if (r.get("lang") or "en") != lang:
@@ -1098,9 +2762,121 @@ def pick_nutrition_tips(lang: str, prof: dict, limit: int = 2) -> List[str]:
     random.shuffle(tips)
     return tips[:limit]
 
+# ===== Локальный retrieval-индекс по Rules =====
+# Хэшированные признаки (слова + символьные 4-граммы) → TF-IDF → L2-нормированная матрица
+# NumPy (отдельно на каждый язык, храним транспонированной: признак × правило).
+# Запрос — несколько десятков признаков, скоринг = сумма строк матрицы → доли миллисекунды.
+RULES_INDEX_DIM = 1 << 12
+RULES_INDEX_REFRESH_SEC = int(os.getenv("RULES_INDEX_REFRESH_SEC", "300"))
+RULES_MIN_SCORE = float(os.getenv("RULES_MIN_SCORE", "0.12"))
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def _rule_features(text: str) -> Dict[int, float]:
+    feats: Dict[int, float] = {}
+    mask = RULES_INDEX_DIM - 1
+    for w in _WORD_RE.findall((text or "").lower()):
+        if len(w) < 2:
+            continue
+        k = hash(w) & mask
+        feats[k] = feats.get(k, 0.0) + 1.0
+        if len(w) > 4:
+            pw = f" {w} "
+            for i in range(len(pw) - 3):
+                k = hash(pw[i:i+4]) & mask
+                feats[k] = feats.get(k, 0.0) + 0.5
+    return feats
+
+class RulesIndex:
+    def __init__(self):
+        self.fingerprint: Optional[int] = None
+        self.by_lang: Dict[str, Tuple[Any, Any, List[dict]]] = {}   # lang -> (M_T, idf, rules)
+
+    def build(self, rules: List[dict]) -> bool:
+        """Пересобирает индекс, если набор правил изменился. True — если пересобран."""
+        rows = [r for r in rules if (r.get("text") or "").strip()]
+        fp = hash(tuple((str(r.get("rule_id")), r.get("lang") or "en", r.get("text"), r.get("citations") or "",
+                         r.get("segment") or "") for r in rows))
+        if fp == self.fingerprint:
+            return False
+        groups: Dict[str, List[dict]] = {}
+        for r in rows:
+            groups.setdefault(norm_lang(r.get("lang") or "en"), []).append(r)
+        by_lang = {}
+        for lang, grp in groups.items():
+            feats = [_rule_features(r["text"]) for r in grp]
+            df = np.zeros(RULES_INDEX_DIM, dtype=np.float32)
+            for f in feats:
+                df[list(f.keys())] += 1.0
+            idf = np.log((1.0 + len(grp)) / (1.0 + df)).astype(np.float32) + 1.0
+            m = np.zeros((RULES_INDEX_DIM, len(grp)), dtype=np.float32)
+            for j, f in enumerate(feats):
+                idx = np.fromiter(f.keys(), dtype=np.int64)
+                m[idx, j] = np.fromiter(f.values(), dtype=np.float32) * idf[idx]
+            norms = np.linalg.norm(m, axis=0)
+            norms[norms == 0] = 1.0
+            m /= norms
+            by_lang[lang] = (m, idf, [{"rule_id": r.get("rule_id"), "text": r["text"].strip(),
+                                       "citations": (r.get("citations") or "").strip(),
+                                       "segment": r.get("segment") or ""} for r in grp])
+        self.by_lang = by_lang          # атомарная подмена
+        self.fingerprint = fp
+        return True
+
+    def query(self, text: str, lang: str, k: int = 3) -> List[Tuple[float, dict]]:
+        entry = self.by_lang.get(lang)
+        if not entry:
+            return []
+        m, idf, rules = entry
+        f = _rule_features(text)
+        if not f:
+            return []
+        idx = np.fromiter(f.keys(), dtype=np.int64)
+        q = np.fromiter(f.values(), dtype=np.float32) * idf[idx]
+        q /= (np.linalg.norm(q) or 1.0)
+        scores = q @ m[idx]
+        n = min(len(rules), k)
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), rules[i]) for i in top if scores[i] >= RULES_MIN_SCORE]
+
+RULES_INDEX = RulesIndex()
+
+def rules_index_refresh() -> bool:
+    if not HAVE_NUMPY:
+        return False
+    t0 = time.monotonic()
+    changed = RULES_INDEX.build(_read_rules())
+    if changed:
+        metric_observe("rules_index_build_seconds", time.monotonic() - t0)
+        metric_set("rules_index_size", sum(len(v[2]) for v in RULES_INDEX.by_lang.values()))
+        logging.info("Rules index rebuilt.")
+    return changed
+
+async def job_rules_index_refresh(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(rules_index_refresh)
+    except Exception as e:
+        logging.warning(f"rules index refresh failed: {e}")
+
+def rules_retrieve(text: str, lang: str, prof: Optional[dict] = None, k: int = 3) -> List[dict]:
+    """Top-k правил под запрос (с учётом сегмента профиля). Пусто, если индекса нет."""
+    if not HAVE_NUMPY:
+        return []
+    if RULES_INDEX.fingerprint is None:
+        try:
+            rules_index_refresh()
+        except Exception as e:
+            logging.warning(f"rules index build failed: {e}")
+            return []
+    t0 = time.perf_counter()
+    hits = RULES_INDEX.query(text, lang, k=k * 3)
+    out = [r for _, r in hits if rules_match(r["segment"], prof or {})][:k]
+    metric_observe("rules_retrieve_seconds", time.perf_counter() - t0)
+    return out
+
 # ===== Мини-логика цикла =====
-def cycle_phase_for(uid: int) -> Optional[str]:
-    prof = profiles_get(uid)
+def cycle_phase_for(uid: int, prof: Optional[dict] = None) -> Optional[str]:
+    prof = profiles_get(uid) if prof is None else prof
     if str(prof.get("cycle_enabled") or "").lower() not in {"1","yes","true"}:
         return None
     try:
@@ -1114,68 +2890,170 @@ def cycle_phase_for(uid: int) -> Optional[str]:
     if 14 <= day <= 15: return "ovulation"
     return "luteal"
 
-def cycle_tip(lang: str, phase: str) -> str:
-    base = {
-        "menses": {
-            "ru":"Фаза менструации: мягче к себе, железо/белок, сон приоритет.",
-            "en":"Menses phase: go gentle, prioritize iron/protein and sleep."
-        },
-        "follicular": {
-            "ru":"Фолликулярная фаза: лучше заходят тренировки/новые задачи.",
-            "en":"Follicular phase: great for workouts and new tasks."
-        },
-        "ovulation": {
-            "ru":"Овуляция: следи за сном и гидратацией.",
-            "en":"Ovulation: watch sleep and hydration."
-        },
-        "luteal": {
-            "ru":"Лютеиновая: магний/прогулка, стабильный сон, меньше кофеина.",
-            "en":"Luteal: magnesium/walk, steady sleep, go easy on caffeine."
-        }
+CYCLE_TIPS = {
+    "menses": {
+        "ru":"Фаза менструации: мягче к себе, железо/белок, сон приоритет.",
+        "en":"Menses phase: go gentle, prioritize iron/protein and sleep."
+    },
+    "follicular": {
+        "ru":"Фолликулярная фаза: лучше заходят тренировки/новые задачи.",
+        "en":"Follicular phase: great for workouts and new tasks."
+    },
+    "ovulation": {
+        "ru":"Овуляция: следи за сном и гидратацией.",
+        "en":"Ovulation: watch sleep and hydration."
+    },
+    "luteal": {
+        "ru":"Лютеиновая: магний/прогулка, стабильный сон, меньше кофеина.",
+        "en":"Luteal: magnesium/walk, steady sleep, go easy on caffeine."
     }
-    return base.get(phase, {}).get(lang, "")
+}
 
-async def job_daily_checkin(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data or {}
-    uid, lang = d.get("user_id"), d.get("lang","en")
-    u = users_get(uid)
-    if (u.get("paused") or "").lower()=="yes":
-        return
-    kb = InlineKeyboardMarkup([
+def cycle_tip(lang: str, phase: str) -> str:
+    return CYCLE_TIPS.get(phase, {}).get(lang, "")
+
+# ===== Реестр клавиатур =====
+# Клавиатуры зависят только от языка (и ключа шага/кода), поэтому строим каждую один раз,
+# храним готовый dict/JSON и раздаём общий экземпляр. Объекты PTB и так неизменяемы;
+# FrozenMarkup дополнительно отдаёт закешированный to_dict() — его нельзя мутировать.
+class FrozenMarkup(InlineKeyboardMarkup):
+    __slots__ = ("_dict_cache", "_json_cache")
+
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        with self._unfrozen():
+            self._dict_cache = super().to_dict()
+            self._json_cache = json.dumps(self._dict_cache, ensure_ascii=False)
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        return self._dict_cache
+
+    def to_json(self, *args, **kwargs) -> str:
+        return self._json_cache
+
+KEYBOARDS: Dict[tuple, Optional[FrozenMarkup]] = {}
+
+def frozen_keyboard(fn):
+    """Кеширует результат fn(*args) как FrozenMarkup; списки в аргументах → кортежи."""
+    name = fn.__name__
+    def wrapper(*args):
+        key = (name,) + tuple(tuple(a) if isinstance(a, list) else a for a in args)
+        try:
+            return KEYBOARDS[key]
+        except KeyError:
+            kb = fn(*args)
+            kb = KEYBOARDS[key] = FrozenMarkup(kb.inline_keyboard) if kb is not None else None
+            return kb
+    wrapper.__name__ = name
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+@frozen_keyboard
+def inline_mood_kb(lang: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
         [InlineKeyboardButton(T[lang]["mood_good"], callback_data="mood|good"),
-         InlineKeyboardButton(T[lang]["mood_ok"], callback_data="mood|ok"),
-         InlineKeyboardButton(T[lang]["mood_bad"], callback_data="mood|bad")],
+         InlineKeyboardButton(T[lang]["mood_ok"],   callback_data="mood|ok"),
+         InlineKeyboardButton(T[lang]["mood_bad"],  callback_data="mood|bad")],
         [InlineKeyboardButton(T[lang]["mood_note"], callback_data="mood|note")]
     ])
-    # форс-чек-ин (вне лимитера, не увеличивает счётчик)
-    await _maybe_send_raw(context, uid, T[lang]["daily_gm"].replace("{name}", display_name(uid) or ""), kb, force=True, count=False)
 
-    prof = profiles_get(uid)
-    tips = pick_nutrition_tips(lang, prof, limit=2)
+# ===== Предгенерация утреннего чек-ина (off-peak) =====
+# job_pregen_morning заранее (за PREGEN_LOOKAHEAD_MIN до слота) собирает утренний пакет:
+# текст+клавиатура+советы (rules/цикл). В пиковую минуту send_daily_checkin только
+# достаёт готовый пакет из MORNING_STAGE и отправляет.
+PREGEN_EVERY_SEC = int(os.getenv("PREGEN_EVERY_SEC", "900"))
+PREGEN_LOOKAHEAD_MIN = int(os.getenv("PREGEN_LOOKAHEAD_MIN", "90"))
+PREGEN_TOLERANCE_MIN = 30
+
+# uid -> (due_utc, lang, text, kb, extras)
+MORNING_STAGE: Dict[int, Tuple[datetime, str, str, InlineKeyboardMarkup, Tuple[str, ...]]] = {}
+
+def build_morning_payload(uid: int, lang: str, u: dict, prof: dict,
+                          rules: Optional[List[dict]] = None) -> Tuple[str, InlineKeyboardMarkup, Tuple[str, ...]]:
+    text = tr(lang, "daily_gm", name=_display_name_from(u))
+    extras = []
+    tips = pick_nutrition_tips(lang, prof, limit=2, rules=rules)
     if tips:
-        await maybe_send(context, uid, "• " + "\n• ".join(tips))
-
-    phase = cycle_phase_for(uid)
+        extras.append("• " + "\n• ".join(tips))
+    phase = cycle_phase_for(uid, prof)
     if phase:
         tip = cycle_tip(lang, phase)
         if tip:
-            await maybe_send(context, uid, tip)
+            extras.append(tip)
+    return text, inline_mood_kb(lang), tuple(extras)
 
-# Новый вечерний джоб — другой текст
-async def job_evening_checkin(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data or {}
-    uid, lang = d.get("user_id"), d.get("lang","en")
+def _pregen_build_batch(due_users: List[Tuple[int, str, datetime]]) -> int:
+    """Синхронная часть: одно чтение Users/Profiles/Rules на весь батч."""
+    src_u = REPLICA.rows("users") if SHEETS_ENABLED else list(MEM_USERS.values())
+    users = {str(u.get("user_id")): u for u in src_u}
+    if SHEETS_ENABLED:
+        profs = {str(r.get("user_id")): r for r in REPLICA.rows("profiles")}
+    else:
+        profs = {str(k): v for k, v in MEM_PROFILES.items()}
+    rules = _read_rules()
+    built = 0
+    for uid, lang, due in due_users:
+        u = users.get(str(uid)) or {}
+        if (u.get("paused") or "").lower() == "yes":
+            continue
+        try:
+            text, kb, extras = build_morning_payload(uid, lang, u, profs.get(str(uid), {}), rules)
+        except Exception as e:
+            logging.warning(f"pregen failed uid={uid}: {e}")
+            continue
+        MORNING_STAGE[uid] = (due, lang, text, kb, extras)
+        built += 1
+    return built
+
+async def job_pregen_morning(context: ContextTypes.DEFAULT_TYPE):
+    t0 = time.monotonic()
+    due_users = [(uid, lang, due) for uid, lang, due in MORNING_SLOTS.upcoming(utcnow(), PREGEN_LOOKAHEAD_MIN)
+                 if not (MORNING_STAGE.get(uid) and MORNING_STAGE[uid][0] == due)]
+    if not due_users:
+        return
+    try:
+        n = await asyncio.to_thread(_pregen_build_batch, due_users)
+    except Exception as e:
+        logging.error(f"pregen batch error: {e}")
+        return
+    metric_inc("pregen_built_total", n)
+    metric_set("pregen_stage_size", len(MORNING_STAGE))
+    metric_observe("pregen_batch_seconds", time.monotonic() - t0)
+
+def _take_staged_morning(uid: int, lang: str, now: datetime):
+    staged = MORNING_STAGE.pop(uid, None)
+    if not staged:
+        return None
+    due, s_lang, text, kb, extras = staged
+    if s_lang != lang or abs((now - due).total_seconds()) > PREGEN_TOLERANCE_MIN * 60:
+        return None
+    return text, kb, extras
+
+async def send_daily_checkin(context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str):
+    # пауза могла включиться после сборки пакета — проверяем в обоих путях
+    if user_rec(uid).paused:
+        return
+    staged = _take_staged_morning(uid, lang, utcnow())
+    if staged:
+        metric_inc("pregen_hits_total")
+        text, kb, extras = staged
+    else:
+        # пакета нет (новый юзер/смена настроек) — собираем на лету, как раньше
+        metric_inc("pregen_misses_total")
+        text, kb, extras = build_morning_payload(uid, lang, users_get(uid), profiles_get(uid))
+    # форс-чек-ин (вне лимитера, не увеличивает счётчик)
+    await _maybe_send_raw(context, uid, text, kb, force=True, count=False, priority=PRIO_BROADCAST)
+    for extra in extras:
+        await maybe_send(context, uid, extra, priority=PRIO_BROADCAST)
+
+# Вечерний чек-ин — другой текст
+async def send_evening_checkin(context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str):
     u = users_get(uid)
     if (u.get("paused") or "").lower()=="yes":
         return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(T[lang]["mood_good"], callback_data="mood|good"),
-         InlineKeyboardButton(T[lang]["mood_ok"],   callback_data="mood|ok"),
-         InlineKeyboardButton(T[lang]["mood_bad"],  callback_data="mood|bad")],
-        [InlineKeyboardButton(T[lang]["mood_note"], callback_data="mood|note")]
-    ])
+    kb = inline_mood_kb(lang)
     # форс-чек-ин (вне лимитера, не увеличивает счётчик)
-    await _maybe_send_raw(context, uid, T[lang]["daily_pm"].replace("{name}", display_name(uid) or ""), kb, force=True, count=False)
+    await _maybe_send_raw(context, uid, tr(lang, "daily_pm", uid), kb, force=True, count=False, priority=PRIO_BROADCAST)
 
 # ===== Serious keywords =====
 SERIOUS_KWS = {
@@ -1185,10 +3063,108 @@ SERIOUS_KWS = {
     "tb":["tuberculosis","tb","туберкул","туберкульоз"],
 }
 
+# ===== Ключевые слова эвристик: один проход по тексту =====
+CHIP_KWS = {
+    "hb":["heartburn","burning after meals","изжог","жжёт","жжет","печія","кислота"],
+    "neck":["neck pain","neck","шея","затылок","ший"],
+}
+FACT_KWS = {
+    "sleep":["сплю","сон","sleep"],
+    "stress":["стресс","stress","тревог","anxie"],
+    "heartburn":["изжог","heartburn","кислота"],
+    "water":["water"],
+    "water_ml":["мл"],  # только триггер — объём проверяет регэксп в reflect_facts
+}
+H60_PROTEIN_KWS = ["белок","protein","больше белка","↑белок"]
+# вопросительные слова — только целым словом (\b…\b), остальное — подстрокой
+QUESTION_WORDS = ["как","когда","что","почему","зачем","ли","можно","нужно",
+                  "how","when","what","which","why","where","can","could","should",
+                  "як","коли","що","чому","навіщо"]
+
+
+class KeywordEngine:
+    """Все словари эвристик в одной регулярке: (?=(kw1|kw2|...)), свёрнутой в префиксное
+    дерево; finditer проходит текст один раз и находит совпадения в каждой позиции.
+    Из совпавших в одной позиции регулярка отдаёт только самое длинное, поэтому каждому
+    слову заранее приписаны категории всех его префиксов-подстрок («онколог» ⊃ «онко»).
+    Слова из `words` засчитываются только при границах слова с обеих сторон."""
+
+    def __init__(self, substrings: Dict[str, List[str]], words: Dict[str, List[str]]):
+        cats: Dict[str, set] = {}
+        for cat, kws in substrings.items():
+            for kw in kws:
+                cats.setdefault(kw, set()).add(cat)
+        closed = {kw: set(c) for kw, c in cats.items()}
+        for kw in closed:
+            for other, c in cats.items():
+                if other != kw and kw.startswith(other):
+                    closed[kw] |= c
+        self._sub = {kw: frozenset(c) for kw, c in closed.items()}
+        self._word: Dict[str, frozenset] = {}
+        for cat, kws in words.items():
+            for kw in kws:
+                self._word[kw] = self._word.get(kw, frozenset()) | {cat}
+        self._rx = re.compile("(?=(" + _trie_pattern(set(self._sub) | set(self._word)) + "))")
+
+    def scan(self, low: str) -> frozenset:
+        found = set()
+        for m in self._rx.finditer(low):
+            kw = m.group(1)
+            c = self._sub.get(kw)
+            if c:
+                found |= c
+            if kw in self._word:
+                i, j = m.start(), m.start() + len(kw)
+                if (i == 0 or not _is_word_char(low[i - 1])) and (j == len(low) or not _is_word_char(low[j])):
+                    found |= self._word[kw]
+        return frozenset(found)
+
+
+def _trie_pattern(words) -> str:
+    """Альтернатива, свёрнутая в префиксное дерево: в каждой позиции regex проверяет один
+    символ, а не все слова подряд. Пустая ветка стоит последней — выигрывает самое длинное."""
+    trie: Dict[str, dict] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: dict) -> str:
+        alts = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if "" in node:
+            alts.append("")
+        if len(alts) == 1:
+            return alts[0]
+        return "(?:" + "|".join(alts) + ")"
+
+    return emit(trie)
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+KEYWORDS = KeywordEngine(
+    {**{f"serious:{k}": v for k, v in SERIOUS_KWS.items()},
+     **{f"chip:{k}": v for k, v in CHIP_KWS.items()},
+     **{f"fact:{k}": v for k, v in FACT_KWS.items()},
+     "h60:protein": H60_PROTEIN_KWS},
+    {"question": QUESTION_WORDS},
+)
+
+
+@lru_cache(maxsize=512)
+def keyword_categories(low: str) -> frozenset:
+    """Категории ключевых слов для уже приведённого к lower текста. Один и тот же текст
+    за ход проверяют несколько эвристик (serious, факты, чипы), поэтому результат кешируется."""
+    return KEYWORDS.scan(low)
+
+
 def detect_serious(text: str) -> Optional[str]:
-    low = (text or "").lower()
-    for cond, kws in SERIOUS_KWS.items():
-        if any(k in low for k in kws):
+    cats = keyword_categories((text or "").lower())
+    for cond in SERIOUS_KWS:
+        if f"serious:{cond}" in cats:
             return cond
     return None
 
@@ -1228,21 +3204,22 @@ def profile_banner(lang: str, profile: dict) -> str:
     return f"{sex or '—'}, {age_raw or '—'}{hw}; goal — {goal or '—'}"
 
 def should_show_profile_banner(uid: int) -> bool:
-    u = users_get(uid)
-    return (u.get("profile_banner_shown") or "no") != "yes"
+    return (hot_get(uid, "profile_banner_shown") or "no") != "yes"
 
 def apply_warm_tone(text: str, lang: str) -> str:
     return re.sub(r"\n{3,}", "\n\n", (text or "").strip())
 
-def ask_feedback_soft(uid: int, context: ContextTypes.DEFAULT_TYPE, lang: str):
+def ask_feedback_soft(uid: int, context: ContextTypes.DEFAULT_TYPE, lang: str, composer: "ReplyComposer" = None):
     try:
-        u = users_get(uid)
-        last = (u.get("last_fb_asked") or "").strip()
-        today = (utcnow() + timedelta(hours=int(str(u.get("tz_offset") or "0")))).date().isoformat()
+        last = hot_get(uid, "last_fb_asked").strip()
+        today = datetime.fromtimestamp(time.time() + user_rec(uid).tz_sec, timezone.utc).date().isoformat()
         if last == today:
             return
         kb = inline_feedback_kb(lang)
-        context.application.create_task(context.bot.send_message(uid, T[lang]["ask_fb"], reply_markup=kb))
+        if composer is not None:
+            composer.tail(T[lang]["ask_fb"], kb, priority=PRIO_NORMAL)
+        else:
+            context.application.create_task(OUTBOX.send(context.bot, uid, T[lang]["ask_fb"], reply_markup=kb, priority=PRIO_NORMAL))
         users_set(uid, "last_fb_asked", today)
     except Exception as e:
         logging.warning(f"ask_feedback_soft error: {e}")
@@ -1250,9 +3227,10 @@ def ask_feedback_soft(uid: int, context: ContextTypes.DEFAULT_TYPE, lang: str):
 # === [PATCH] Лёгкая персонализация «зеркало фактов»
 def reflect_facts(text: str) -> str:
     low = (text or "").lower()
+    cats = keyword_categories(low)
     facts = []
     # сон
-    if any(k in low for k in ["сплю","сон","sleep"]):
+    if "fact:sleep" in cats:
         m = re.search(r'(\d{1,2})\s*[-–/]\s*(\d{1,2})\s*(?:ч|h)', low) or re.search(r'(\d{1,2})\s*(?:ч|h)', low)
         if m:
             if m.lastindex == 2:
@@ -1260,13 +3238,13 @@ def reflect_facts(text: str) -> str:
             else:
                 facts.append(f"вижу: спишь ~{m.group(1)} ч.")
     # стресс
-    if any(k in low for k in ["стресс","stress","тревог","anxie"]):
+    if "fact:stress" in cats:
         facts.append("отмечаю высокий стресс.")
     # изжога
-    if any(k in low for k in ["изжог","heartburn","кислота"]):
+    if "fact:heartburn" in cats:
         facts.append("есть жалоба на изжогу.")
     # вода
-    if re.search(r'(\d{3,4})\s*мл', low) or "water" in low:
+    if "fact:water" in cats or ("fact:water_ml" in cats and re.search(r'(\d{3,4})\s*мл', low)):
         facts.append("контроль воды — уже в фокусе.")
     if not facts:
         return ""
@@ -1306,6 +3284,7 @@ def pain_plan(lang: str, red_flags_selected: List[str], profile: dict) -> List[s
     return core + extra + [T[lang]["er_text"]]
 
 # ===== Клавиатуры =====
+@frozen_keyboard
 def inline_numbers_0_10() -> InlineKeyboardMarkup:
     rows = []
     row1 = [InlineKeyboardButton(str(n), callback_data=f"num|{n}") for n in range(0, 6)]
@@ -1321,6 +3300,7 @@ def inline_list(options: List[str], prefix: str) -> InlineKeyboardMarkup:
     if row: rows.append(row)
     return InlineKeyboardMarkup(rows)
 
+@frozen_keyboard
 def inline_topic_kb(lang: str) -> InlineKeyboardMarkup:
     label = {"ru":"🧩 Опрос 6 пунктов","uk":"🧩 Опитник (6)","en":"🧩 Intake (6 Qs)","es":"🧩 Intake (6)"}[lang]
     return InlineKeyboardMarkup([
@@ -1334,12 +3314,14 @@ def inline_topic_kb(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(label, callback_data="intake:start")]
     ])
 
+@frozen_keyboard
 def inline_accept(lang: str) -> InlineKeyboardMarkup:
     labels = T[lang]["accept_opts"]
     return InlineKeyboardMarkup([[InlineKeyboardButton(labels[0], callback_data="acc|yes"),
                                   InlineKeyboardButton(labels[1], callback_data="acc|later"),
                                   InlineKeyboardButton(labels[2], callback_data="acc|no")]])
 
+@frozen_keyboard
 def inline_remind(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⏰ +4h" if lang=="en" else T[lang]["act_rem_4h"], callback_data="rem|4h"),
@@ -1347,6 +3329,7 @@ def inline_remind(lang: str) -> InlineKeyboardMarkup:
          InlineKeyboardButton("⏰ Tomorrow morning" if lang=="en" else T[lang]["act_rem_morn"], callback_data="rem|morning")]
     ])
 
+@frozen_keyboard
 def inline_feedback_kb(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(T[lang]["fb_good"], callback_data="fb|up"),
@@ -1354,6 +3337,7 @@ def inline_feedback_kb(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["fb_free"], callback_data="fb|text")]
     ])
 
+@frozen_keyboard
 def inline_actions(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⏰ +4h" if lang=="en" else T[lang]["act_rem_4h"],  callback_data="act|rem|4h"),
@@ -1365,6 +3349,7 @@ def inline_actions(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["act_er"], callback_data="act|er")]
     ])
 
+@frozen_keyboard
 def inline_main_menu(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(T[lang]["m_h60"], callback_data="menu|h60")],
@@ -1379,6 +3364,7 @@ def inline_main_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["m_soon"], callback_data="menu|coming")]
     ])
 
+@frozen_keyboard
 def inline_symptoms_menu(lang: str) -> InlineKeyboardMarkup:
     labels = {"en":["Headache","Heartburn","Fatigue","Other"],
               "ru":["Головная боль","Изжога","Усталость","Другое"],
@@ -1392,6 +3378,7 @@ def inline_symptoms_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["back"], callback_data="menu|root")]
     ])
 
+@frozen_keyboard
 def inline_miniplans_menu(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Neck pain 5-min" if lang=="en" else "Шея 5 мин", callback_data="mini|neck")],
@@ -1401,6 +3388,7 @@ def inline_miniplans_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["back"], callback_data="menu|root")]
     ])
 
+@frozen_keyboard
 def inline_findcare_menu(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Labs near me" if lang=="en" else "Лабы рядом", callback_data="care|labsnear")],
@@ -1409,6 +3397,7 @@ def inline_findcare_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["back"], callback_data="menu|root")]
     ])
 
+@frozen_keyboard
 def inline_habits_menu(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💧 Water",   callback_data="hab|water"),
@@ -1419,6 +3408,7 @@ def inline_habits_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["back"], callback_data="menu|root")]
     ])
 
+@frozen_keyboard
 def inline_lang_menu(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("EN", callback_data="lang|en"),
@@ -1428,6 +3418,7 @@ def inline_lang_menu(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(T[lang]["back"], callback_data="menu|root")]
     ])
 
+@frozen_keyboard
 def inline_smart_checkin(lang: str) -> InlineKeyboardMarkup:
     lab = {"en":["I’m OK","Pain","Tired","Stressed","Heartburn","Other"],
            "ru":["Я ок","Боль","Устал","Стресс","Изжога","Другое"],
@@ -1444,78 +3435,101 @@ def inline_smart_checkin(lang: str) -> InlineKeyboardMarkup:
     ])
 
 # ===== Контекстные чипы, микропланы и справки =====
+def chip_kind(text: str) -> Optional[str]:
+    cats = keyword_categories((text or "").lower())
+    if "chip:hb" in cats:
+        return "hb"
+    if "chip:neck" in cats:
+        return "neck"
+    return None
+
 def chips_for_text(text: str, lang: str) -> Optional[InlineKeyboardMarkup]:
-    low = (text or "").lower()
-    hb_kw = any(k in low for k in ["heartburn","burning after meals","изжог","жжёт","жжет","печія","кислота"])
-    neck_kw = any(k in low for k in ["neck pain","neck","шея","затылок","ший"])
-    if hb_kw:
+    kind = chip_kind(text)
+    return _chips_kb(lang, kind) if kind else None
+
+@frozen_keyboard
+def _chips_kb(lang: str, kind: str) -> InlineKeyboardMarkup:
+    if kind == "hb":
         return InlineKeyboardMarkup([
             [InlineKeyboardButton("Avoid triggers" if lang=="en" else "Избегать триггеры", callback_data="chip|hb|triggers")],
             [InlineKeyboardButton("OTC options", callback_data="chip|hb|otc")],
             [InlineKeyboardButton("When to see a doctor" if lang=="en" else "Когда к врачу", callback_data="chip|hb|red")]
         ])
-    if neck_kw:
+    else:
         return InlineKeyboardMarkup([
             [InlineKeyboardButton("5-min routine", callback_data="chip|neck|routine")],
             [InlineKeyboardButton("Heat/Ice tips" if lang=="en" else "Тепло/лёд", callback_data="chip|neck|heat")],
             [InlineKeyboardButton("Red flags", callback_data="chip|neck|red")]
         ])
-    return None
+
+PAIN_KB_CODES = ("painloc", "painkind", "paindur", "num", "painrf")
+
+def warm_keyboards():
+    """Строим все клавиатуры заранее, чтобы в хэндлерах не было ни одной сборки."""
+    t0 = time.perf_counter()
+    inline_numbers_0_10()
+    for lang in SUPPORTED:
+        for fn in (inline_mood_kb, inline_topic_kb, inline_accept, inline_remind, inline_feedback_kb,
+                   inline_actions, inline_main_menu, inline_symptoms_menu, inline_miniplans_menu,
+                   inline_findcare_menu, inline_habits_menu, inline_lang_menu, inline_smart_checkin):
+            fn(lang)
+        for kind in ("hb", "neck"):
+            _chips_kb(lang, kind)
+        for code in PAIN_KB_CODES:
+            _kb_for_code(lang, code)
+        for step in PROFILE_STEPS:
+            build_profile_kb(lang, step["key"], step["opts"][lang])
+    logging.info(f"Keyboards warmed: {len(KEYBOARDS)} in {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+MICROPLANS = {
+    "neck": {"ru":"Шея 5 мин:\n1) Медленные наклоны вперёд/назад ×5\n2) Повороты в стороны ×5\n3) Полукруги подбородком ×5\n4) Растяжка трапеций 2×20с.",
+        "uk":"Шия 5 хв:\n1) Нахили вперед/назад ×5\n2) Повороти в сторони ×5\n3) Півкола підборіддям ×5\n4) Розтяжка трапецій 2×20с.",
+        "en":"Neck 5-min:\n1) Slow flex/extend ×5\n2) Rotations L/R ×5\n3) Chin semicircles ×5\n4) Upper-trap stretch 2×20s.",
+        "es":"Cuello 5 min:\n1) Flex/ext lenta ×5\n2) Giros izq/der ×5\n3) Semicírculos con barbilla ×5\n4) Estiramiento trapecio sup. 2×20s."},
+    "sleepreset": {"ru":"Сон-ресет (3 ночи):\nН1: экран-детокс 60м + отбой фикс.\nН2: 15м вне кровати при пробуждениях.\nН3: свет утром 10–15м, кофе до 14:00.",
+        "uk":"Сон-ресет (3 ночі):\nН1: детокс екранів 60 хв + фіксований відбій.\nН2: 15 хв поза ліжком при пробудженнях.\nН3: світло вранці 10–15 хв, кава до 14:00.",
+        "en":"Sleep reset (3 nights):\nN1: 60-min screen detox + fixed bedtime.\nN2: 15-min out of bed if awake.\nN3: AM light 10–15m; caffeine by 2pm.",
+        "es":"Reinicio del sueño (3 noches):\nN1: 60 min sin pantallas + hora fija.\nN2: 15 min fuera de la cama si despiertas.\nN3: Luz AM 10–15m; café hasta 14:00."},
+    "heartburn": {"ru":"Изжога — 3 шага:\n1) Порции меньше, не ложиться 3ч после еды.\n2) Триггеры: жирное, алкоголь, мята, шоколад, кофе — убрать.\n3) OTC: антацид по инструкции 2–3 дня.",
+        "uk":"Печія — 3 кроки:\n1) Менші порції, не лягати 3 год після їжі.\n2) Тригери: жирне, алкоголь, м’ята, шоколад, кава — прибрати.\n3) OTC: антацид за інстр. 2–3 дні.",
+        "en":"Heartburn — 3 steps:\n1) Smaller meals; avoid lying 3h after.\n2) Remove triggers: fatty foods, alcohol, mint, chocolate, coffee.\n3) OTC antacid 2–3 days as directed.",
+        "es":"Acidez — 3 pasos:\n1) Comidas pequeñas; no recostarse 3h.\n2) Evitar: grasas, alcohol, menta, chocolate, café.\n3) Antiácido OTC 2–3 días según etiqueta."},
+    "hydration": {"ru":"Гидратация в жару:\nВода 200–300 мл каждый час активности; соль/электролиты при длительной жаре; светлая одежда и тень.",
+        "uk":"Гідратація в спеку:\nВода 200–300 мл щогодини активності; електроліти за тривалої спеки; світлий одяг і тінь.",
+        "en":"Hot-day hydration:\n200–300 ml water each active hour; add electrolytes if prolonged heat; light clothing & shade.",
+        "es":"Hidratación en calor:\n200–300 ml de agua por hora activa; electrolitos si el calor es prolongado; ropa clara y sombra."},
+}
 
 def microplan_text(key: str, lang: str) -> str:
-    if key=="neck":
-        return {"ru":"Шея 5 мин:\n1) Медленные наклоны вперёд/назад ×5\n2) Повороты в стороны ×5\n3) Полукруги подбородком ×5\n4) Растяжка трапеций 2×20с.",
-                "uk":"Шия 5 хв:\n1) Нахили вперед/назад ×5\n2) Повороти в сторони ×5\n3) Півкола підборіддям ×5\n4) Розтяжка трапецій 2×20с.",
-                "en":"Neck 5-min:\n1) Slow flex/extend ×5\n2) Rotations L/R ×5\n3) Chin semicircles ×5\n4) Upper-trap stretch 2×20s.",
-                "es":"Cuello 5 min:\n1) Flex/ext lenta ×5\n2) Giros izq/der ×5\n3) Semicírculos con barbilla ×5\n4) Estiramiento trapecio sup. 2×20s."}[lang]
-    if key=="sleepreset":
-        return {"ru":"Сон-ресет (3 ночи):\nН1: экран-детокс 60м + отбой фикс.\nН2: 15м вне кровати при пробуждениях.\nН3: свет утром 10–15м, кофе до 14:00.",
-                "uk":"Сон-ресет (3 ночі):\nН1: детокс екранів 60 хв + фіксований відбій.\nН2: 15 хв поза ліжком при пробудженнях.\nН3: світло вранці 10–15 хв, кава до 14:00.",
-                "en":"Sleep reset (3 nights):\nN1: 60-min screen detox + fixed bedtime.\nN2: 15-min out of bed if awake.\nN3: AM light 10–15m; caffeine by 2pm.",
-                "es":"Reinicio del sueño (3 noches):\nN1: 60 min sin pantallas + hora fija.\nN2: 15 min fuera de la cama si despiertas.\nN3: Luz AM 10–15m; café hasta 14:00."}[lang]
-    if key=="heartburn":
-        return {"ru":"Изжога — 3 шага:\n1) Порции меньше, не ложиться 3ч после еды.\n2) Триггеры: жирное, алкоголь, мята, шоколад, кофе — убрать.\n3) OTC: антацид по инструкции 2–3 дня.",
-                "uk":"Печія — 3 кроки:\n1) Менші порції, не лягати 3 год після їжі.\n2) Тригери: жирне, алкоголь, м’ята, шоколад, кава — прибрати.\n3) OTC: антацид за інстр. 2–3 дні.",
-                "en":"Heartburn — 3 steps:\n1) Smaller meals; avoid lying 3h after.\n2) Remove triggers: fatty foods, alcohol, mint, chocolate, coffee.\n3) OTC antacid 2–3 days as directed.",
-                "es":"Acidez — 3 pasos:\n1) Comidas pequeñas; no recostarse 3h.\n2) Evitar: grasas, alcohol, menta, chocolate, café.\n3) Antiácido OTC 2–3 días según etiqueta."}[lang]
-    if key=="hydration":
-        return {"ru":"Гидратация в жару:\nВода 200–300 мл каждый час активности; соль/электролиты при длительной жаре; светлая одежда и тень.",
-                "uk":"Гідратація в спеку:\nВода 200–300 мл щогодини активності; електроліти за тривалої спеки; світлий одяг і тінь.",
-                "en":"Hot-day hydration:\n200–300 ml water each active hour; add electrolytes if prolonged heat; light clothing & shade.",
-                "es":"Hidratación en calor:\n200–300 ml de agua por hora activa; electrolitos si el calor es prolongado; ropa clara y sombra."}[lang]
-    return ""
+    return MICROPLANS.get(key, {}).get(lang, "")
+
+CHIP_TEXTS = {
+    ("hb", "triggers"): {"ru":"Изжога — триггеры: жирное, острое, шоколад, кофе, цитрусы, мята, алкоголь. Последний приём пищи за 3 ч до сна.",
+        "uk":"Печія — тригери: жирне, гостре, шоколад, кава, цитрусові, м’ята, алкоголь. Останній прийом за 3 год до сну.",
+        "en":"Heartburn triggers: fatty/spicy foods, chocolate, coffee, citrus, mint, alcohol. Last meal ≥3h before bed.",
+        "es":"Desencadenantes: grasa/picante, chocolate, café, cítricos, menta, alcohol. Última comida ≥3h antes de dormir."},
+    ("hb", "otc"): {"ru":"OTC варианты при изжоге: антацид (альгиновая кислота/карбонаты), кратко 2–3 дня. Если часто повторяется — обсудить с врачом.",
+        "uk":"OTC варіанти: антацид (альгінати/карбонати) на 2–3 дні. Якщо часто — до лікаря.",
+        "en":"OTC: antacid (alginates/carbonates) for 2–3 days. If frequent — discuss with a clinician.",
+        "es":"OTC: antiácido (alginatos/carbonatos) 2–3 días. Si es frecuente, consulta médica."},
+    ("hb", "red"): {"ru":"Когда к врачу при изжоге: дисфагия, рвота кровью, чёрный стул, потеря веса, ночные боли, >2–3 нед несмотря на меры.",
+        "uk":"Коли до лікаря: дисфагія, блювання кровʼю, чорний стілець, втрата ваги, нічний біль, >2–3 тиж попри заходи.",
+        "en":"See a doctor if: trouble swallowing, vomiting blood, black stools, weight loss, nocturnal pain, >2–3 weeks despite measures.",
+        "es":"Acude al médico si: disfagia, vómito con sangre, heces negras, pérdida de peso, dolor nocturno, >2–3 semanas pese a medidas."},
+    ("neck", "heat"): {"ru":"Шея: первые 48 ч лучше холод 10–15 мин ×2–3/д; затем тепло для расслабления; лёгкая растяжка без боли.",
+        "uk":"Шия: перші 48 год — холод 10–15 хв ×2–3/д; далі тепло; легка розтяжка без болю.",
+        "en":"Neck: first 48h prefer ice 10–15 min ×2–3/day, then heat for relaxation; gentle stretch without pain.",
+        "es":"Cuello: primeras 48h hielo 10–15 min ×2–3/día, luego calor; estiramientos suaves sin dolor."},
+    ("neck", "red"): {"ru":"Красные флаги: слабость рук, онемение, травма, лихорадка, боль >7/10, быстро прогрессирует — к врачу/неотложке.",
+        "uk":"Червоні прапори: слабкість рук, оніміння, травма, гарячка, біль >7/10, прогресує — до лікаря/невідкладної.",
+        "en":"Red flags: arm weakness/numbness, trauma, fever, pain >7/10, rapid progression — seek care.",
+        "es":"Banderas rojas: debilidad/entumecimiento en brazos, trauma, fiebre, dolor >7/10, progresión rápida — atención médica."},
+}
 
 def chip_text(domain: str, kind: str, lang: str) -> str:
-    if domain=="hb":
-        if kind=="triggers":
-            return {"ru":"Изжога — триггеры: жирное, острое, шоколад, кофе, цитрусы, мята, алкоголь. Последний приём пищи за 3 ч до сна.",
-                    "uk":"Печія — тригери: жирне, гостре, шоколад, кава, цитрусові, м’ята, алкоголь. Останній прийом за 3 год до сну.",
-                    "en":"Heartburn triggers: fatty/spicy foods, chocolate, coffee, citrus, mint, alcohol. Last meal ≥3h before bed.",
-                    "es":"Desencadenantes: grasa/picante, chocolate, café, cítricos, menta, alcohol. Última comida ≥3h antes de dormir."}[lang]
-        if kind=="otc":
-            return {"ru":"OTC варианты при изжоге: антацид (альгиновая кислота/карбонаты), кратко 2–3 дня. Если часто повторяется — обсудить с врачом.",
-                    "uk":"OTC варіанти: антацид (альгінати/карбонати) на 2–3 дні. Якщо часто — до лікаря.",
-                    "en":"OTC: antacid (alginates/carbonates) for 2–3 days. If frequent — discuss with a clinician.",
-                    "es":"OTC: antiácido (alginatos/carbonatos) 2–3 días. Si es frecuente, consulta médica."}[lang]
-        if kind=="red":
-            return {"ru":"Когда к врачу при изжоге: дисфагия, рвота кровью, чёрный стул, потеря веса, ночные боли, >2–3 нед несмотря на меры.",
-                    "uk":"Коли до лікаря: дисфагія, блювання кровʼю, чорний стілець, втрата ваги, нічний біль, >2–3 тиж попри заходи.",
-                    "en":"See a doctor if: trouble swallowing, vomiting blood, black stools, weight loss, nocturnal pain, >2–3 weeks despite measures.",
-                    "es":"Acude al médico si: disfagia, vómito con sangre, heces negras, pérdida de peso, dolor nocturno, >2–3 semanas pese a medidas."}[lang]
-    if domain=="neck":
-        if kind=="routine":
-            return microplan_text("neck", lang)
-        if kind=="heat":
-            return {"ru":"Шея: первые 48 ч лучше холод 10–15 мин ×2–3/д; затем тепло для расслабления; лёгкая растяжка без боли.",
-                    "uk":"Шия: перші 48 год — холод 10–15 хв ×2–3/д; далі тепло; легка розтяжка без болю.",
-                    "en":"Neck: first 48h prefer ice 10–15 min ×2–3/day, then heat for relaxation; gentle stretch without pain.",
-                    "es":"Cuello: primeras 48h hielo 10–15 min ×2–3/día, luego calor; estiramientos suaves sin dolor."}[lang]
-        if kind=="red":
-            return {"ru":"Красные флаги: слабость рук, онемение, травма, лихорадка, боль >7/10, быстро прогрессирует — к врачу/неотложке.",
-                    "uk":"Червоні прапори: слабкість рук, оніміння, травма, гарячка, біль >7/10, прогресує — до лікаря/невідкладної.",
-                    "en":"Red flags: arm weakness/numbness, trauma, fever, pain >7/10, rapid progression — seek care.",
-                    "es":"Banderas rojas: debilidad/entumecimiento en brazos, trauma, fiebre, dolor >7/10, progresión rápida — atención médica."}[lang]
-    return ""
+    if domain == "neck" and kind == "routine":
+        return microplan_text("neck", lang)
+    return CHIP_TEXTS.get((domain, kind), {}).get(lang, "")
 
 def care_links(kind: str, lang: str, city_hint: Optional[str]=None) -> str:
     if kind=="labsnear":
@@ -1529,16 +3543,23 @@ def care_links(kind: str, lang: str, city_hint: Optional[str]=None) -> str:
     return ""
 
 # ===== Youth-команды =====
+ENERGY_TIPS = {
+  "en": "\n".join(["1) 10-min brisk walk now (raise pulse).","2) 300–500 ml water + light protein.","3) 20-min screen detox to refresh focus."]),
+  "ru": "\n".join(["1) Быстрая ходьба 10 мин.","2) 300–500 мл воды + лёгкий белок.","3) 20 мин без экрана — разгрузка внимания."]),
+  "uk": "\n".join(["1) Швидка ходьба 10 хв.","2) 300–500 мл води + легкий білок.","3) 20 хв без екрана — перезавантаження уваги."]),
+  "es": "\n".join(["1) Camina rápido 10 min.","2) 300–500 ml de agua + proteína ligera.","3) 20 min sin pantallas."])
+}
+SKIN_TIPS = {
+    "ru":"Умывание 2×/день тёплой водой, SPF утром, 1% ниацинамид вечером.",
+    "en":"Wash face 2×/day with lukewarm water, SPF in the morning, 1% niacinamide at night.",
+    "uk":"Вмивання 2×/день теплою водою, SPF вранці, 1% ніацинамід ввечері.",
+    "es":"Lava el rostro 2×/día con agua tibia, SPF por la mañana, 1% niacinamida por la noche."
+}
+
 async def cmd_energy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = norm_lang(users_get(uid).get("lang") or "en")
-    tips = {
-      "en": ["1) 10-min brisk walk now (raise pulse).","2) 300–500 ml water + light protein.","3) 20-min screen detox to refresh focus."],
-      "ru": ["1) Быстрая ходьба 10 мин.","2) 300–500 мл воды + лёгкий белок.","3) 20 мин без экрана — разгрузка внимания."],
-      "uk": ["1) Швидка ходьба 10 хв.","2) 300–500 мл води + легкий білок.","3) 20 хв без екрана — перезавантаження уваги."],
-      "es": ["1) Camina rápido 10 min.","2) 300–500 ml de agua + proteína ligera.","3) 20 min sin pantallas."]
-    }[lang]
-    await update.message.reply_text(T[lang]["energy_title"] + "\n" + "\n".join(tips), reply_markup=inline_actions(lang))
+    await update.message.reply_text(T[lang]["energy_title"] + "\n" + ENERGY_TIPS[lang], reply_markup=inline_actions(lang))
 
 async def cmd_water(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -1549,25 +3570,14 @@ async def cmd_water(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_mood(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = norm_lang(users_get(uid).get("lang") or "en")
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(T[lang]["mood_good"], callback_data="mood|good"),
-         InlineKeyboardButton(T[lang]["mood_ok"],   callback_data="mood|ok"),
-         InlineKeyboardButton(T[lang]["mood_bad"],  callback_data="mood|bad")],
-        [InlineKeyboardButton(T[lang]["mood_note"], callback_data="mood|note")]
-    ])
+    kb = inline_mood_kb(lang)
     # [PATCH] подставляем имя
-    await update.message.reply_text(T[lang]["daily_gm"].replace("{name}", display_name(uid) or ""), reply_markup=kb)
+    await update.message.reply_text(tr(lang, "daily_gm", uid), reply_markup=kb)
 
 async def cmd_skin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = norm_lang(users_get(uid).get("lang") or "en")
-    tip = {
-        "ru":"Умывание 2×/день тёплой водой, SPF утром, 1% ниацинамид вечером.",
-        "en":"Wash face 2×/day with lukewarm water, SPF in the morning, 1% niacinamide at night.",
-        "uk":"Вмивання 2×/день теплою водою, SPF вранці, 1% ніацинамід ввечері.",
-        "es":"Lava el rostro 2×/día con agua tibia, SPF por la mañana, 1% niacinamida por la noche."
-    }[lang]
-    await update.message.reply_text(T[lang]["skin_title"] + "\n" + tip, reply_markup=inline_actions(lang))
+    await update.message.reply_text(T[lang]["skin_title"] + "\n" + SKIN_TIPS[lang], reply_markup=inline_actions(lang))
 
 # === ПРАВКА 3: команда быстрого самотеста JobQueue (/test_in) ===
 async def cmd_test_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1587,6 +3597,7 @@ async def cmd_test_in(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ JobQueue unavailable.")
 
 # ===== Pain triage вспомогательные =====
+@frozen_keyboard
 def _kb_for_code(lang: str, code: str):
     if code == "painloc":
         kb = inline_list(T[lang]["triage_pain_q1_opts"], "painloc")
@@ -1601,7 +3612,7 @@ def _kb_for_code(lang: str, code: str):
     else:
         kb = None
     if kb:
-        rows = kb.inline_keyboard + [[InlineKeyboardButton(T[lang]["back"], callback_data="pain|exit")]]
+        rows = list(kb.inline_keyboard) + [[InlineKeyboardButton(T[lang]["back"], callback_data="pain|exit")]]
         return InlineKeyboardMarkup(rows)
     return None
 
@@ -1609,7 +3620,7 @@ def _kb_for_code(lang: str, code: str):
 async def cmd_health60(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = norm_lang(users_get(uid).get("lang") or getattr(update.effective_user, "language_code", None))
-    sessions.setdefault(uid, {})["awaiting_h60"] = True
+    set_state(uid, ST_H60, "cmd_health60")
     await update.message.reply_text(T[lang]["h60_intro"])
 
 # ===== /intake кнопка =====
@@ -1668,6 +3679,7 @@ PROFILE_STEPS = [
                              "es":[("<5k pasos","<5k"),("5–8k","5-8k"),("8–12k","8-12k"),("Deporte regular","sport")]}}
 ]
 
+@frozen_keyboard
 def build_profile_kb(lang:str, key:str, opts:List[Tuple[str,str]])->InlineKeyboardMarkup:
     rows=[]; row=[]
     for label,val in opts:
@@ -1679,7 +3691,8 @@ def build_profile_kb(lang:str, key:str, opts:List[Tuple[str,str]])->InlineKeyboa
     return InlineKeyboardMarkup(rows)
 
 async def start_profile_ctx(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lang: str, uid: int):
-    sessions[uid] = {"profile_active": True, "p_step": 0, "p_wait_key": None}
+    set_state(uid, ST_IDLE, "profile_start")
+    sessions[uid] = {"profile_active": True, "p_step": 0, "p_wait_key": None, "state": ST_IDLE}
     await context.bot.send_message(chat_id, T[lang]["profile_intro"], reply_markup=ReplyKeyboardRemove())
     step = PROFILE_STEPS[0]
     kb = build_profile_kb(lang, step["key"], step["opts"][lang])
@@ -1716,17 +3729,111 @@ async def render_main_menu(update_or_cb: Update, context: ContextTypes.DEFAULT_T
     lang = norm_lang(users_get(uid).get("lang") or getattr(update_or_cb.effective_user, "language_code", None) or "en")
     await context.bot.send_message(chat_id, f"{T[lang]['m_menu_title']}", reply_markup=inline_main_menu(lang))
 
+# ----- Ветки on_text по состоянию диалога -----
+# Хэндлер получает текст в своём состоянии; False — «не моё», идём в общий поток роутера.
+async def _st_daily_comment(update, context, uid: int, lang: str, text: str):
+    set_state(uid, ST_IDLE, "daily_comment")
+    daily_add(iso(utcnow()), uid, "note", text)
+    await update.message.reply_text(T[lang]["mood_thanks"])
+
+async def _st_free_feedback(update, context, uid: int, lang: str, text: str):
+    set_state(uid, ST_IDLE, "free_feedback")
+    feedback_add(iso(utcnow()), uid, "free", update.effective_user.username, "", text)
+    await update.message.reply_text(T[lang]["fb_thanks"])
+
+async def _st_city(update, context, uid: int, lang: str, text: str):
+    set_state(uid, ST_IDLE, "city")
+    await update.message.reply_text(T[lang]["thanks"])
+
+async def _st_weight(update, context, uid: int, lang: str, text: str):
+    m = re.search(r'\d{1,3}(?:[.,]\d{1,1})?', text.replace(",", "."))
+    set_state(uid, ST_IDLE, "weight")
+    if m:
+        val = m.group(0)
+        st = habits_add(uid, "weight", val, "kg")
+        await update.message.reply_text(("Logged weight: " if lang=="en" else "Вес записан: ") + f"{val} kg\nStreak: {st}", reply_markup=inline_main_menu(lang))
+    else:
+        await update.message.reply_text("Please send a number like 72.5" if lang=="en" else "Пришлите число, например 72.5", reply_markup=inline_main_menu(lang))
+
+H60_PROTEIN_PICKS = {
+    "ru": "Под тебя подойдёт сегодня:\n• Творог 200 г + огурец\n• Омлет 2 яйца + овощи\n• Сардины 1 банка + салат\nВыбери вариант — подстрою дальше.",
+    "uk": "На сьогодні підійде:\n• Сир 200 г + огірок\n• Омлет 2 яйця + овочі\n• Сардини 1 банка + салат\nОбери варіант — підлаштую далі.",
+    "en": "Good picks for today:\n• Cottage cheese 200 g + cucumber\n• 2-egg omelet + veggies\n• Sardines (1 can) + salad\nPick one — I’ll tailor next.",
+}
+
+async def _st_h60(update, context, uid: int, lang: str, text: str):
+    set_state(uid, ST_IDLE, "h60")
+    low = text.lower()
+    if "h60:protein" in keyword_categories(low):
+        msg = H60_PROTEIN_PICKS.get(lang, H60_PROTEIN_PICKS["en"])
+    else:
+        msg = T[lang]["unknown"]
+    out = ReplyComposer(context.bot, update.effective_chat.id)
+    out.part(msg, inline_actions(lang))
+    kind = chip_kind(text)
+    if kind:
+        out.part(T[lang][f"chips_{kind}"], _chips_kb(lang, kind))
+    ask_feedback_soft(uid, context, lang, out)
+    await out.flush()
+
+async def _st_profile_value(update, context, uid: int, lang: str, text: str):
+    key = sessions[uid].get("p_wait_key")
+    set_state(uid, ST_IDLE, "profile_value", p_wait_key=None)
+    if not key:
+        return False
+    val = text
+    if key in {"age","height_cm","weight_kg"}:
+        m = re.search(r'\d{1,3}', text)
+        if m: val = m.group(0)
+    profiles_upsert(uid,{key:val}); sessions[uid][key]=val
+    users_set(uid, "profile_banner_shown", "no")
+    await advance_profile_ctx(context, update.effective_chat.id, lang, uid)
+
+async def _st_pain(update, context, uid: int, lang: str, text: str):
+    s = sessions[uid]
+    if re.search(r"\b(stop|exit|back|назад|выход|выйти)\b", text.lower()):
+        set_state(uid, ST_IDLE, "pain_exit_text")
+        sessions.pop(uid, None)
+        await update.message.reply_text(T[lang]["m_menu_title"], reply_markup=inline_main_menu(lang))
+        return
+    step = s.get("step")
+    if step == 1:
+        await send_unique(update.message, uid, T[lang]["triage_pain_q2"], reply_markup=_kb_for_code(lang, "painkind")); return
+    if step == 2:
+        await send_unique(update.message, uid, T[lang]["triage_pain_q3"], reply_markup=_kb_for_code(lang, "paindur")); return
+    if step == 3:
+        await update.message.reply_text(T[lang]["triage_pain_q4"], reply_markup=_kb_for_code(lang, "num")); return
+    if step == 4:
+        m = re.fullmatch(r"(?:10|[0-9])", text)
+        if m:
+            sev = int(m.group(0)); s.setdefault("answers", {})["severity"] = sev; s["step"] = 5
+            await update.message.reply_text(T[lang]["triage_pain_q5"], reply_markup=_kb_for_code(lang, "painrf")); return
+        await update.message.reply_text(T[lang]["triage_pain_q4"], reply_markup=_kb_for_code(lang, "num")); return
+    return False
+
+# Таблица переходов для текста: состояние → хэндлер (он же переводит в следующее состояние)
+TEXT_STATES = {
+    ST_DAILY_COMMENT: _st_daily_comment,
+    ST_FREE_FEEDBACK: _st_free_feedback,
+    ST_CITY:          _st_city,
+    ST_WEIGHT:        _st_weight,
+    ST_H60:           _st_h60,
+    ST_PROFILE_VALUE: _st_profile_value,
+    ST_PAIN:          _st_pain,
+}
+
 # ===== Основной текстовый обработчик =====
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user; uid = user.id
     text = (update.message.text or "").strip()
     logging.info(f"INCOMING uid={uid} text={text[:200]}")
 
-    # [PATCH] anti-spam: снимаем флаг ожидания при любом входящем сообщении
-    clear_pending(uid)
-
     urec = users_get(uid)
 
+    # [PATCH] anti-spam: снимаем флаг ожидания при любом входящем сообщении (пишем, только если он стоит)
+    if urec and (urec.get("pending_q") or "").lower() == "yes":
+        clear_pending(uid)
+
     # первый заход
     if not urec:
         lang_guess = detect_lang_from_text(text, norm_lang(getattr(user, "language_code", None)))
@@ -1734,7 +3841,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sessions.setdefault(uid, {})["last_user_text"] = text
         # [PATCH] приветствие с подстановкой
         await update.message.reply_text(
-            T[lang_guess]["welcome"].replace("{name}", display_name(uid) or ""),
+            tr(lang_guess, "welcome", uid),
             reply_markup=ReplyKeyboardRemove()
         )
         await update.message.reply_text(T[lang_guess]["m_menu_title"], reply_markup=inline_main_menu(lang_guess))
@@ -1752,12 +3859,12 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = norm_lang(urec.get("lang") or getattr(user, "language_code", None) or "en")
 
     # [PATCH] имя: если ждали имя — обработаем
-    if await try_handle_name_reply(uid, text, lang):
+    if get_state(uid) == ST_NAME and await try_handle_name_reply(context.bot, uid, text, lang):
         return
 
     # мягкий автодетект ТОЛЬКО пока не зафиксирован явно и это не команда
     if sessions.setdefault(uid, {}).get("lang_locked") != True and text and not text.startswith("/"):
-        new_lang = detect_lang_from_text(text, lang)
+        new_lang = LANG_DETECTOR.detect_for_user(uid, text, lang)
         if new_lang != lang:
             users_set(uid, "lang", new_lang)
             lang = new_lang
@@ -1770,107 +3877,42 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sessions[uid]["serious_condition"] = sc
         prof = profiles_get(uid)
         plan = pain_plan(lang, [], prof)
-        await update.message.reply_text("\n".join(plan), reply_markup=inline_actions(lang))
-        ask_feedback_soft(uid, context, lang)
-        return
-
-    if sessions.get(uid, {}).get("awaiting_daily_comment"):
-        daily_add(iso(utcnow()), uid, "note", text)
-        sessions[uid]["awaiting_daily_comment"] = False
-        await update.message.reply_text(T[lang]["mood_thanks"]); return
-
-    if sessions.get(uid, {}).get("awaiting_free_feedback"):
-        sessions[uid]["awaiting_free_feedback"] = False
-        feedback_add(iso(utcnow()), uid, "free", user.username, "", text)
-        await update.message.reply_text(T[lang]["fb_thanks"]); return
-
-    if sessions.get(uid, {}).get("awaiting_city"):
-        sessions[uid]["awaiting_city"] = False
-        await update.message.reply_text(T[lang]["thanks"]); return
-
-    # ожидание веса
-    if sessions.get(uid, {}).get("awaiting_weight"):
-        m = re.search(r'\d{1,3}(?:[.,]\d{1,1})?', text.replace(",", "."))
-        sessions[uid]["awaiting_weight"] = False
-        if m:
-            val = m.group(0)
-            st = habits_add(uid, "weight", val, "kg")
-            await update.message.reply_text(("Logged weight: " if lang=="en" else "Вес записан: ") + f"{val} kg\nStreak: {st}", reply_markup=inline_main_menu(lang))
-        else:
-            await update.message.reply_text("Please send a number like 72.5" if lang=="en" else "Пришлите число, например 72.5", reply_markup=inline_main_menu(lang))
+        out = ReplyComposer(context.bot, update.effective_chat.id)
+        out.part("\n".join(plan), inline_actions(lang))
+        ask_feedback_soft(uid, context, lang, out)
+        await out.flush()
         return
 
-    if sessions.get(uid, {}).get("awaiting_h60"):
-        sessions[uid]["awaiting_h60"] = False
-        prof = profiles_get(uid)
-        low = text.lower()
-        if any(word in low for word in ["белок","protein","больше белка","↑белок"]):
-            if lang=="ru":
-                msg = "Под тебя подойдёт сегодня:\n• Творог 200 г + огурец\n• Омлет 2 яйца + овощи\n• Сардины 1 банка + салат\nВыбери вариант — подстрою дальше."
-            elif lang=="uk":
-                msg = "На сьогодні підійде:\n• Сир 200 г + огірок\n• Омлет 2 яйця + овочі\n• Сардини 1 банка + салат\nОбери варіант — підлаштую далі."
-            else:
-                msg = "Good picks for today:\n• Cottage cheese 200 g + cucumber\n• 2-egg omelet + veggies\n• Sardines (1 can) + salad\nPick one — I’ll tailor next."
-            await update.message.reply_text(msg, reply_markup=inline_actions(lang))
-        else:
-            await update.message.reply_text(T[lang]["unknown"], reply_markup=inline_actions(lang))
-        chips = chips_for_text(text, lang)
-        if chips:
-            await update.message.reply_text(T[lang]["chips_hb"] if "hb" in str(chips.inline_keyboard[0][0].callback_data) else T[lang]["chips_neck"], reply_markup=chips)
-        ask_feedback_soft(uid, context, lang)
+    handler = TEXT_STATES.get(get_state(uid))
+    if handler is not None and await handler(update, context, uid, lang, text) is not False:
         return
 
-    if sessions.get(uid, {}).get("p_wait_key"):
-        key = sessions[uid]["p_wait_key"]; sessions[uid]["p_wait_key"] = None
-        val = text
-        if key in {"age","height_cm","weight_kg"}:
-            m = re.search(r'\d{1,3}', text)
-            if m: val = m.group(0)
-        profiles_upsert(uid,{key:val}); sessions[uid][key]=val
-        users_set(uid, "profile_banner_shown", "no")
-        await advance_profile_ctx(context, update.effective_chat.id, lang, uid); return
-
-    s = sessions.get(uid, {})
-    if s.get("topic") == "pain":
-        if re.search(r"\b(stop|exit|back|назад|выход|выйти)\b", text.lower()):
-            sessions.pop(uid, None)
-            await update.message.reply_text(T[lang]["m_menu_title"], reply_markup=inline_main_menu(lang))
-            return
-        if s.get("step") == 1:
-            await send_unique(update.message, uid, T[lang]["triage_pain_q2"], reply_markup=_kb_for_code(lang, "painkind")); return
-        if s.get("step") == 2:
-            await send_unique(update.message, uid, T[lang]["triage_pain_q3"], reply_markup=_kb_for_code(lang, "paindur")); return
-        if s.get("step") == 3:
-            await update.message.reply_text(T[lang]["triage_pain_q4"], reply_markup=_kb_for_code(lang, "num")); return
-        if s.get("step") == 4:
-            m = re.fullmatch(r"(?:10|[0-9])", text)
-            if m:
-                sev = int(m.group(0)); s.setdefault("answers", {})["severity"] = sev; s["step"] = 5
-                await update.message.reply_text(T[lang]["triage_pain_q5"], reply_markup=_kb_for_code(lang, "painrf")); return
-            await update.message.reply_text(T[lang]["triage_pain_q4"], reply_markup=_kb_for_code(lang, "num")); return
-
+    out = ReplyComposer(context.bot, update.effective_chat.id)
     if should_show_profile_banner(uid):
         prof = profiles_get(uid)
         banner = profile_banner(lang, prof)
         if banner.strip().strip("—"):
-            await update.message.reply_text(banner)
+            out.part(banner)
         users_set(uid, "profile_banner_shown", "yes")
 
     # [PATCH] лёгкое «зеркало фактов» перед основным ответом
     fact = reflect_facts(text)
     if fact:
-        await maybe_send(context, uid, fact, force=True, count=False)
+        out.part(fact)
 
     prof = profiles_get(uid)
-    data = llm_router_answer(text, lang, prof)
+    data = await llm_router_answer(text, lang, prof)
     msg = apply_warm_tone(data.get("assistant_reply") or T[lang]["unknown"], lang)
-    await update.message.reply_text(msg.replace("{name}", display_name(uid) or ""), reply_markup=inline_actions(lang))
-    chips = chips_for_text(text, lang)
-    if chips:
-        await update.message.reply_text(T[lang]["chips_hb"] if "hb" in str(chips.inline_keyboard[0][0].callback_data) else T[lang]["chips_neck"], reply_markup=chips)
-    ask_feedback_soft(uid, context, lang)
+    if "{name}" in msg:
+        msg = msg.replace("{name}", display_name(uid) or "")
+    out.part(msg, inline_actions(lang))
     for one in (data.get("followups") or [])[:2]:
-        await send_unique(update.message, uid, apply_warm_tone(one, lang), force=True)
+        out.part(apply_warm_tone(one, lang), join=True)
+    kind = chip_kind(text)
+    if kind:
+        out.part(T[lang][f"chips_{kind}"], _chips_kb(lang, kind))
+    ask_feedback_soft(uid, context, lang, out)
+    await out.flush()
     return
 
 # ===== Build & run (команды и планировщики) =====
@@ -1878,7 +3920,32 @@ async def post_init(app):
     me = await app.bot.get_me()
     logging.info(f"BOT READY: @{me.username} (id={me.id})")
     # ВАЖНО: восстановим все сохранённые напоминания/чек-ины из Sheets/памяти
+    if SHEETS_ENABLED:
+        await asyncio.to_thread(REPLICA.refresh)
+    start_slot_scheduler(app)
+    OUTBOX.start(app.bot)
+    REMINDERS.start(app.bot)
+    DEFERRED.start(app.bot)
     schedule_from_sheet_on_start(app)
+    if METRICS_PORT:
+        metrics_serve(METRICS_PORT)
+    if _has_jq_app(app):
+        app.job_queue.run_repeating(job_llm_probe, interval=LLM_PROBE_EVERY_SEC, first=LLM_PROBE_EVERY_SEC, name="llm_probe")
+        app.job_queue.run_repeating(job_pregen_morning, interval=PREGEN_EVERY_SEC, first=5, name="pregen_morning")
+        app.job_queue.run_repeating(job_rules_index_refresh, interval=RULES_INDEX_REFRESH_SEC, first=1, name="rules_index")
+        app.job_queue.run_repeating(job_metrics_log, interval=METRICS_LOG_SEC, first=METRICS_LOG_SEC, name="metrics_log")
+        if SHEETS_ENABLED:
+            app.job_queue.run_repeating(job_replica_refresh, interval=REPLICA_REFRESH_SEC, first=REPLICA_REFRESH_SEC, name="replica_refresh")
+            app.job_queue.run_repeating(job_append_flush, interval=APPEND_FLUSH_SEC, first=APPEND_FLUSH_SEC, name="append_flush")
+        app.job_queue.run_repeating(job_hot_checkpoint, interval=HOT_CHECKPOINT_SEC, first=HOT_CHECKPOINT_SEC, name="hot_checkpoint")
+
+async def post_shutdown(app):
+    await DEFERRED.stop()
+    await REMINDERS.stop()
+    await OUTBOX.stop()
+    await hot_checkpoint()
+    if SHEETS_ENABLED:
+        await asyncio.to_thread(appends_flush_all, 3)
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -1886,7 +3953,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     users_upsert(user.id, user.username or "", lang)
     context.user_data["lang"] = lang
     sessions.setdefault(user.id, {})["last_user_text"] = "/start"
-    await update.message.reply_text(T[lang]["welcome"].replace("{name}", display_name(user.id) or ""), reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text(tr(lang, "welcome", user.id), reply_markup=ReplyKeyboardRemove())
 
     # [PATCH] сразу попросить имя один раз (после выбора языка)
     if await ensure_ask_name(user.id, lang, context):
@@ -1925,6 +3992,7 @@ async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id; users_set(uid, "paused", "yes")
+    MORNING_STAGE.pop(uid, None)
     lang = norm_lang(users_get(uid).get("lang") or "en")
     await update.message.reply_text(T[lang]["paused_on"])
 
@@ -1934,28 +4002,27 @@ async def cmd_resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(T[lang]["paused_off"])
 
 # *** /delete_data: чистим все листы и снимаем джобы
-async def cmd_delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-
-    if SHEETS_ENABLED:
-        def _delete_where(ws, col_name, value):
-            vals = ws.get_all_values()
-            if not vals: return
-            hdr = vals[0]
+def _delete_user_rows(uid: int):
+    """Удаление строк пользователя во всех листах (под SHEET_ROWS_LOCK — номера строк сдвигаются)."""
+    def _delete_where(ws, col_name, value):
+        vals = ws.get_all_values()
+        if not vals: return
+        hdr = vals[0]
+        try:
+            col = hdr.index(col_name) + 1
+        except ValueError:
+            return
+        rows = []
+        for i in range(2, len(vals) + 1):
             try:
-                col = hdr.index(col_name) + 1
-            except ValueError:
-                return
-            rows = []
-            for i in range(2, len(vals) + 1):
-                try:
-                    if ws.cell(i, col).value == str(value):
-                        rows.append(i)
-                except Exception:
-                    continue
-            for i in reversed(rows):
-                ws.delete_rows(i)
+                if ws.cell(i, col).value == str(value):
+                    rows.append(i)
+            except Exception:
+                continue
+        for i in reversed(rows):
+            ws.delete_rows(i)
 
+    with SHEET_ROWS_LOCK:
         _delete_where(ws_users,    "user_id", uid)
         _delete_where(ws_profiles, "user_id", uid)
         _delete_where(ws_episodes, "user_id", uid)
@@ -1963,6 +4030,17 @@ async def cmd_delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         _delete_where(ws_daily,    "user_id", uid)
         _delete_where(ws_feedback, "user_id", uid)
         _delete_where(ws_habits,   "user_id", uid)
+
+async def cmd_delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+
+    HOT.drop_user(uid)   # до удаления строк: чекпоинт не должен вернуть их поля
+    if SHEETS_ENABLED:
+        await asyncio.to_thread(appends_flush_all)
+        await asyncio.to_thread(_delete_user_rows, uid)
+        REPLICA.invalidate()
+        for reader in TAIL_READERS.values():
+            reader.reset()
     else:
         MEM_USERS.pop(uid, None)
         MEM_PROFILES.pop(uid, None)
@@ -1973,10 +4051,14 @@ async def cmd_delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         MEM_FEEDBACK  = [r for r in MEM_FEEDBACK  if r["user_id"] != str(uid)]
         MEM_HABITS    = [r for r in MEM_HABITS    if r["user_id"] != str(uid)]
 
-    if _has_jq_ctx(context):
-        for name in [f"daily_{uid}", f"daily_e_{uid}"]:
-            for j in context.application.job_queue.get_jobs_by_name(name):
-                j.schedule_removal()
+    unschedule_checkins(uid)
+    MORNING_STAGE.pop(uid, None)
+    REMINDERS.drop_user(uid)
+    LANG_DETECTOR.forget(uid)
+    DEFERRED.drop_user(uid)
+    USER_RECS.pop(uid, None)
+    with REMINDER_ROWS_LOCK:
+        REMINDER_ROWS.clear()   # строки в Reminders сдвинулись
 
     lang = norm_lang(getattr(update.effective_user,"language_code",None))
     await update.message.reply_text(T[lang]["deleted"], reply_markup=ReplyKeyboardRemove())
@@ -2047,10 +4129,8 @@ async def cmd_checkin_evening(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def cmd_checkin_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if _has_jq_ctx(context):
-        for name in [f"daily_{uid}", f"daily_e_{uid}"]:
-            for j in context.application.job_queue.get_jobs_by_name(name):
-                j.schedule_removal()
+    unschedule_checkins(uid)
+    MORNING_STAGE.pop(uid, None)
     lang = norm_lang(users_get(uid).get("lang") or "en")
     await update.message.reply_text({"ru":"Ежедневный чек-ин выключен.",
                                      "uk":"Щоденний чек-ін вимкнено.",
@@ -2066,8 +4146,96 @@ def _lang_cmd(code: str, ack: str):
         await update.message.reply_text(ack)
     return _h
 
+# ===== Конкурентная обработка апдейтов =====
+# Апдейты разных пользователей идут параллельно (до MAX_CONCURRENT_UPDATES),
+# апдейты одного пользователя — строго по порядку: хэндлеры меняют sessions[uid].
+# Семафор базового класса берётся раньше do_process_update, поэтому ему отдан только
+# верхний предел очереди (UPDATE_BACKLOG_MAX), а рабочие слоты — собственный семафор,
+# который апдейт занимает уже после очереди своего пользователя: всплеск от одного
+# пользователя ждёт на своём локе и не держит слоты остальных.
+UPDATE_BACKLOG_MAX = int(os.getenv("UPDATE_BACKLOG_MAX", "4096"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max(UPDATE_BACKLOG_MAX, max_concurrent_updates))
+        self._work = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, list] = {}   # uid -> [Lock, число ожидающих]
+        self._active = 0
+
+    @staticmethod
+    def _key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._work:
+                await coroutine
+            return
+        slot = self._locks.get(key)
+        if slot is None:
+            slot = self._locks[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                async with self._work:
+                    self._active += 1
+                    metric_set("updates_inflight", self._active)
+                    t0 = time.monotonic()
+                    try:
+                        await coroutine
+                    finally:
+                        self._active -= 1
+                        metric_observe("update_handle_seconds", time.monotonic() - t0)
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self._locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ===== HTTP-клиент Telegram =====
+# Трейс httpcore: connect_tcp означает новое соединение, остальное — запросы по живым
+# keep-alive соединениям. tg_http_requests_total / tg_http_connects_total → доля переиспользования.
+async def _tg_http_trace(event: str, info: dict):
+    if event == "connection.connect_tcp.complete":
+        metric_inc("tg_http_connects_total")
+
+async def _tg_http_on_request(request: httpx.Request):
+    request.extensions["trace"] = _tg_http_trace
+    metric_inc("tg_http_requests_total")
+
+def _tg_request(pool_size: int, read_timeout: float) -> HTTPXRequest:
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=read_timeout,
+        write_timeout=TG_WRITE_TIMEOUT,
+        pool_timeout=TG_POOL_TIMEOUT,
+        httpx_kwargs={
+            "limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                                   keepalive_expiry=TG_KEEPALIVE_SEC),
+            "event_hooks": {"request": [_tg_http_on_request]},
+        },
+    )
+
 def build_app() -> "Application":
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    app = (ApplicationBuilder().token(TELEGRAM_TOKEN)
+           .request(_tg_request(TG_POOL_SIZE, TG_READ_TIMEOUT))
+           .get_updates_request(_tg_request(1, TG_READ_TIMEOUT))
+           .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+           .post_init(post_init).post_shutdown(post_shutdown).build())
+    warm_keyboards()
+    LANG_DETECTOR.warm()
     try:
         register_intake_pro(app, GSPREAD_CLIENT, on_complete_cb=_ipro_save_to_sheets_and_open_menu)
         logging.info("Intake Pro registered.")
@@ -2181,16 +4349,12 @@ def _compute_reminder_when(uid: int, kind: str) -> datetime:
     return utcnow() + timedelta(hours=4)
 
 
-async def _schedule_oneoff(app, uid: int, when_utc: datetime, rid: str):
+async def _schedule_oneoff(app, uid: int, when_utc: datetime, rid: str, text: str, lang: str):
     """
-    Планируем единичное напоминание в JobQueue.
+    Кладём единичное напоминание в REMINDERS (куча + один таймер).
     Минимальная задержка — 60 секунд (как и при восстановлении).
     """
-    if not _has_jq_app(app):
-        logging.warning(f"JobQueue not available – cannot schedule reminder {rid}")
-        return
-    delay = max(60, int((when_utc - utcnow()).total_seconds()))
-    app.job_queue.run_once(job_oneoff_reminder, when=delay, data={"user_id": uid, "reminder_id": rid})
+    REMINDERS.push(rid, uid, text, lang, max(when_utc, utcnow() + timedelta(seconds=60)))
 
 
 def _lang_for(uid: int) -> str:
@@ -2198,6 +4362,36 @@ def _lang_for(uid: int) -> str:
 
 
 # ---------- Основной callback-router ----------
+# Таблица «префикс → хэндлер»: callback_data разбирается один раз в CbData,
+# дальше один поиск в dict вместо цепочки startswith. Хэндлер возвращает False,
+# если подкоманда не распознана — тогда отвечаем «не понял действие».
+
+class CbData:
+    __slots__ = ("prefix", "rest", "_args")
+
+    def __init__(self, data: str):
+        self.prefix, _, self.rest = data.partition("|")   # rest — всё после первого «|»
+        self._args: Optional[Tuple[str, ...]] = None
+
+    @property
+    def args(self) -> Tuple[str, ...]:
+        # rest, разбитый по «|»; считаем только если хэндлеру нужны позиционные части
+        if self._args is None:
+            self._args = tuple(self.rest.split("|")) if self.rest else ()
+        return self._args
+
+    def arg(self, i: int, default: str = "") -> str:
+        args = self.args
+        return args[i] if i < len(args) else default
+
+CALLBACKS: Dict[str, Any] = {}
+
+def callback_handler(prefix: str):
+    def deco(fn):
+        CALLBACKS[prefix] = fn
+        return fn
+    return deco
+
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -2216,391 +4410,456 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
         return
 
-    # ---------------- ГЛАВНОЕ МЕНЮ ----------------
-    if data.startswith("menu|"):
-        _, what = data.split("|", 1)
-        if what == "root":
-            await _reply_cbsafe(q, T[lang]["m_menu_title"], kb=inline_main_menu(lang), replace=True)
-            return
-        if what == "h60":
-            sessions.setdefault(uid, {})["awaiting_h60"] = True
-            await _reply_cbsafe(q, T[lang]["h60_intro"], kb=None, replace=False)
-            return
-        if what == "sym":
-            await _reply_cbsafe(q, "Выберите категорию симптома:" if lang != "en" else "Choose a symptom:", kb=inline_symptoms_menu(lang), replace=True)
-            return
-        if what == "mini":
-            await _reply_cbsafe(q, "Мини-планы:" if lang != "en" else "Mini-plans:", kb=inline_miniplans_menu(lang), replace=True)
-            return
-        if what == "care":
-            await _reply_cbsafe(q, "Куда обратиться:" if lang != "en" else "Find care:", kb=inline_findcare_menu(lang), replace=True)
-            return
-        if what == "hab":
-            await _reply_cbsafe(q, "Быстрый лог привычек:" if lang != "en" else "Habits quick-log:", kb=inline_habits_menu(lang), replace=True)
-            return
-        if what == "rem":
-            await _reply_cbsafe(q, "Быстрые напоминания:" if lang != "en" else "Quick reminders:", kb=inline_remind(lang), replace=True)
-            return
-        if what == "lang":
-            await _reply_cbsafe(q, "Язык / Language:", kb=inline_lang_menu(lang), replace=True)
-            return
-        if what == "privacy":
-            await _reply_cbsafe(q, T[lang]["privacy"], replace=False)
-            return
-        if what == "smart":
-            await _reply_cbsafe(q, "Смарт-чек-ин:" if lang != "en" else "Smart check-in:", kb=inline_smart_checkin(lang), replace=True)
-            return
-        if what == "coming":
-            await _reply_cbsafe(q, T[lang]["m_soon"], replace=False)
-            return
+    cb = CbData(data)
+    handler = CALLBACKS.get(cb.prefix)
+    if handler is not None and await handler(q, context, uid, lang, cb) is not False:
+        return
 
-    # ---------------- СМЕНА ЯЗЫКА ----------------
-    if data.startswith("lang|"):
-        _, code = data.split("|", 1)
-        if code in {"en", "ru", "uk", "es"}:
-            users_set(uid, "lang", code)
-            sessions.setdefault(uid, {})["lang_locked"] = True
-            lang = code
-            await _reply_cbsafe(q,
-                                {"ru": "Ок, дальше по-русски.",
-                                 "uk": "Ок, надалі українською.",
-                                 "es": "De acuerdo, seguiré en español.",
-                                 "en": "OK, I’ll reply in English."}[lang],
-                                kb=inline_main_menu(lang), replace=True)
-            return
+    # Если дошли сюда — ничего не совпало
+    await _reply_cbsafe(q, ("Не понял действие." if lang != "en" else "Didn’t catch that action."), replace=False)
 
-    # ---------------- КНОПКА ИМЕНИ ----------------
-    if data.startswith("name|"):
-        # обрабатываем name|ask, name|write, name|skip
-        parts = data.split("|")
-        action = parts[1] if len(parts) > 1 else "ask"
-        if action in {"ask", "write"}:
-            sessions.setdefault(uid, {})["awaiting_name"] = True
-            prompt = "How should I address you?" if lang == "en" else "Как к вам обращаться?"
-            # показываем инпут-указание
-            await _reply_cbsafe(q,
-                                ("Please send your name in one message (e.g., “Alex”)."
-                                 if lang == "en"
-                                 else "Напишите имя одним сообщением (например: «Алекс»)."),
-                                kb=None, replace=False)
-            # и сам вопрос (без {name})
-            try:
-                await maybe_send(context, uid, prompt, kb=None, force=True, count=False)
-            except Exception:
-                pass
-            return
-        if action == "skip":
-            sessions.setdefault(uid, {})["awaiting_name"] = False
-            await _reply_cbsafe(q, "Ок, пропустим." if lang != "en" else "OK, skipping.", kb=inline_main_menu(lang), replace=True)
-            return
 
-    # ---------------- СОГЛАСИЕ НА СООБЩЕНИЯ ----------------
-    if data.startswith("consent|"):
-        _, ans = data.split("|", 1)
-        users_set(uid, "consent", "yes" if ans == "yes" else "no")
-        await _reply_cbsafe(q, T[lang]["thanks"], replace=False)
-        return
+# ---------------- ГЛАВНОЕ МЕНЮ ----------------
+MENU_TITLES = {
+    "sym":   ("Выберите категорию симптома:", "Choose a symptom:", inline_symptoms_menu),
+    "mini":  ("Мини-планы:", "Mini-plans:", inline_miniplans_menu),
+    "care":  ("Куда обратиться:", "Find care:", inline_findcare_menu),
+    "hab":   ("Быстрый лог привычек:", "Habits quick-log:", inline_habits_menu),
+    "rem":   ("Быстрые напоминания:", "Quick reminders:", inline_remind),
+    "lang":  ("Язык / Language:", "Язык / Language:", inline_lang_menu),
+    "smart": ("Смарт-чек-ин:", "Smart check-in:", inline_smart_checkin),
+}
 
-    # ---------------- HEALTH60 И СИМПТОМЫ ----------------
-    if data.startswith("sym|"):
-        _, sym = data.split("|", 1)
-        sessions.setdefault(uid, {})["awaiting_h60"] = True
-        intro = T[lang]["h60_intro"]
-        if sym == "headache":
-            intro = intro + ("\n\nНапример: «Голова болит 4 часа, 5/10»" if lang != "en" else "\n\nE.g., “Headache for 4 hours, 5/10”.")
-        elif sym == "heartburn":
-            intro = intro + ("\n\nНапример: «Жжёт после еды, ночью хуже»" if lang != "en" else "\n\nE.g., “Burning after meals, worse at night”.")
-        elif sym == "fatigue":
-            intro = intro + ("\n\nНапример: «Сон 6 ч, усталость к обеду»" if lang != "en" else "\n\nE.g., “Sleep 6h, energy dips at noon”.")
-        await _reply_cbsafe(q, intro, replace=False)
+@callback_handler("menu")
+async def _cb_menu(q, context, uid: int, lang: str, cb: CbData):
+    what = cb.rest
+    if what == "root":
+        await _reply_cbsafe(q, T[lang]["m_menu_title"], kb=inline_main_menu(lang), replace=True)
         return
-
-    # ---------------- МИНИ-ПЛАНЫ / CARE ----------------
-    if data.startswith("mini|"):
-        _, key = data.split("|", 1)
-        await _reply_cbsafe(q, microplan_text(key, lang) or "…", replace=False)
+    if what == "h60":
+        set_state(uid, ST_H60, "cb_menu_h60")
+        await _reply_cbsafe(q, T[lang]["h60_intro"], kb=None, replace=False)
         return
-
-    if data.startswith("care|"):
-        _, key = data.split("|", 1)
-        if key == "labsnear":
-            await _reply_cbsafe(q, care_links("labsnear", lang), replace=False)
-            return
-        if key == "urgent":
-            await _reply_cbsafe(q, care_links("urgent", lang), replace=False)
-            return
-        if key == "free_nj":
-            await _reply_cbsafe(q, care_links("free_nj", lang), replace=False)
-            return
-
-    # ---------------- ХАБИТЫ ----------------
-    if data.startswith("hab|"):
-        _, typ = data.split("|", 1)
-        if typ == "water":
-            streak = habits_add(uid, "water", "1", "cup")
-            await _reply_cbsafe(q,
-                                (f"Вода записана. Стрик: {streak}" if lang != "en" else f"Logged water. Streak: {streak}"),
-                                kb=inline_actions(lang), replace=False)
-            return
-        if typ == "steps":
-            streak = habits_add(uid, "steps", "1", "session")
-            await _reply_cbsafe(q,
-                                (f"Шаги отмечены. Стрик: {streak}" if lang != "en" else f"Steps logged. Streak: {streak}"),
-                                kb=inline_actions(lang), replace=False)
-            return
-        if typ == "sleep":
-            streak = habits_add(uid, "sleep", "1", "night")
-            await _reply_cbsafe(q,
-                                (f"Сон отмечен. Стрик: {streak}" if lang != "en" else f"Sleep logged. Streak: {streak}"),
-                                kb=inline_actions(lang), replace=False)
-            return
-        if typ == "stress":
-            streak = habits_add(uid, "stress", "1", "breath")
-            await _reply_cbsafe(q,
-                                (f"Стресс-минутка отмечена. Стрик: {streak}" if lang != "en" else f"Stress break logged. Streak: {streak}"),
-                                kb=inline_actions(lang), replace=False)
-            return
-        if typ == "weight":
-            sessions.setdefault(uid, {})["awaiting_weight"] = True
-            await _reply_cbsafe(q,
-                                ("Пришлите вес числом, например 72.5" if lang != "en" else "Send weight as a number, e.g., 72.5"),
-                                replace=False)
-            return
-
-    # ---------------- ФИДБЕК ----------------
-    if data.startswith("fb|"):
-        _, kind = data.split("|", 1)
-        ts = iso(utcnow())
-        if kind == "up":
-            feedback_add(ts, uid, display_name(uid) or "", users_get(uid).get("username"), "up", "")
-            await _reply_cbsafe(q, T[lang]["fb_thanks"], replace=False)
-            return
-        if kind == "down":
-            feedback_add(ts, uid, display_name(uid) or "", users_get(uid).get("username"), "down", "")
-            await _reply_cbsafe(q, T[lang]["fb_thanks"], replace=False)
-            return
-        if kind == "text":
-            sessions.setdefault(uid, {})["awaiting_free_feedback"] = True
-            await _reply_cbsafe(q, T[lang]["fb_write"], replace=False)
-            return
-
-    # ---------------- MOOD ----------------
-    if data.startswith("mood|"):
-        _, state = data.split("|", 1)
-        ts = iso(utcnow())
-        if state == "note":
-            sessions.setdefault(uid, {})["awaiting_daily_comment"] = True
-            await _reply_cbsafe(q, ("Напишите комментарий одним сообщением:" if lang != "en" else "Type a short comment:"), replace=False)
-            return
-        daily_add(ts, uid, state, "")
-        await _reply_cbsafe(q, T[lang]["mood_thanks"], replace=False)
+    if what in MENU_TITLES:
+        ru, en, kb = MENU_TITLES[what]
+        await _reply_cbsafe(q, ru if lang != "en" else en, kb=kb(lang), replace=True)
         return
-
-    # ---------------- SMART CHECK-IN ----------------
-    if data.startswith("smart|"):
-        _, key = data.split("|", 1)
-        short = {
-            "ok": "Отлично! Держим курс." if lang != "en" else "Great — keep it up!",
-            "pain": "Оцените боль 0–10 и напишите, где болит." if lang != "en" else "Rate the pain 0–10 and where it hurts.",
-            "tired": "Сделайте 10-мин прогулку и 300–500 мл воды." if lang != "en" else "Try a 10-min brisk walk + 300–500 ml water.",
-            "stress": "4× дыхание 4-4-6 и короткая прогулка." if lang != "en" else "Do 4 rounds of 4-4-6 breathing + a short walk.",
-            "hb": "Изжога: посмотрите триггеры и OTC-варианты ниже." if lang != "en" else "Heartburn: see triggers + OTC options below.",
-            "other": "Коротко опишите, что беспокоит." if lang != "en" else "Briefly describe what’s wrong."
-        }[key]
-        await _reply_cbsafe(q, short, replace=False)
-        if key in {"hb"}:
-            await _reply_cbsafe(q, T[lang]["chips_hb"], kb=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Avoid triggers" if lang=="en" else "Избегать триггеры", callback_data="chip|hb|triggers")],
-                [InlineKeyboardButton("OTC options", callback_data="chip|hb|otc")],
-                [InlineKeyboardButton("When to see a doctor" if lang=="en" else "Когда к врачу", callback_data="chip|hb|red")]
-            ]), replace=False)
+    if what == "privacy":
+        await _reply_cbsafe(q, T[lang]["privacy"], replace=False)
         return
-
-    # ---------------- ЧИПСЫ ----------------
-    if data.startswith("chip|"):
-        _, dom, kind = data.split("|", 2)
-        await _reply_cbsafe(q, chip_text(dom, kind, lang) or "…", replace=False)
+    if what == "coming":
+        await _reply_cbsafe(q, T[lang]["m_soon"], replace=False)
         return
+    return False
 
-    # ---------------- Профиль, 10 шагов ----------------
-    if data.startswith("p|"):
-        parts = data.split("|")
-        if len(parts) >= 3 and parts[1] == "choose":
-            _, _, key, val = parts[0], parts[1], parts[2], parts[3] if len(parts) > 3 else ""
-            profiles_upsert(uid, {key: val})
-            sessions.setdefault(uid, {})[key] = val
-            users_set(uid, "profile_banner_shown", "no")
-            await advance_profile_ctx(context, q.message.chat_id, lang, uid)
-            try:
-                await q.answer()
-            except Exception:
-                pass
-            return
-        if len(parts) >= 3 and parts[1] == "write":
-            _, _, key = parts[0], parts[1], parts[2]
-            sessions.setdefault(uid, {})["p_wait_key"] = key
-            await _reply_cbsafe(q,
-                                ("Пришлите значение одним сообщением." if lang != "en" else "Send the value in one message."),
-                                replace=False)
-            return
-        if len(parts) >= 3 and parts[1] == "skip":
-            await advance_profile_ctx(context, q.message.chat_id, lang, uid)
-            try:
-                await q.answer()
-            except Exception:
-                pass
-            return
+# ---------------- СМЕНА ЯЗЫКА ----------------
+LANG_SWITCHED = {"ru": "Ок, дальше по-русски.",
+                 "uk": "Ок, надалі українською.",
+                 "es": "De acuerdo, seguiré en español.",
+                 "en": "OK, I’ll reply in English."}
 
-    # ---------------- TRIAGE: Pain ----------------
-    if data.startswith("topic|"):
-        _, topic = data.split("|", 1)
-        if topic == "pain":
-            s = sessions.setdefault(uid, {})
-            s["topic"] = "pain"
-            s["step"] = 1
-            s["answers"] = {}
-            await _reply_cbsafe(q, T[lang]["triage_pain_q1"], kb=_kb_for_code(lang, "painloc"), replace=True)
-            return
-        if topic == "sleep":
-            await _reply_cbsafe(q, microplan_text("sleepreset", lang), replace=False)
-            return
-        if topic == "nutrition":
-            await _reply_cbsafe(q, ("Напишите, что ели вчера и цель (вес/энергия/сон)." if lang != "en" else "Tell me yesterday’s meals and your goal (weight/energy/sleep)."), replace=False)
-            return
-        if topic == "labs":
-            await _reply_cbsafe(q, ("Какие анализы хотите обсудить?" if lang != "en" else "Which labs do you want to discuss?"), replace=False)
-            return
-        if topic == "habits":
-            await _reply_cbsafe(q, T[lang]["m_hab"], kb=inline_habits_menu(lang), replace=True)
-            return
-        if topic == "longevity":
-            await _reply_cbsafe(q, ("Сфокусируем долголетие: сон, активность, питание, стресc." if lang != "en" else "Longevity focus: sleep, activity, nutrition, stress."), replace=False)
-            return
-        if topic == "profile":
-            await start_profile_ctx(context, q.message.chat_id, lang, uid)
-            return
+@callback_handler("lang")
+async def _cb_lang(q, context, uid: int, lang: str, cb: CbData):
+    code = cb.rest
+    if code not in SUPPORTED:
+        return False
+    users_set(uid, "lang", code)
+    sessions.setdefault(uid, {})["lang_locked"] = True
+    await _reply_cbsafe(q, LANG_SWITCHED[code], kb=inline_main_menu(code), replace=True)
+
+# ---------------- КНОПКА ИМЕНИ ----------------
+@callback_handler("name")
+async def _cb_name(q, context, uid: int, lang: str, cb: CbData):
+    # обрабатываем name|ask, name|write, name|skip
+    action = cb.arg(0, "ask")
+    if action in {"ask", "write"}:
+        set_state(uid, ST_NAME, "cb_name_" + action)
+        prompt = "How should I address you?" if lang == "en" else "Как к вам обращаться?"
+        # показываем инпут-указание
+        await _reply_cbsafe(q,
+                            ("Please send your name in one message (e.g., “Alex”)."
+                             if lang == "en"
+                             else "Напишите имя одним сообщением (например: «Алекс»)."),
+                            kb=None, replace=False)
+        # и сам вопрос (без {name})
+        try:
+            await maybe_send(context, uid, prompt, kb=None, force=True, count=False)
+        except Exception:
+            pass
+        return
+    if action == "skip":
+        leave_state(uid, ST_NAME, "cb_name_skip")
+        await _reply_cbsafe(q, "Ок, пропустим." if lang != "en" else "OK, skipping.", kb=inline_main_menu(lang), replace=True)
+        return
+    return False
 
-    if data.startswith("pain|"):
-        _, sub = data.split("|", 1)
-        if sub == "exit":
-            sessions.pop(uid, None)
-            await _reply_cbsafe(q, T[lang]["m_menu_title"], kb=inline_main_menu(lang), replace=True)
-            return
+# ---------------- СОГЛАСИЕ НА СООБЩЕНИЯ ----------------
+@callback_handler("consent")
+async def _cb_consent(q, context, uid: int, lang: str, cb: CbData):
+    users_set(uid, "consent", "yes" if cb.rest == "yes" else "no")
+    await _reply_cbsafe(q, T[lang]["thanks"], replace=False)
+
+# ---------------- HEALTH60 И СИМПТОМЫ ----------------
+SYM_EXAMPLES = {
+    "headache":  ("\n\nНапример: «Голова болит 4 часа, 5/10»", "\n\nE.g., “Headache for 4 hours, 5/10”."),
+    "heartburn": ("\n\nНапример: «Жжёт после еды, ночью хуже»", "\n\nE.g., “Burning after meals, worse at night”."),
+    "fatigue":   ("\n\nНапример: «Сон 6 ч, усталость к обеду»", "\n\nE.g., “Sleep 6h, energy dips at noon”."),
+}
 
-    if data.startswith("painloc|"):
-        _, loc = data.split("|", 1)
-        s = sessions.setdefault(uid, {})
-        s.setdefault("answers", {})["loc"] = loc
-        s["step"] = 2
-        await _reply_cbsafe(q, T[lang]["triage_pain_q2"], kb=_kb_for_code(lang, "painkind"), replace=True)
+@callback_handler("sym")
+async def _cb_sym(q, context, uid: int, lang: str, cb: CbData):
+    set_state(uid, ST_H60, "cb_sym")
+    intro = T[lang]["h60_intro"]
+    if cb.rest in SYM_EXAMPLES:
+        ru, en = SYM_EXAMPLES[cb.rest]
+        intro = intro + (ru if lang != "en" else en)
+    await _reply_cbsafe(q, intro, replace=False)
+
+# ---------------- МИНИ-ПЛАНЫ / CARE ----------------
+@callback_handler("mini")
+async def _cb_mini(q, context, uid: int, lang: str, cb: CbData):
+    await _reply_cbsafe(q, microplan_text(cb.rest, lang) or "…", replace=False)
+
+@callback_handler("care")
+async def _cb_care(q, context, uid: int, lang: str, cb: CbData):
+    if cb.rest not in {"labsnear", "urgent", "free_nj"}:
+        return False
+    await _reply_cbsafe(q, care_links(cb.rest, lang), replace=False)
+
+# ---------------- ХАБИТЫ ----------------
+HABIT_LOGS = {
+    "water":  ("1", "cup",     "Вода записана. Стрик: {n}",          "Logged water. Streak: {n}"),
+    "steps":  ("1", "session", "Шаги отмечены. Стрик: {n}",          "Steps logged. Streak: {n}"),
+    "sleep":  ("1", "night",   "Сон отмечен. Стрик: {n}",            "Sleep logged. Streak: {n}"),
+    "stress": ("1", "breath",  "Стресс-минутка отмечена. Стрик: {n}", "Stress break logged. Streak: {n}"),
+}
+
+@callback_handler("hab")
+async def _cb_hab(q, context, uid: int, lang: str, cb: CbData):
+    typ = cb.rest
+    if typ in HABIT_LOGS:
+        value, unit, ru, en = HABIT_LOGS[typ]
+        streak = habits_add(uid, typ, value, unit)
+        await _reply_cbsafe(q, (ru if lang != "en" else en).format(n=streak),
+                            kb=inline_actions(lang), replace=False)
+        return
+    if typ == "weight":
+        set_state(uid, ST_WEIGHT, "cb_hab_weight")
+        await _reply_cbsafe(q,
+                            ("Пришлите вес числом, например 72.5" if lang != "en" else "Send weight as a number, e.g., 72.5"),
+                            replace=False)
         return
+    return False
 
-    if data.startswith("painkind|"):
-        _, kind = data.split("|", 1)
-        s = sessions.setdefault(uid, {})
-        s.setdefault("answers", {})["kind"] = kind
-        s["step"] = 3
-        await _reply_cbsafe(q, T[lang]["triage_pain_q3"], kb=_kb_for_code(lang, "paindur"), replace=True)
+# ---------------- ФИДБЕК ----------------
+@callback_handler("fb")
+async def _cb_fb(q, context, uid: int, lang: str, cb: CbData):
+    kind = cb.rest
+    if kind in {"up", "down"}:
+        feedback_add(iso(utcnow()), uid, display_name(uid) or "", users_get(uid).get("username"), kind, "")
+        await _reply_cbsafe(q, T[lang]["fb_thanks"], replace=False)
+        return
+    if kind == "text":
+        set_state(uid, ST_FREE_FEEDBACK, "cb_fb_text")
+        await _reply_cbsafe(q, T[lang]["fb_write"], replace=False)
         return
+    return False
 
-    if data.startswith("paindur|"):
-        _, dur = data.split("|", 1)
-        s = sessions.setdefault(uid, {})
-        s.setdefault("answers", {})["dur"] = dur
-        s["step"] = 4
-        await _reply_cbsafe(q, T[lang]["triage_pain_q4"], kb=_kb_for_code(lang, "num"), replace=True)
+# ---------------- MOOD ----------------
+@callback_handler("mood")
+async def _cb_mood(q, context, uid: int, lang: str, cb: CbData):
+    state = cb.rest
+    if state == "note":
+        set_state(uid, ST_DAILY_COMMENT, "cb_mood_note")
+        await _reply_cbsafe(q, ("Напишите комментарий одним сообщением:" if lang != "en" else "Type a short comment:"), replace=False)
         return
+    daily_add(iso(utcnow()), uid, state, "")
+    await _reply_cbsafe(q, T[lang]["mood_thanks"], replace=False)
+
+# ---------------- SMART CHECK-IN ----------------
+SMART_SHORT = {
+    "ok":     ("Отлично! Держим курс.", "Great — keep it up!"),
+    "pain":   ("Оцените боль 0–10 и напишите, где болит.", "Rate the pain 0–10 and where it hurts."),
+    "tired":  ("Сделайте 10-мин прогулку и 300–500 мл воды.", "Try a 10-min brisk walk + 300–500 ml water."),
+    "stress": ("4× дыхание 4-4-6 и короткая прогулка.", "Do 4 rounds of 4-4-6 breathing + a short walk."),
+    "hb":     ("Изжога: посмотрите триггеры и OTC-варианты ниже.", "Heartburn: see triggers + OTC options below."),
+    "other":  ("Коротко опишите, что беспокоит.", "Briefly describe what’s wrong."),
+}
 
-    if data.startswith("num|"):
-        _, sev = data.split("|", 1)
+@callback_handler("smart")
+async def _cb_smart(q, context, uid: int, lang: str, cb: CbData):
+    key = cb.rest
+    if key not in SMART_SHORT:
+        return False
+    ru, en = SMART_SHORT[key]
+    await _reply_cbsafe(q, ru if lang != "en" else en, replace=False)
+    if key == "hb":
+        await _reply_cbsafe(q, T[lang]["chips_hb"], kb=_chips_kb(lang, "hb"), replace=False)
+
+# ---------------- ЧИПСЫ ----------------
+@callback_handler("chip")
+async def _cb_chip(q, context, uid: int, lang: str, cb: CbData):
+    dom, _, kind = cb.rest.partition("|")
+    await _reply_cbsafe(q, chip_text(dom, kind, lang) or "…", replace=False)
+
+# ---------------- Профиль, 10 шагов ----------------
+@callback_handler("p")
+async def _cb_profile(q, context, uid: int, lang: str, cb: CbData):
+    action, key = cb.arg(0), cb.arg(1)
+    if len(cb.args) < 2:
+        return False
+    if action == "choose":
+        val = cb.arg(2)
+        profiles_upsert(uid, {key: val})
+        sessions.setdefault(uid, {})[key] = val
+        users_set(uid, "profile_banner_shown", "no")
+        await advance_profile_ctx(context, q.message.chat_id, lang, uid)
         try:
-            sev_i = int(sev)
+            await q.answer()
         except Exception:
-            sev_i = 0
-        s = sessions.setdefault(uid, {})
-        s.setdefault("answers", {})["severity"] = sev_i
-        s["step"] = 5
-        await _reply_cbsafe(q, T[lang]["triage_pain_q5"], kb=_kb_for_code(lang, "painrf"), replace=True)
+            pass
         return
-
-    if data.startswith("painrf|"):
-        _, rf = data.split("|", 1)
-        s = sessions.setdefault(uid, {})
-        answers = s.setdefault("answers", {})
-        answers["rf"] = rf
-        # Сформируем план
-        prof = profiles_get(uid)
-        plan_lines = pain_plan(lang, [rf], prof)
-        head = T[lang]["plan_header"].replace("{name}", display_name(uid) or "")
-        await _reply_cbsafe(q, head + "\n" + "\n".join(plan_lines), replace=False)
-        # Создадим эпизод
+    if action == "write":
+        set_state(uid, ST_PROFILE_VALUE, "cb_profile_write", p_wait_key=key)
+        await _reply_cbsafe(q,
+                            ("Пришлите значение одним сообщением." if lang != "en" else "Send the value in one message."),
+                            replace=False)
+        return
+    if action == "skip":
+        await advance_profile_ctx(context, q.message.chat_id, lang, uid)
         try:
-            eid = episode_create(uid, f"pain:{answers.get('loc','')}", int(answers.get("severity", 0)), rf)
-            s["episode_id"] = eid
+            await q.answer()
         except Exception:
             pass
-        # Спросим принять план
-        await _reply_cbsafe(q, T[lang]["plan_accept"], kb=inline_accept(lang), replace=False)
         return
+    return False
 
-    # ---------------- Принятие плана ----------------
-    if data.startswith("acc|"):
-        _, choice = data.split("|", 1)
-        s = sessions.setdefault(uid, {})
-        eid = s.get("episode_id")
-        if choice == "yes":
-            if eid:
-                episode_set(eid, "plan_accepted", "1")
-            await _reply_cbsafe(q, T[lang]["remind_when"], kb=inline_remind(lang), replace=True)
-            return
-        if choice == "later":
-            await _reply_cbsafe(q, T[lang]["remind_when"], kb=inline_remind(lang), replace=True)
-            return
-        if choice == "no":
-            await _reply_cbsafe(q, T[lang]["thanks"].replace("{name}", display_name(uid) or ""), replace=False)
-            return
+# ---------------- TRIAGE: Pain ----------------
+TOPIC_TEXTS = {
+    "nutrition": ("Напишите, что ели вчера и цель (вес/энергия/сон).", "Tell me yesterday’s meals and your goal (weight/energy/sleep)."),
+    "labs":      ("Какие анализы хотите обсудить?", "Which labs do you want to discuss?"),
+    "longevity": ("Сфокусируем долголетие: сон, активность, питание, стресc.", "Longevity focus: sleep, activity, nutrition, stress."),
+}
 
-    # ---------------- Напоминания (и экшены) ----------------
-    if data.startswith("rem|") or data.startswith("act|rem|"):
-        kind = ""
-        if data.startswith("rem|"):
-            _, kind = data.split("|", 1)
-        else:
-            _, _, kind = data.split("|", 2)
-        when_utc = _compute_reminder_when(uid, kind)
-        rid = reminder_add(uid, T[lang]["thanks"].replace("{name}", display_name(uid) or ""), when_utc)
-        await _schedule_oneoff(context.application, uid, when_utc, rid)
-        txt = {"ru": f"Напоминание поставлено ({when_utc.strftime('%Y-%m-%d %H:%M UTC')}).",
-               "uk": f"Нагадування створено ({when_utc.strftime('%Y-%m-%d %H:%M UTC')}).",
-               "es": f"Recordatorio programado ({when_utc.strftime('%Y-%m-%d %H:%M UTC')}).",
-               "en": f"Reminder scheduled ({when_utc.strftime('%Y-%m-%d %H:%M UTC')})."}[lang]
-        await _reply_cbsafe(q, txt, replace=False)
-        # привяжем к эпизоду next_checkin_at, если есть эпизод
-        s = sessions.setdefault(uid, {})
-        if s.get("episode_id"):
-            episode_set(s["episode_id"], "next_checkin_at", iso(when_utc))
+@callback_handler("topic")
+async def _cb_topic(q, context, uid: int, lang: str, cb: CbData):
+    topic = cb.rest
+    if topic == "pain":
+        set_state(uid, ST_PAIN, "cb_topic_pain", topic="pain", step=1, answers={})
+        await _reply_cbsafe(q, T[lang]["triage_pain_q1"], kb=_kb_for_code(lang, "painloc"), replace=True)
+        return
+    if topic == "sleep":
+        await _reply_cbsafe(q, microplan_text("sleepreset", lang), replace=False)
+        return
+    if topic in TOPIC_TEXTS:
+        ru, en = TOPIC_TEXTS[topic]
+        await _reply_cbsafe(q, ru if lang != "en" else en, replace=False)
+        return
+    if topic == "habits":
+        await _reply_cbsafe(q, T[lang]["m_hab"], kb=inline_habits_menu(lang), replace=True)
+        return
+    if topic == "profile":
+        await start_profile_ctx(context, q.message.chat_id, lang, uid)
         return
+    return False
 
-    # ---------------- Экшены ----------------
-    if data.startswith("act|"):
-        parts = data.split("|")
-        if len(parts) >= 2 and parts[1] == "h60":
-            sessions.setdefault(uid, {})["awaiting_h60"] = True
-            await _reply_cbsafe(q, T[lang]["h60_intro"], replace=False)
-            return
-        if len(parts) >= 3 and parts[1] == "ex" and parts[2] == "neck":
-            await _reply_cbsafe(q, microplan_text("neck", lang), replace=False)
-            return
-        if len(parts) >= 2 and parts[1] == "lab":
-            sessions.setdefault(uid, {})["awaiting_city"] = True
-            await _reply_cbsafe(q, T[lang]["act_city_prompt"], replace=False)
-            return
-        if len(parts) >= 2 and parts[1] == "er":
-            await _reply_cbsafe(q, T[lang]["er_text"], replace=False)
-            return
+@callback_handler("pain")
+async def _cb_pain(q, context, uid: int, lang: str, cb: CbData):
+    if cb.rest != "exit":
+        return False
+    set_state(uid, ST_IDLE, "cb_pain_exit")
+    sessions.pop(uid, None)
+    await _reply_cbsafe(q, T[lang]["m_menu_title"], kb=inline_main_menu(lang), replace=True)
+
+# шаг опросника боли: префикс → (ключ ответа, следующий шаг, вопрос, клавиатура)
+PAIN_STEPS = {
+    "painloc":  ("loc",  2, "triage_pain_q2", "painkind"),
+    "painkind": ("kind", 3, "triage_pain_q3", "paindur"),
+    "paindur":  ("dur",  4, "triage_pain_q4", "num"),
+}
 
-    # Если дошли сюда — ничего не совпало
-    await _reply_cbsafe(q, ("Не понял действие." if lang != "en" else "Didn’t catch that action."), replace=False)
+async def _cb_pain_step(q, context, uid: int, lang: str, cb: CbData):
+    field, step, question, kb_code = PAIN_STEPS[cb.prefix]
+    s = sessions.setdefault(uid, {})
+    s.setdefault("answers", {})[field] = cb.rest
+    s["step"] = step
+    await _reply_cbsafe(q, T[lang][question], kb=_kb_for_code(lang, kb_code), replace=True)
+
+for _prefix in PAIN_STEPS:
+    callback_handler(_prefix)(_cb_pain_step)
+
+@callback_handler("num")
+async def _cb_num(q, context, uid: int, lang: str, cb: CbData):
+    try:
+        sev_i = int(cb.rest)
+    except Exception:
+        sev_i = 0
+    s = sessions.setdefault(uid, {})
+    s.setdefault("answers", {})["severity"] = sev_i
+    s["step"] = 5
+    await _reply_cbsafe(q, T[lang]["triage_pain_q5"], kb=_kb_for_code(lang, "painrf"), replace=True)
+
+@callback_handler("painrf")
+async def _cb_painrf(q, context, uid: int, lang: str, cb: CbData):
+    rf = cb.rest
+    s = sessions.setdefault(uid, {})
+    answers = s.setdefault("answers", {})
+    answers["rf"] = rf
+    # Сформируем план
+    prof = profiles_get(uid)
+    plan_lines = pain_plan(lang, [rf], prof)
+    head = tr(lang, "plan_header", uid)
+    await _reply_cbsafe(q, head + "\n" + "\n".join(plan_lines), replace=False)
+    # Создадим эпизод
+    try:
+        eid = episode_create(uid, f"pain:{answers.get('loc','')}", int(answers.get("severity", 0)), rf)
+        s["episode_id"] = eid
+    except Exception:
+        pass
+    # Спросим принять план
+    await _reply_cbsafe(q, T[lang]["plan_accept"], kb=inline_accept(lang), replace=False)
+
+# ---------------- Принятие плана ----------------
+@callback_handler("acc")
+async def _cb_accept(q, context, uid: int, lang: str, cb: CbData):
+    choice = cb.rest
+    if choice in {"yes", "later"}:
+        eid = sessions.setdefault(uid, {}).get("episode_id")
+        if choice == "yes" and eid:
+            episode_set(eid, "plan_accepted", "1")
+        await _reply_cbsafe(q, T[lang]["remind_when"], kb=inline_remind(lang), replace=True)
+        return
+    if choice == "no":
+        await _reply_cbsafe(q, tr(lang, "thanks", uid), replace=False)
+        return
+    return False
+
+# ---------------- Напоминания (и экшены) ----------------
+REMINDER_SCHEDULED = {"ru": "Напоминание поставлено ({when}).",
+                      "uk": "Нагадування створено ({when}).",
+                      "es": "Recordatorio programado ({when}).",
+                      "en": "Reminder scheduled ({when})."}
+
+async def _set_quick_reminder(q, context, uid: int, lang: str, kind: str):
+    when_utc = _compute_reminder_when(uid, kind)
+    rem_text = tr(lang, "thanks", uid)
+    rid = reminder_add(uid, rem_text, when_utc)
+    await _schedule_oneoff(context.application, uid, when_utc, rid, rem_text, lang)
+    txt = REMINDER_SCHEDULED[lang].format(when=when_utc.strftime('%Y-%m-%d %H:%M UTC'))
+    await _reply_cbsafe(q, txt, replace=False)
+    # привяжем к эпизоду next_checkin_at, если есть эпизод
+    s = sessions.setdefault(uid, {})
+    if s.get("episode_id"):
+        episode_set(s["episode_id"], "next_checkin_at", iso(when_utc))
+
+@callback_handler("rem")
+async def _cb_rem(q, context, uid: int, lang: str, cb: CbData):
+    await _set_quick_reminder(q, context, uid, lang, cb.rest)
+
+# ---------------- Экшены ----------------
+@callback_handler("act")
+async def _cb_act(q, context, uid: int, lang: str, cb: CbData):
+    action = cb.arg(0)
+    if action == "rem":
+        await _set_quick_reminder(q, context, uid, lang, cb.rest.split("|", 1)[1] if "|" in cb.rest else "")
+        return
+    if action == "h60":
+        set_state(uid, ST_H60, "cb_act_h60")
+        await _reply_cbsafe(q, T[lang]["h60_intro"], replace=False)
+        return
+    if action == "ex" and cb.arg(1) == "neck":
+        await _reply_cbsafe(q, microplan_text("neck", lang), replace=False)
+        return
+    if action == "lab":
+        set_state(uid, ST_CITY, "cb_act_lab")
+        await _reply_cbsafe(q, T[lang]["act_city_prompt"], replace=False)
+        return
+    if action == "er":
+        await _reply_cbsafe(q, T[lang]["er_text"], replace=False)
+        return
+    return False
+
+
+def bench_callbacks(n: int = 200_000):
+    """python main.py --bench callbacks — стоимость разбора и поиска хэндлера на один тап
+    по каждому префиксу; для сравнения — прежняя линейная цепочка startswith."""
+    chain = [p + "|" for p in CALLBACKS]
+    print(f"{'prefix':<10} {'table ns':>9} {'chain ns':>9}")
+    for prefix in CALLBACKS:
+        data = f"{prefix}|x|y"
+        t0 = time.perf_counter()
+        for _ in range(n):
+            CALLBACKS.get(CbData(data).prefix)
+        t_table = (time.perf_counter() - t0) / n * 1e9
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for c in chain:
+                if data.startswith(c):
+                    data.split("|")
+                    break
+        t_chain = (time.perf_counter() - t0) / n * 1e9
+        print(f"{prefix:<10} {t_table:>9.0f} {t_chain:>9.0f}")
+
+
+def bench_keywords(n: int = 20_000):
+    """python main.py --bench keywords — один проход KeywordEngine против прежних
+    отдельных сканов (serious, вопрос, чипы, факты, белок) на типичных сообщениях."""
+    samples = [
+        "Сплю 5-6 ч, стресс на работе, изжога после еды. Что делать?",
+        "my neck hurts after long calls and I drink 500 мл water",
+        "Болит голова с утра, давление нормальное",
+        "I was diagnosed with diabetes last year, hba1c 7.1 — can I fast?",
+        "хочу больше белка на завтрак",
+        "ok",
+    ]
+    q_kws = QUESTION_WORDS
+    lists = [*SERIOUS_KWS.values(), *CHIP_KWS.values(), *FACT_KWS.values(), H60_PROTEIN_KWS]
+
+    def legacy(low):
+        for kws in lists:
+            any(k in low for k in kws)
+        any(re.search(rf"\b{kw}\b", low) for kw in q_kws)
+
+    print(f"{'len':>4} {'engine us':>10} {'legacy us':>10}")
+    for s in samples:
+        low = s.lower()
+        t0 = time.perf_counter()
+        for _ in range(n):
+            KEYWORDS.scan(low)
+        t_engine = (time.perf_counter() - t0) / n * 1e6
+        t0 = time.perf_counter()
+        for _ in range(n):
+            legacy(low)
+        t_legacy = (time.perf_counter() - t0) / n * 1e6
+        print(f"{len(low):>4} {t_engine:>10.2f} {t_legacy:>10.2f}")
+
+
+def bench_dedupe(seed: int = 7):
+    """python main.py --bench dedupe — PromptSig против голого SequenceMatcher на текстах
+    бота (T) и их слегка изменённых копиях: решения должны совпасть один в один."""
+    rnd = random.Random(seed)
+    corpus = [v for bundle in T.values() for v in bundle.values() if isinstance(v, str) and v.strip()]
+    variants = []
+    for text in corpus:
+        chars = list(text)
+        for _ in range(rnd.randint(0, 3)):
+            if chars:
+                chars[rnd.randrange(len(chars))] = rnd.choice("aeoу ,!")
+        variants.append("".join(chars))
+    pairs = [(a, b) for a, b in zip(corpus, variants)] + [(rnd.choice(corpus), rnd.choice(corpus)) for _ in range(2000)]
+    # граница: ratio ровно 0.93 (186/200) должен считаться дублем
+    pairs += [("abcdefghij" * 9 + "abc" + "z" * 14, "abcdefghij" * 9 + "abc"),
+              ("q" + "lorem ipsum " * 8 + "x" * 13, "lorem ipsum " * 8)]
+    sigs = [(PromptSig(a), PromptSig(b)) for a, b in pairs]
+    t0 = time.perf_counter()
+    legacy = [_ratio(a, b) >= 0.93 for a, b in pairs]
+    t_legacy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fast = [sa.similar(sb, 0.93) for sa, sb in sigs]
+    t_fast = time.perf_counter() - t0
+    mismatch = sum(x != y for x, y in zip(legacy, fast))
+    print(f"pairs={len(pairs)} duplicates={sum(legacy)} mismatches={mismatch}")
+    print(f"SequenceMatcher {t_legacy / len(pairs) * 1e6:.1f} us/pair, PromptSig {t_fast / len(pairs) * 1e6:.1f} us/pair")
 
 
 # ---------- Регистрация хэндлеров ЧАСТИ 2 и entrypoint ----------
@@ -2616,11 +4875,29 @@ def _setup_part2_handlers(app):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench":
+        {"callbacks": bench_callbacks, "keywords": bench_keywords, "dedupe": bench_dedupe}[sys.argv[2]]()
+        sys.exit(0)
     # Собираем приложение и включаем «вторую половину» хэндлеров
     application = build_app()
     _setup_part2_handlers(application)
-    # Запуск
+    # Запуск: webhook — Telegram получает 200 сразу после постановки апдейта в очередь,
+    # обработка идёт через PerUserUpdateProcessor
+    mode = sys.argv[1] if len(sys.argv) > 1 else RUN_MODE
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if mode == "webhook":
+            if not WEBHOOK_URL:
+                raise SystemExit("WEBHOOK_URL is required for webhook mode")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=MAX_CONCURRENT_UPDATES,
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except KeyboardInterrupt:
         pass
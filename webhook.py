@@ -1,7 +1,11 @@
 import os
-import requests
+import json
+import random
+import asyncio
+from collections import OrderedDict, deque
+import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
@@ -13,24 +17,126 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_SHEETS_WEBHOOK = os.getenv("GOOGLE_SHEETS_WEBHOOK")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "10000"))
+WEBHOOK_DEDUPE_SIZE = int(os.getenv("WEBHOOK_DEDUPE_SIZE", "50000"))
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", "30"))
+FEEDBACK_FLUSH_SEC = float(os.getenv("FEEDBACK_FLUSH_SEC", "5"))
+FEEDBACK_BATCH_MAX = int(os.getenv("FEEDBACK_BATCH_MAX", "200"))
+FEEDBACK_RETRIES = int(os.getenv("FEEDBACK_RETRIES", "4"))
+FEEDBACK_SPILL_FILE = os.getenv("FEEDBACK_SPILL_FILE", "feedback_spill.jsonl")
 
 openai = OpenAI(api_key=OPENAI_API_KEY)
 app = FastAPI()
 telegram_app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
 
 # 🔹 Отправка в Google Таблицу
+# Фоновый отправщик: отзывы копятся в памяти и раз в FEEDBACK_FLUSH_SEC уходят одним
+# POST {"items": [{"user_id", "feedback"}, ...]} через общий httpx-клиент. При ошибке —
+# повтор с экспоненциальной задержкой (4xx не повторяются), если не вышло — пачка
+# дописывается в FEEDBACK_SPILL_FILE и отправляется при следующем успешном цикле.
+class FeedbackForwarder:
+    def __init__(self, url: str):
+        self.url = url
+        self.pending = []
+        self.inflight = []   # пачка, которая сейчас отправляется (вернётся в pending при остановке)
+        self.client = None
+        self.task = None
+
+    def add(self, user_id: int, feedback: str):
+        self.pending.append({"user_id": user_id, "feedback": feedback})
+
+    def start(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            follow_redirects=True,  # Apps Script отвечает редиректом
+        )
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        batch, self.inflight, self.pending = self.inflight + self.pending, [], []
+        if batch and not await self.post(batch, retries=1):
+            await asyncio.to_thread(self.spill, batch)
+        if self.client:
+            await self.client.aclose()
+
+    async def post(self, batch, retries: int) -> bool:
+        """True — пачка доставлена или отвергнута окончательно (4xx), повторять не нужно."""
+        delay = 1.0
+        for attempt in range(retries):
+            try:
+                r = await self.client.post(self.url, json={"items": batch})
+                if r.status_code < 400:
+                    print(f"✔️ Отзывы отправлены: {len(batch)}")
+                    return True
+                if r.status_code < 500 and r.status_code not in (408, 429):
+                    print(f"❌ Таблица отвергла пачку ({r.status_code}), отзывов отброшено: {len(batch)}")
+                    return True
+                print(f"❌ Таблица ответила {r.status_code}")
+            except httpx.HTTPError as e:
+                print(f"❌ Ошибка при отправке отзывов: {e}")
+            if attempt + 1 < retries:
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+                delay *= 2
+        return False
+
+    def spill(self, batch):
+        with open(FEEDBACK_SPILL_FILE, "a", encoding="utf-8") as f:
+            for item in batch:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    def read_spill(self):
+        if not os.path.exists(FEEDBACK_SPILL_FILE):
+            return []
+        with open(FEEDBACK_SPILL_FILE, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def rewrite_spill(self, items):
+        """Файл уменьшается только после успешной отправки — до этого отзывы лежат на диске."""
+        if not items:
+            if os.path.exists(FEEDBACK_SPILL_FILE):
+                os.remove(FEEDBACK_SPILL_FILE)
+            return
+        tmp = FEEDBACK_SPILL_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        os.replace(tmp, FEEDBACK_SPILL_FILE)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(FEEDBACK_FLUSH_SEC)
+            if not self.pending:
+                continue
+            self.inflight = self.pending[:FEEDBACK_BATCH_MAX]
+            del self.pending[:len(self.inflight)]
+            if await self.post(self.inflight, FEEDBACK_RETRIES):
+                self.inflight = []
+                # канал ожил — досылаем то, что ушло на диск
+                spilled = await asyncio.to_thread(self.read_spill)
+                for i in range(0, len(spilled), FEEDBACK_BATCH_MAX):
+                    if not await self.post(spilled[i:i + FEEDBACK_BATCH_MAX], FEEDBACK_RETRIES):
+                        break
+                    await asyncio.to_thread(self.rewrite_spill, spilled[i + FEEDBACK_BATCH_MAX:])
+            else:
+                batch, self.inflight = self.inflight, []
+                await asyncio.to_thread(self.spill, batch)
+
+feedback_forwarder = FeedbackForwarder(GOOGLE_SHEETS_WEBHOOK) if GOOGLE_SHEETS_WEBHOOK else None
+
 def send_feedback_to_google_sheets(user_id: int, feedback: str):
-    if not GOOGLE_SHEETS_WEBHOOK:
+    if not feedback_forwarder:
         print("❗ GOOGLE_SHEETS_WEBHOOK не указан в .env")
         return
-    try:
-        response = requests.post(GOOGLE_SHEETS_WEBHOOK, json={
-            "user_id": user_id,
-            "feedback": feedback
-        })
-        print(f"✔️ Отзыв отправлен: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Ошибка при отправке отзыва: {e}")
+    feedback_forwarder.add(user_id, feedback)
 
 # 🔹 Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -49,7 +155,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        response = openai.chat.completions.create(
+        # синхронный клиент — в отдельном потоке, чтобы не блокировать event loop
+        response = await asyncio.to_thread(
+            openai.with_options(timeout=OPENAI_TIMEOUT_SEC).chat.completions.create,
             model="gpt-3.5-turbo",
             messages=[
                 {
@@ -86,10 +194,118 @@ telegram_app.add_handler(CommandHandler("start", start))
 telegram_app.add_handler(CommandHandler("feedback", feedback))
 telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+# 🔹 Очередь апдейтов: вебхук только кладёт апдейт в общую очередь и сразу отвечает 200,
+# её разбирают WEBHOOK_WORKERS воркеров. Порядок внутри пользователя: если его апдейт уже
+# обрабатывает другой воркер, новый откладывается в busy[user_id] и тот же воркер
+# доберёт его следом, а этот берёт следующий апдейт. Медленный пользователь занимает
+# один воркер, но не держит очередь остальных.
+queue = None
+busy = {}                         # user_id → deque отложенных апдейтов (ключ есть, пока идёт обработка)
+workers = []
+seen_update_ids = OrderedDict()   # LRU по update_id: Telegram повторяет медленные вебхуки
+stats = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "errors": 0}
+
+def _update_key(data: dict) -> int:
+    for field in ("message", "edited_message", "callback_query", "my_chat_member", "inline_query"):
+        obj = data.get(field)
+        if isinstance(obj, dict):
+            who = obj.get("from") or obj.get("chat") or {}
+            if isinstance(who.get("id"), int):
+                return who["id"]
+    return data["update_id"]
+
+def _seen(update_id: int) -> bool:
+    if update_id in seen_update_ids:
+        seen_update_ids.move_to_end(update_id)
+        return True
+    seen_update_ids[update_id] = None
+    if len(seen_update_ids) > WEBHOOK_DEDUPE_SIZE:
+        seen_update_ids.popitem(last=False)
+    return False
+
+def _backlog() -> int:
+    return queue.qsize() + sum(len(d) for d in busy.values())
+
+async def process(data: dict):
+    try:
+        update = Update.de_json(data, telegram_app.bot)
+        await telegram_app.process_update(update)
+        stats["processed"] += 1
+    except Exception as e:
+        stats["errors"] += 1
+        print(f"❌ Ошибка обработки апдейта {data.get('update_id')}: {e}")
+    finally:
+        queue.task_done()
+
+async def worker():
+    while True:
+        data = await queue.get()
+        key = _update_key(data)
+        if key in busy:
+            busy[key].append(data)
+            continue
+        busy[key] = deque()
+        try:
+            await process(data)
+            while busy[key]:
+                await process(busy[key].popleft())
+        finally:
+            # при отмене воркера отложенные апдейты пользователя не должны повиснуть в join()
+            for _ in busy.pop(key, ()):
+                queue.task_done()
+
+@app.on_event("startup")
+async def on_startup():
+    await telegram_app.initialize()
+    if feedback_forwarder:
+        feedback_forwarder.start()
+    global queue
+    queue = asyncio.Queue()   # предел — WEBHOOK_QUEUE_MAX вместе с отложенными, см. root()
+    for _ in range(WEBHOOK_WORKERS):
+        workers.append(asyncio.create_task(worker()))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # дорабатываем то, что уже приняли, затем останавливаемся
+    try:
+        await asyncio.wait_for(queue.join(), timeout=10)
+    except asyncio.TimeoutError:
+        print("❗ Очередь не успела опустеть при остановке")
+    for t in workers:
+        t.cancel()
+    if feedback_forwarder:
+        await feedback_forwarder.stop()
+    await telegram_app.shutdown()
+
 # 🔹 Вебхук от Telegram
 @app.post("/")
 async def root(request: Request):
-    json_data = await request.json()
-    update = Update.de_json(json_data, telegram_app.bot)
-    await telegram_app.process_update(update)
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    try:
+        data = await request.json()
+        update_id = data["update_id"]
+        if not isinstance(update_id, int):
+            raise ValueError("update_id")
+    except Exception:
+        return Response(status_code=400)
+    stats["received"] += 1
+    if _seen(update_id):
+        stats["duplicates"] += 1
+        return {"ok": True}
+    if _backlog() >= WEBHOOK_QUEUE_MAX:
+        # пусть Telegram повторит позже; повтор не отбросится как дубликат
+        seen_update_ids.pop(update_id, None)
+        stats["rejected"] += 1
+        return Response(status_code=503)
+    queue.put_nowait(data)
     return {"ok": True}
+
+# 🔹 Метрики (Prometheus text format)
+@app.get("/metrics")
+async def metrics():
+    lines = [f"webhook_queue_depth {queue.qsize()}",
+             f"webhook_parked_updates {sum(len(d) for d in busy.values())}",
+             f"webhook_busy_users {len(busy)}"]
+    lines += [f"webhook_updates_{k}_total {v}" for k, v in stats.items()]
+    return Response("\n".join(lines) + "\n", media_type="text/plain")